@@ -0,0 +1,691 @@
+'''
+Matching engine in its own process, fed through shared-memory ring buffers.
+
+In this mode the API workers (uvicorn --workers N) only parse HTTP and build
+JSON; every order book lives in one engine process that matches on a single
+thread, so matching is deterministic and never competes with request
+handling for a GIL.
+
+Each API worker claims one channel: a pair of single-producer single-consumer
+rings in a multiprocessing.shared_memory segment, one carrying requests to
+the engine and one carrying responses back. A channel is claimed by taking
+an flock on its lock file, which the kernel releases if the worker dies.
+Rings hold fixed-width slots; numbers that are Decimals in the book travel as
+fixed-width ASCII fields so they round-trip exactly. Because an order matches
+at most one resting order (see OrderBook.process_limit_order), a response
+always fits in one slot.
+
+The engine also publishes the /api/orderbook body of each of its books to
+a directory (BookPublisher), from which the workers serve that endpoint.
+
+Run the engine before the API workers:
+
+    python engine.py --name orderbook --channels 8
+    ORDERBOOK_ENGINE=orderbook uvicorn main:app --workers 4
+'''
+import argparse
+import fcntl
+import json
+import os
+import signal
+import struct
+import tempfile
+import threading
+import time
+from decimal import Decimal
+from multiprocessing import shared_memory
+
+from orderbook.registry import SymbolRegistry, RegistryFull, make_symbol
+from orderbook.memory import BookLimitPolicy, parse_book_limits
+
+# Ring layout: producer index, consumer index (on separate cache lines), then
+# the slots. Indexes only grow; slot = index % slots.
+RING_HEADER = 128
+HEAD = struct.Struct('<Q')
+
+# Width of Decimal fields, enough for the exact value of a JSON float
+# (Decimal(0.1) has 55 digits), and of account and asset fields
+NUMBER_WIDTH = 96
+TEXT_WIDTH = 64
+
+# seq, op, side, order id, price, quantity, display quantity (iceberg
+# orders, empty otherwise), account, base asset, quote asset
+REQUEST = struct.Struct('<QBB6xq96s96s96s64s64s64s')
+# One block per order carried in a response: order_id, timestamp, price,
+# quantity, account, trade_id
+ORDER_BLOCK = 'qq96s96s64s64s'
+# ... the two order blocks, the book's state root after a register
+# (commitment.py) and a message
+RESPONSE = struct.Struct('<QBBB5xqq96s96s' + ORDER_BLOCK * 2 + '32s128s')
+REQUEST_SLOT = (REQUEST.size + 63) // 64 * 64
+RESPONSE_SLOT = (RESPONSE.size + 63) // 64 * 64
+
+OP_REGISTER = 1
+OP_CANCEL = 2
+OP_BEST = 3
+OP_ORDER = 4  # look an order id up in every book
+
+STATUS_OK = 0
+STATUS_REJECTED = 1  # the book refused the order
+STATUS_NOT_FOUND = 2  # with BOOK_NOT_FOUND or ORDER_NOT_FOUND as the message
+STATUS_FULL = 3  # no room for a new market (RegistryFull)
+STATUS_ERROR = 4
+
+# The API answers these exactly as when it holds the books itself
+BOOK_NOT_FOUND = 'Order book not found'
+ORDER_NOT_FOUND = 'Order not found'
+
+# Response flags
+HAS_RESTING = 1  # the order rests in the book
+HAS_TRADE = 2  # block A is the maker of a trade
+HAS_ORDER = 4  # block A is an order (cancelled or best order)
+HAS_NEXT_BEST = 8  # block B is the next best order
+# Block A is an ask. Set by OP_ORDER, whose block B holds the order's base and
+# quote asset in its account and trade_id fields.
+ASK_ORDER = 16
+
+SIDES = ('bid', 'ask')
+
+
+def _text(value):
+    return b'' if value is None else str(value).encode('utf-8')
+
+
+def _field(raw):
+    return raw.rstrip(b'\0').decode('utf-8')
+
+
+def _decimal(raw):
+    raw = raw.rstrip(b'\0')
+    return Decimal(raw.decode('ascii')) if raw else None
+
+
+def order_rejection(side, price, quantity):
+    '''Why process_order cannot take this limit order, or None: it exits
+    the process on an unknown side or a size of 0 or less, and a price that
+    is not a finite number does not compare.'''
+    if side not in SIDES:
+        return 'side must be "bid" or "ask"'
+    if quantity is None or not quantity.is_finite() or quantity <= 0:
+        return 'No orders of size 0 or less'
+    if price is None or not price.is_finite():
+        return 'price must be a finite number'
+    return None
+
+
+def _optional(raw):
+    text = _field(raw)
+    return text if text else None
+
+
+class Ring(object):
+    '''Single-producer single-consumer ring of fixed-width slots over a
+    buffer. The producer writes the slot before publishing the new head, so
+    the consumer never sees a partly written slot.'''
+
+    def __init__(self, buf, offset, slots, slot_size):
+        self.buf = buf
+        self.head_offset = offset
+        self.tail_offset = offset + RING_HEADER // 2
+        self.data_offset = offset + RING_HEADER
+        self.slots = slots
+        self.slot_size = slot_size
+
+    @staticmethod
+    def size(slots, slot_size):
+        return RING_HEADER + slots * slot_size
+
+    def put(self, data):
+        head = HEAD.unpack_from(self.buf, self.head_offset)[0]
+        tail = HEAD.unpack_from(self.buf, self.tail_offset)[0]
+        if head - tail >= self.slots:
+            return False
+        start = self.data_offset + (head % self.slots) * self.slot_size
+        self.buf[start:start + len(data)] = data
+        HEAD.pack_into(self.buf, self.head_offset, head + 1)
+        return True
+
+    def get(self):
+        tail = HEAD.unpack_from(self.buf, self.tail_offset)[0]
+        head = HEAD.unpack_from(self.buf, self.head_offset)[0]
+        if tail == head:
+            return None
+        start = self.data_offset + (tail % self.slots) * self.slot_size
+        data = bytes(self.buf[start:start + self.slot_size])
+        HEAD.pack_into(self.buf, self.tail_offset, tail + 1)
+        return data
+
+    def skip_pending(self):
+        HEAD.pack_into(self.buf, self.tail_offset, HEAD.unpack_from(self.buf, self.head_offset)[0])
+
+
+def channel_size(slots):
+    return Ring.size(slots, REQUEST_SLOT) + Ring.size(slots, RESPONSE_SLOT)
+
+
+def channel_rings(buf, slots):
+    '''(request ring, response ring) of a channel segment.'''
+    return (Ring(buf, 0, slots, REQUEST_SLOT),
+            Ring(buf, Ring.size(slots, REQUEST_SLOT), slots, RESPONSE_SLOT))
+
+
+def segment_name(name, index):
+    return '%s-%d' % (name, index)
+
+
+def attach_segment(name):
+    # Attaching must not register the segment with this process's resource
+    # tracker, or it would be unlinked when the worker exits
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        from multiprocessing import resource_tracker
+        segment = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment
+
+
+class Backoff(object):
+    '''Spin briefly, then sleep with growing intervals while a ring is idle.'''
+
+    def __init__(self, spins=200, max_sleep=0.001):
+        self.spins = spins
+        self.max_sleep = max_sleep
+        self.idle = 0
+
+    def reset(self):
+        self.idle = 0
+
+    def wait(self):
+        self.idle += 1
+        if self.idle > self.spins:
+            time.sleep(min(self.max_sleep, 0.00005 * (self.idle - self.spins)))
+
+
+def publish_directory(name):
+    return os.path.join(tempfile.gettempdir(), '%s-books' % name)
+
+
+def orderbook_body(order_book, symbol):
+    # Same bytes as the JSONResponse of /api/orderbook
+    return json.dumps({
+        "message": "Order book retrieved successfully",
+        "orderbook": order_book.get_orderbook(symbol),
+        "status_code": 1
+    }, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+class BookPublisher(object):
+    '''
+    Writes the /api/orderbook body of every book to <symbol>.json in
+    directory, for the API workers to serve. Runs on the matching thread
+    every interval seconds: a book is written again once its sequence moved,
+    or after max_age seconds in any case since the body carries the rolling
+    24h stats. Files are replaced atomically, so a reader always sees a
+    whole body; files of evicted books are removed.
+    '''
+
+    def __init__(self, directory, interval=0.1, max_age=1.0, clock=time.monotonic):
+        self.directory = directory
+        self.interval = interval
+        self.max_age = max_age
+        self.clock = clock
+        self.published = {}  # symbol : (OrderBook.sequence, time written)
+        self.writes = 0
+        self.errors = 0
+        self.last_error = None
+        os.makedirs(directory, exist_ok=True)
+        # Books of a previous engine are not ours to serve
+        self.clear()
+
+    def path(self, symbol):
+        return os.path.join(self.directory, symbol + '.json')
+
+    def publish(self, registry):
+        now = self.clock()
+        live = set()
+        for symbol, order_book in registry.items():
+            live.add(symbol)
+            last = self.published.get(symbol)
+            if last is not None and last[0] == order_book.sequence and now - last[1] < self.max_age:
+                continue
+            sequence = order_book.sequence
+            try:
+                path = self.path(symbol)
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(orderbook_body(order_book, symbol))
+                os.replace(path + '.tmp', path)
+            except Exception as e:
+                self.errors += 1
+                self.last_error = str(e)
+                continue
+            self.published[symbol] = (sequence, now)
+            self.writes += 1
+        for symbol in set(self.published) - live:
+            del self.published[symbol]
+            self.remove(symbol)
+
+    def remove(self, symbol):
+        try:
+            os.remove(self.path(symbol))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.json') or filename.endswith('.json.tmp'):
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except FileNotFoundError:
+                    pass
+        self.published.clear()
+
+
+def _order_block(order):
+    if order is None:
+        return (0, 0, b'', b'', b'', b'')
+    return (order.order_id, order.timestamp, _text(order.price), _text(order.quantity),
+            _text(order.account), _text(order.trade_id))
+
+
+class Engine(object):
+    '''Owns the books and answers requests from every channel in turn.'''
+
+    def __init__(self, name, channels, slots=1024, markets=(), max_books=1000, idle_seconds=300,
+                 book_limits=None, publisher=None):
+        self.registry = SymbolRegistry(markets, max_books, idle_seconds)
+        self.registry.add_listener(BookLimitPolicy(book_limits or {}))
+        self.publisher = publisher
+        self.segments = []
+        self.channels = []
+        for index in range(channels):
+            try:
+                segment = shared_memory.SharedMemory(name=segment_name(name, index), create=True,
+                                                     size=channel_size(slots))
+            except FileExistsError:
+                # Left behind by an engine that did not shut down cleanly
+                stale = shared_memory.SharedMemory(name=segment_name(name, index))
+                stale.close()
+                stale.unlink()
+                segment = shared_memory.SharedMemory(name=segment_name(name, index), create=True,
+                                                     size=channel_size(slots))
+            self.segments.append(segment)
+            self.channels.append(channel_rings(segment.buf, slots))
+        self.running = True
+
+    def handle(self, data):
+        seq, op, side, order_id, price, quantity, display, account, base, quote = REQUEST.unpack_from(data)
+        try:
+            side = SIDES[side]
+            if op == OP_ORDER:
+                return self.find_order(seq, order_id)
+            symbol = make_symbol(_field(base), _field(quote))
+            if op == OP_REGISTER:
+                return self.register(seq, symbol, side, price, quantity, display, _field(account), base, quote)
+            order_book = self.registry.get(symbol)
+            if order_book is None:
+                return self.response(seq, STATUS_NOT_FOUND, message=BOOK_NOT_FOUND)
+            if op == OP_CANCEL:
+                tree = order_book.bids if side == 'bid' else order_book.asks
+                if not tree.order_exists(order_id):
+                    return self.response(seq, STATUS_NOT_FOUND, message=ORDER_NOT_FOUND)
+                order = tree.get_order(order_id)
+                order_book.cancel_order(side, order_id)
+                return self.response(seq, STATUS_OK, flags=HAS_ORDER, timestamp=order_book.time,
+                                     block_a=_order_block(order))
+            if op == OP_BEST:
+                top = order_book.get_top_of_book(side)
+                if top is None:
+                    return self.response(seq, STATUS_OK)
+                return self.response(seq, STATUS_OK, flags=HAS_ORDER, block_a=_order_block(top['head_order']))
+            return self.response(seq, STATUS_ERROR, message='Unknown command %d' % op)
+        except RegistryFull as e:
+            return self.response(seq, STATUS_FULL, message=str(e))
+        except Exception as e:
+            return self.response(seq, STATUS_ERROR, message=str(e))
+
+    def find_order(self, seq, order_id):
+        for symbol, order_book in self.registry.items():
+            for tree in (order_book.bids, order_book.asks):
+                if tree.order_exists(order_id):
+                    order = tree.get_order(order_id)
+                    flags = HAS_ORDER | (ASK_ORDER if tree is order_book.asks else 0)
+                    return self.response(seq, STATUS_OK, flags=flags, block_a=_order_block(order),
+                                         block_b=(0, 0, b'', b'', _text(order.baseAsset), _text(order.quoteAsset)))
+        return self.response(seq, STATUS_NOT_FOUND, message=ORDER_NOT_FOUND)
+
+    def register(self, seq, symbol, side, price, quantity, display, account, base, quote):
+        price, quantity = _decimal(price), _decimal(quantity)
+        rejection = order_rejection(side, price, quantity)
+        if rejection is not None:
+            return self.response(seq, STATUS_REJECTED, message=rejection)
+        order_book = self.registry.get_or_create(symbol)
+        _order = {
+            'type': 'limit',
+            'trade_id': account,
+            'account': account,
+            'price': price,
+            'quantity': quantity,
+            'side': side,
+            'baseAsset': _field(base),
+            'quoteAsset': _field(quote)
+        }
+        if display.rstrip(b'\0'):
+            _order['displayQuantity'] = _decimal(display)
+        result = order_book.process_order(_order, False, False)
+        if not result["success"]:
+            return self.response(seq, STATUS_REJECTED, message=result["message"])
+        trades, order, task_id, next_best_order = result["data"]
+        flags = 0
+        resting_id = 0
+        resting_quantity = b''
+        traded_quantity = b''
+        block_a = _order_block(None)
+        if order is not None:
+            flags |= HAS_RESTING
+            resting_id = order['order_id']
+            resting_quantity = _text(order['quantity'])
+        if trades:
+            trade = trades[0]
+            maker_trade_id, _, maker_order_id, new_book_quantity = trade['party1']
+            flags |= HAS_TRADE
+            traded_quantity = _text(trade['quantity'])
+            block_a = (maker_order_id, trade['timestamp'], _text(trade['price']), _text(new_book_quantity),
+                       b'', _text(maker_trade_id))
+        if next_best_order is not None:
+            flags |= HAS_NEXT_BEST
+        return self.response(seq, STATUS_OK, task_id, flags, resting_id, order_book.time, resting_quantity,
+                             traded_quantity, block_a, _order_block(next_best_order),
+                             state_root=order_book.commitment.root())
+
+    @staticmethod
+    def response(seq, status, task_id=0, flags=0, order_id=0, timestamp=0, quantity=b'',
+                 traded_quantity=b'', block_a=None, block_b=None, state_root=b'', message=''):
+        return RESPONSE.pack(seq, status, task_id, flags, order_id, timestamp, quantity, traded_quantity,
+                             *(block_a or _order_block(None)), *(block_b or _order_block(None)),
+                             state_root, message.encode('utf-8')[:128])
+
+    def serve(self):
+        backoff = Backoff()
+        next_publish = 0
+        while self.running:
+            if self.publisher is not None and time.monotonic() >= next_publish:
+                self.publisher.publish(self.registry)
+                next_publish = time.monotonic() + self.publisher.interval
+            busy = False
+            for requests, responses in self.channels:
+                data = requests.get()
+                if data is None:
+                    continue
+                busy = True
+                response = self.handle(data)
+                while not responses.put(response):
+                    time.sleep(0.0001)  # the worker's reader always drains
+            if busy:
+                backoff.reset()
+            else:
+                backoff.wait()
+
+    def stop(self, *args):
+        self.running = False
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+            segment.unlink()
+        if self.publisher is not None:
+            self.publisher.clear()
+
+
+class EngineModeMiddleware:
+    '''Answers 503 on endpoints that read the books directly, which only
+    exist in the engine process in this mode.'''
+
+    def __init__(self, app, local_paths):
+        self.app = app
+        self.local_paths = set(local_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.local_paths:
+            await send({
+                "type": "http.response.start",
+                "status": 503,
+                "headers": [(b"content-type", b"application/json")],
+            })
+            await send({
+                "type": "http.response.body",
+                "body": b'{"message":"Not available when matching runs in the engine process","status_code":0}',
+            })
+            return
+        await self.app(scope, receive, send)
+
+
+class EngineOrder(object):
+    '''An order as reported by the engine, with the attributes of Order that
+    the API serializes.'''
+
+    def __init__(self, block, side, base_asset, quote_asset):
+        order_id, timestamp, price, quantity, account, trade_id = block
+        self.order_id = order_id
+        self.timestamp = timestamp
+        self.price = _decimal(price)
+        self.quantity = _decimal(quantity)
+        self.account = _optional(account)
+        self.trade_id = _optional(trade_id)
+        self.side = side
+        self.baseAsset = base_asset
+        self.quoteAsset = quote_asset
+
+
+class EngineClient(object):
+    '''
+    API worker side of a channel. Any number of request threads may call
+    it: requests are written to the request ring under a lock and a reader
+    thread hands each response to the thread waiting on its sequence number.
+    '''
+
+    def __init__(self, name, channels, slots=1024, timeout=5.0, lock_dir=None):
+        lock_dir = lock_dir or tempfile.gettempdir()
+        self.timeout = timeout
+        for index in range(channels):
+            lock_file = open(os.path.join(lock_dir, '%s.lock' % segment_name(name, index)), 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                continue
+            self.lock_file = lock_file
+            self.index = index
+            break
+        else:
+            raise RuntimeError('All %d engine channels are in use' % channels)
+        self.segment = attach_segment(segment_name(name, self.index))
+        self.requests, self.responses = channel_rings(self.segment.buf, slots)
+        # Responses left by a previous owner of the channel are not ours;
+        # sequence numbers start from the clock so they cannot collide either
+        self.responses.skip_pending()
+        self.seq = time.time_ns()
+        self.pending = {}  # seq : [threading.Event, response tuple]
+        self.lock = threading.Lock()
+        self.running = True
+        self.reader = threading.Thread(target=self._read, name='engine-reader', daemon=True)
+        self.reader.start()
+
+    def _read(self):
+        backoff = Backoff(spins=50)
+        while self.running:
+            data = self.responses.get()
+            if data is None:
+                backoff.wait()
+                continue
+            backoff.reset()
+            response = RESPONSE.unpack_from(data)
+            waiter = self.pending.pop(response[0], None)
+            if waiter is not None:
+                waiter[1] = response
+                waiter[0].set()
+
+    def call(self, op, side, order_id=0, price=None, quantity=None, account=None, base_asset='', quote_asset='',
+             display_quantity=None):
+        waiter = [threading.Event(), None]
+        with self.lock:
+            self.seq += 1
+            seq = self.seq
+            data = REQUEST.pack(seq, op, SIDES.index(side), order_id, _text(price), _text(quantity),
+                                _text(display_quantity), _text(account), _text(base_asset), _text(quote_asset))
+            self.pending[seq] = waiter
+            while not self.requests.put(data):
+                time.sleep(0.0001)
+        if not waiter[0].wait(self.timeout):
+            self.pending.pop(seq, None)
+            raise TimeoutError('Matching engine did not answer in %.1fs' % self.timeout)
+        response = waiter[1]
+        status, message = response[1], _field(response[-1])
+        if status == STATUS_FULL:
+            raise RegistryFull(message)
+        if status == STATUS_NOT_FOUND:
+            raise KeyError(message)
+        if status == STATUS_ERROR:
+            raise RuntimeError(message)
+        return response
+
+    def process_order(self, quote):
+        '''Same result as OrderBook.process_order for a limit order quote.'''
+        for key in ('price', 'quantity', 'displayQuantity', 'account', 'baseAsset', 'quoteAsset'):
+            if len(_text(quote.get(key))) > (NUMBER_WIDTH if key in ('price', 'quantity', 'displayQuantity')
+                                             else TEXT_WIDTH):
+                return {"success": False, "message": "%s is too long" % key}
+        response = self.call(OP_REGISTER, quote['side'], 0, quote['price'], quote['quantity'],
+                             quote['account'], quote['baseAsset'], quote['quoteAsset'], quote.get('displayQuantity'))
+        if response[1] == STATUS_REJECTED:
+            return {"success": False, "message": _field(response[-1])}
+        _, _, task_id, flags, order_id, timestamp, quantity, traded_quantity = response[:8]
+        block_a = response[8:14]
+        block_b = response[14:20]
+        taker_side = quote['side']
+        maker_side = 'ask' if taker_side == 'bid' else 'bid'
+        trades = []
+        if flags & HAS_TRADE:
+            maker_order_id, trade_timestamp, price, new_book_quantity, _, maker_trade_id = block_a
+            trades.append({
+                'timestamp': trade_timestamp,
+                'price': _decimal(price),
+                'quantity': _decimal(traded_quantity),
+                'time': trade_timestamp,
+                'party1': [_optional(maker_trade_id), maker_side, maker_order_id, _decimal(new_book_quantity)],
+                'party2': [quote['trade_id'], taker_side, None, None]
+            })
+        quote['timestamp'] = timestamp
+        order = None
+        if flags & HAS_RESTING:
+            order = dict(quote, order_id=order_id, quantity=_decimal(quantity))
+        next_best_order = None
+        if flags & HAS_NEXT_BEST:
+            next_best_order = EngineOrder(block_b, maker_side, quote['baseAsset'], quote['quoteAsset'])
+        return {"success": True, "data": [trades, order, task_id, next_best_order], "stateRoot": response[-2]}
+
+    def cancel_order(self, base_asset, quote_asset, side, order_id):
+        '''Cancel a resting order; returns it as an EngineOrder and the book
+        time of the cancel. Raises KeyError(BOOK_NOT_FOUND) for an unknown
+        book and KeyError(order_id) for an unknown order, like the lookups
+        of the in-process path.'''
+        try:
+            response = self.call(OP_CANCEL, side, order_id, base_asset=base_asset, quote_asset=quote_asset)
+        except KeyError as e:
+            if e.args[0] == ORDER_NOT_FOUND:
+                raise KeyError(order_id)
+            raise
+        return EngineOrder(response[8:14], side, base_asset, quote_asset), response[5]
+
+    def best_order(self, base_asset, quote_asset, side):
+        '''Best order of side as an EngineOrder, or None. Raises
+        KeyError(BOOK_NOT_FOUND) for an unknown book.'''
+        response = self.call(OP_BEST, side, base_asset=base_asset, quote_asset=quote_asset)
+        if not response[3] & HAS_ORDER:
+            return None
+        return EngineOrder(response[8:14], side, base_asset, quote_asset)
+
+    def find_order(self, order_id):
+        '''The resting order with order_id in any book as an EngineOrder, or
+        None.'''
+        try:
+            response = self.call(OP_ORDER, 'bid', order_id)
+        except KeyError:
+            return None
+        return EngineOrder(response[8:14], 'ask' if response[3] & ASK_ORDER else 'bid',
+                           _field(response[18]), _field(response[19]))
+
+    def close(self):
+        self.running = False
+        self.reader.join(1.0)
+        self.segment.close()
+        self.lock_file.close()
+
+
+class PublishedBook(object):
+
+    def __init__(self, sequence, body):
+        self.sequence = sequence
+        self.body = body
+
+
+class PublishedBooks(object):
+    '''
+    API worker side of BookPublisher. get() reads a book's file when it was
+    replaced since the last read and returns it as a PublishedBook, whose
+    identity and sequence stand in for the OrderBook in ResponseCache.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.books = {}  # symbol : PublishedBook
+
+    def get(self, symbol):
+        '''Last published body of symbol, or None if the engine has no such
+        book.'''
+        try:
+            with open(os.path.join(self.directory, symbol + '.json'), 'rb') as f:
+                # A book is rewritten at most every BookPublisher.interval, well
+                # above the mtime resolution, so a new body has a new mtime even
+                # if it got the inode of the file it replaced
+                stat = os.fstat(f.fileno())
+                sequence = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+                book = self.books.get(symbol)
+                if book is None or book.sequence != sequence:
+                    book = PublishedBook(sequence, f.read())
+                    self.books[symbol] = book
+                return book
+        except FileNotFoundError:
+            self.books.pop(symbol, None)
+            return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the matching engine process')
+    parser.add_argument('--name', default=os.environ.get('ORDERBOOK_ENGINE', 'orderbook'),
+                        help='shared memory name prefix, given to the API as ORDERBOOK_ENGINE')
+    parser.add_argument('--channels', type=int, default=int(os.environ.get('ORDERBOOK_ENGINE_CHANNELS', '8')),
+                        help='number of API worker processes that can connect')
+    parser.add_argument('--slots', type=int, default=1024, help='slots per ring')
+    parser.add_argument('--publish-interval', type=float,
+                        default=float(os.environ.get('ORDERBOOK_ENGINE_PUBLISH_INTERVAL', '0.1')),
+                        help='seconds between writes of the /api/orderbook bodies of changed books')
+    args = parser.parse_args()
+
+    markets = [m for m in os.environ.get('ORDERBOOK_MARKETS', '').split(',') if m]
+    engine = Engine(args.name, args.channels, args.slots, markets,
+                    int(os.environ.get('ORDERBOOK_MAX_BOOKS', '1000')),
+                    float(os.environ.get('ORDERBOOK_IDLE_BOOK_SECONDS', '300')),
+                    parse_book_limits(os.environ.get('ORDERBOOK_BOOK_LIMITS', '')),
+                    BookPublisher(publish_directory(args.name), args.publish_interval,
+                                  float(os.environ.get('ORDERBOOK_RESPONSE_CACHE_MAX_AGE', '1'))))
+    signal.signal(signal.SIGTERM, engine.stop)
+    signal.signal(signal.SIGINT, engine.stop)
+    try:
+        engine.serve()
+    finally:
+        engine.close()
+
+
+if __name__ == '__main__':
+    main()
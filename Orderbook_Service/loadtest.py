@@ -0,0 +1,192 @@
+'''
+Load test for the Orderbook Service.
+
+Replays the call mix that Execution_Service/src/task.controller.js and
+routes.js send to this service:
+
+    register  POST /api/register_order (limitOrder)
+    cancel    POST /api/order then POST /api/cancel_order (handleCancelOrder)
+    best      POST /api/get_best_order (getBestOrder, Uniswap hook)
+    orderbook POST /api/orderbook (generateOrderBook, frontend polling)
+
+By default the FastAPI app in main.py is driven in-process through an ASGI
+transport, so no docker-compose stack, aggregator or attesters are needed.
+Pass --url to hit a running uvicorn instead.
+
+    python loadtest.py --concurrency 32 --duration 20
+    python loadtest.py --url http://127.0.0.1:8000 --mix register=5,cancel=1,best=10,orderbook=1
+
+Requires httpx.
+'''
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import httpx
+
+BASE_ASSET = "0x138d34d08bc9Ee1f4680f45eCFb8fc8e4b0ca018"
+QUOTE_ASSET = "0x8b2f38De30098bA09d69bd080A3814F4aE536A22"
+SYMBOL = "%s_%s" % (BASE_ASSET, QUOTE_ASSET)
+ACCOUNTS = ["0x%040x" % (i + 1) for i in range(50)]
+MID_PRICE = 2530.0
+
+DEFAULT_MIX = "register=10,cancel=2,best=10,orderbook=2"
+
+
+class EndpointStats(object):
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0  # transport failures and 5xx
+        self.rejected = 0  # 4xx, e.g. orders larger than the best order
+
+    def record(self, seconds, status):
+        self.latencies.append(seconds)
+        if status is None or status >= 500:
+            self.errors += 1
+        elif status >= 400:
+            self.rejected += 1
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+class LoadTest(object):
+    def __init__(self, client, mix, rng):
+        self.client = client
+        self.actions = list(mix.keys())
+        self.weights = list(mix.values())
+        self.rng = rng
+        self.stats = {}
+        self.resting_orders = []  # (orderId, side) of orders known to rest in the book
+
+    async def post(self, endpoint, payload):
+        stats = self.stats.setdefault(endpoint, EndpointStats())
+        started = time.perf_counter()
+        try:
+            response = await self.client.post(endpoint, data={"payload": json.dumps(payload)})
+        except httpx.HTTPError:
+            stats.record(time.perf_counter() - started, None)
+            return None
+        stats.record(time.perf_counter() - started, response.status_code)
+        if response.status_code != 200:
+            return None
+        return response.json()
+
+    async def register(self):
+        side = self.rng.choice(("bid", "ask"))
+        # Mostly passive orders around the mid, with some crossing the spread
+        offset = self.rng.uniform(-5.0, 25.0)
+        price = MID_PRICE - offset if side == "bid" else MID_PRICE + offset
+        data = await self.post("/api/register_order", {
+            "account": self.rng.choice(ACCOUNTS),
+            "price": round(price, 2),
+            "quantity": round(self.rng.uniform(0.001, 2.0), 5),
+            "side": side,
+            "baseAsset": BASE_ASSET,
+            "quoteAsset": QUOTE_ASSET,
+            "timestamp": int(time.time() * 1000)
+        })
+        if data is not None and data["order"]["isValid"]:
+            self.resting_orders.append((data["order"]["orderId"], side))
+
+    async def cancel(self):
+        if not self.resting_orders:
+            return await self.register()
+        index = self.rng.randrange(len(self.resting_orders))
+        self.resting_orders[index] = self.resting_orders[-1]
+        order_id, side = self.resting_orders.pop()
+        data = await self.post("/api/order", {"orderId": order_id})
+        if data is None or data["order"] is None:
+            return
+        await self.post("/api/cancel_order", {
+            "orderId": order_id,
+            "side": data["order"]["side"],
+            "baseAsset": data["order"]["baseAsset"],
+            "quoteAsset": data["order"]["quoteAsset"]
+        })
+
+    async def best(self):
+        await self.post("/api/get_best_order", {
+            "side": self.rng.choice(("bid", "ask")),
+            "baseAsset": BASE_ASSET,
+            "quoteAsset": QUOTE_ASSET
+        })
+
+    async def orderbook(self):
+        await self.post("/api/orderbook", {"symbol": SYMBOL})
+
+    async def worker(self, deadline):
+        while time.perf_counter() < deadline:
+            action = self.rng.choices(self.actions, self.weights)[0]
+            await getattr(self, action)()
+
+    async def run(self, concurrency, duration, seed_orders):
+        for _ in range(seed_orders):
+            await self.register()
+        self.stats.clear()
+        started = time.perf_counter()
+        deadline = started + duration
+        await asyncio.gather(*[self.worker(deadline) for _ in range(concurrency)])
+        return time.perf_counter() - started
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, weight = part.split("=")
+        name = name.strip()
+        if name not in ("register", "cancel", "best", "orderbook"):
+            raise argparse.ArgumentTypeError("unknown action %r" % name)
+        mix[name] = float(weight)
+    return mix
+
+
+def report(stats, elapsed):
+    print("%-26s %8s %9s %9s %9s %9s %7s %8s" % (
+        "endpoint", "requests", "req/s", "p50 ms", "p99 ms", "p999 ms", "errors", "rejected"))
+    total = 0
+    for endpoint in sorted(stats):
+        endpoint_stats = stats[endpoint]
+        latencies = sorted(endpoint_stats.latencies)
+        count = len(latencies)
+        total += count
+        print("%-26s %8d %9.1f %9.3f %9.3f %9.3f %6.2f%% %7.2f%%" % (
+            endpoint, count, count / elapsed,
+            percentile(latencies, 0.5) * 1e3,
+            percentile(latencies, 0.99) * 1e3,
+            percentile(latencies, 0.999) * 1e3,
+            100.0 * endpoint_stats.errors / count,
+            100.0 * endpoint_stats.rejected / count))
+    print("total: %d requests in %.1fs (%.1f req/s)" % (total, elapsed, total / elapsed))
+
+
+async def main(args):
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=30.0)
+    else:
+        from main import app
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app),
+                                   base_url="http://orderbook", timeout=30.0)
+    async with client:
+        test = LoadTest(client, args.mix, random.Random(args.seed))
+        elapsed = await test.run(args.concurrency, args.duration, args.seed_orders)
+    report(test.stats, elapsed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="base URL of a running service; in-process if omitted")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help="relative weights, default %s" % DEFAULT_MIX)
+    parser.add_argument("--seed-orders", type=int, default=200,
+                        help="orders registered before measuring starts")
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
@@ -1,16 +1,155 @@
 from orderbook import OrderBook
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request
+from fastapi.responses import JSONResponse, Response, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
+import io
 import json
 import uvicorn
 from decimal import Decimal
 import time
+import os
+import re
 from orderbook import OrderBook
+from orderbook.snapshot import write_snapshot, load_snapshot
+from orderbook.ordertree import OrderTree
+from orderbook.registry import SymbolRegistry, RegistryFull, make_symbol, split_symbol
+from orderbook.address import canonical_asset
+from orderbook.routing import RouteGraph
+from orderbook.amm import Pool, split_swap
+from orderbook.memory import book_usage, parse_book_limits, BookLimitPolicy
+from orderbook.audit import Auditor, AuditThread, audit_book
+from orderbook.bulk import BulkImport, chunks, read_ndjson, read_csv
+import metrics
+import profiler
+from persistence import TradeWriter
+from engine import EngineClient, EngineModeMiddleware, PublishedBooks, order_rejection, publish_directory
+from ratelimit import RateLimiter, AdmissionControl, AdmissionMiddleware, parse_limits
+from respcache import ResponseCache
+from replication import BookLocks, Replicator, ReplicaModeMiddleware
+from tracing import Tracer, TraceMiddleware
 
-order_books = {}  # Dictionary to store multiple order books, keyed by symbol
+# Markets created at startup and never evicted, comma separated base_quote symbols
+MARKETS = [m for m in os.environ.get("ORDERBOOK_MARKETS", "").split(",") if m]
+# Budget for the number of books; empty books idle for longer than
+# ORDERBOOK_IDLE_BOOK_SECONDS are evicted to make room for new markets
+MAX_BOOKS = int(os.environ.get("ORDERBOOK_MAX_BOOKS", "1000"))
+IDLE_BOOK_SECONDS = float(os.environ.get("ORDERBOOK_IDLE_BOOK_SECONDS", "300"))
+
+# Caps per book as "symbol=orders:levels:tape[:trades[:candles[:stops]]],...", with *
+# for the default and empty fields for no cap, e.g. "*=100000:5000:10000:1000000:10000:10000".
+# Orders are counted per side, pending stops per book; orders and stops that
+# would exceed a cap are rejected, the tape, trade history and candles (per
+# interval) are trimmed.
+BOOK_LIMITS = parse_book_limits(os.environ.get("ORDERBOOK_BOOK_LIMITS", ""))
+
+order_books = SymbolRegistry(MARKETS, MAX_BOOKS, IDLE_BOOK_SECONDS)  # Order books keyed by canonical symbol
+order_books.add_listener(BookLimitPolicy(BOOK_LIMITS))
+# Stands in for markets that do not exist yet, so reads of unknown symbols
+# never allocate a book
+EMPTY_ORDER_BOOK = OrderBook()
+# Prices swaps across books, including multi-hop paths through other assets
+route_graph = RouteGraph()
+order_books.add_listener(route_graph)
 app = FastAPI()
 
+# Directory holding one binary snapshot per order book. Books are loaded from
+# it on startup and written back on shutdown; unset disables snapshots.
+SNAPSHOT_DIR = os.environ.get("ORDERBOOK_SNAPSHOT_DIR")
+SNAPSHOT_SUFFIX = ".snap"
+# Symbols come straight from request payloads, only these are used as file names
+SNAPSHOT_SYMBOL_RE = re.compile(r"^[A-Za-z0-9]+_[A-Za-z0-9]+$")
+
+# SQLite database receiving trades and order lifecycle events; unset disables it
+DB_PATH = os.environ.get("ORDERBOOK_DB_PATH")
+trade_writer = None
+
+# Number of trades or candles returned by /api/trades and /api/candles
+DEFAULT_HISTORY_LIMIT = 1000
+MAX_HISTORY_LIMIT = 10000
+
+MAX_ROUTE_HOPS = 4
+
+# Orders per page of /api/orderbook_page
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Token-bucket limits as "endpoint=rate:burst,...", e.g.
+# "register_order=20:40,orderbook=10:20". register_order is keyed by account,
+# the other endpoints by client address. Unset disables rate limiting.
+RATE_LIMITS = parse_limits(os.environ.get("ORDERBOOK_RATE_LIMITS", ""))
+RATE_LIMIT_IDLE_SECONDS = float(os.environ.get("ORDERBOOK_RATE_LIMIT_IDLE_SECONDS", "300"))
+rate_limiter = RateLimiter(RATE_LIMITS, RATE_LIMIT_IDLE_SECONDS)
+# Requests in flight before load is shed with 429s, 0 disables it. The last
+# ORDERBOOK_RESERVED_IN_FLIGHT slots are only used by latency critical endpoints.
+MAX_IN_FLIGHT = int(os.environ.get("ORDERBOOK_MAX_IN_FLIGHT", "0"))
+RESERVED_IN_FLIGHT = int(os.environ.get("ORDERBOOK_RESERVED_IN_FLIGHT", "8"))
+CRITICAL_PATHS = ("/api/get_best_order",)
+admission = AdmissionControl(MAX_IN_FLIGHT, RESERVED_IN_FLIGHT, CRITICAL_PATHS) if MAX_IN_FLIGHT > 0 else None
+
+# /api/orderbook bodies are cached per book change and compressed once in a
+# background thread (gzip, plus brotli/zstd if installed), then served by
+# Accept-Encoding. Bodies are rebuilt after ORDERBOOK_RESPONSE_CACHE_MAX_AGE
+# seconds even if the book did not change, as they carry the rolling stats.
+RESPONSE_CACHE_MAX_AGE = float(os.environ.get("ORDERBOOK_RESPONSE_CACHE_MAX_AGE", "1"))
+COMPRESS_MIN_BYTES = int(os.environ.get("ORDERBOOK_COMPRESS_MIN_BYTES", "1024"))
+response_cache = ResponseCache(max_entries=MAX_BOOKS, max_age=RESPONSE_CACHE_MAX_AGE,
+                               min_size=COMPRESS_MIN_BYTES)
+
+# Shared memory name of a matching engine started with engine.py. When set,
+# orders are matched in that process and the books are not kept here, so only
+# the order path (register, cancel, best order), order lookups and
+# /api/orderbook (from the bodies the engine publishes) are served.
+ENGINE_NAME = os.environ.get("ORDERBOOK_ENGINE")
+ENGINE_CHANNELS = int(os.environ.get("ORDERBOOK_ENGINE_CHANNELS", "8"))
+ENGINE_LOCAL_PATHS = ("/api/orderbook_page", "/api/trades", "/api/candles",
+                      "/api/route", "/api/split_route", "/api/check_available_funds", "/api/amend_order",
+                      "/api/cancel_replace_order", "/api/register_stop_order", "/api/cancel_stop_order",
+                      "/api/snapshot", "/api/admin/memory", "/api/admin/audit",
+                      "/api/state_root", "/api/import_orders")
+engine_client = None
+published_books = PublishedBooks(publish_directory(ENGINE_NAME)) if ENGINE_NAME else None
+
+# Warm-standby replication: "primary" streams every book command to the
+# followers connecting to ORDERBOOK_REPLICATION_LISTEN ("host:port" or
+# "unix:/path"); "follower" replays the stream from ORDERBOOK_REPLICATION_PRIMARY,
+# serves reads and refuses writes until promoted. Unset disables replication.
+REPLICATION_ROLE = os.environ.get("ORDERBOOK_REPLICATION_ROLE")
+REPLICATION_LISTEN = os.environ.get("ORDERBOOK_REPLICATION_LISTEN")
+REPLICATION_PRIMARY = os.environ.get("ORDERBOOK_REPLICATION_PRIMARY")
+# Commands kept for followers that reconnect; their memory is reported per
+# book in /api/admin/memory
+REPLICATION_BACKLOG = int(os.environ.get("ORDERBOOK_REPLICATION_BACKLOG", "100000"))
+WRITE_PATHS = ("/api/register_order", "/api/cancel_order", "/api/amend_order", "/api/cancel_replace_order",
+               "/api/register_stop_order", "/api/cancel_stop_order", "/api/import_orders")
+if REPLICATION_ROLE and ENGINE_NAME:
+    raise ValueError("Replication needs the books in this process, it cannot be used with ORDERBOOK_ENGINE")
+replication = (Replicator(order_books, REPLICATION_ROLE, REPLICATION_LISTEN, REPLICATION_PRIMARY, REPLICATION_BACKLOG)
+               if REPLICATION_ROLE else None)
+# Commands on one book run one at a time under its lock, the replicator's when
+# replicating
+book_lock = replication.book_lock if replication is not None else BookLocks()
+
+# Background check of the book counters (volume, num_orders, depth, length)
+# against the linked orders: every ORDERBOOK_AUDIT_INTERVAL seconds the next
+# levels are audited for at most ORDERBOOK_AUDIT_BUDGET_US microseconds.
+# An interval of 0 disables it. Books are read under book_lock.
+AUDIT_INTERVAL = float(os.environ.get("ORDERBOOK_AUDIT_INTERVAL", "1"))
+AUDIT_BUDGET = float(os.environ.get("ORDERBOOK_AUDIT_BUDGET_US", "500")) / 1e6
+auditor = Auditor(AUDIT_BUDGET, lock=book_lock)
+audit_thread = None
+
+# W3C trace context: requests carrying a sampled traceparent, and new traces
+# at ORDERBOOK_TRACE_SAMPLE_RATE, get a server span with parse/match/serialize
+# children, exported in batches as OTLP JSON to ORDERBOOK_TRACE_EXPORT, either
+# "file:/path" (one batch per line) or an OTLP/HTTP collector URL such as
+# "http://127.0.0.1:4318/v1/traces". Unset disables tracing.
+TRACE_EXPORT = os.environ.get("ORDERBOOK_TRACE_EXPORT")
+TRACE_SAMPLE_RATE = float(os.environ.get("ORDERBOOK_TRACE_SAMPLE_RATE", "0.01"))
+tracer = Tracer(TRACE_EXPORT, TRACE_SAMPLE_RATE) if TRACE_EXPORT else None
+
+# Envelope around the pre-encoded order kept in OrderBook.top_of_book
+BEST_ORDER_PREFIX = b'{"message":"Best order retrieved successfully","order":'
+
 # Add CORS middleware configuration
 app.add_middleware(
     CORSMiddleware,
@@ -20,16 +159,276 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+class StageClockMiddleware:
+    '''Stamps each request with its arrival time while stage timers are on,
+    so the parse stage also covers reading and decoding the form body.'''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and metrics.stage_timers_enabled:
+            scope.setdefault("state", {})["received_at"] = time.perf_counter()
+        await self.app(scope, receive, send)
+
+app.add_middleware(StageClockMiddleware)
+if ENGINE_NAME:
+    app.add_middleware(EngineModeMiddleware, local_paths=ENGINE_LOCAL_PATHS)
+if replication is not None:
+    app.add_middleware(ReplicaModeMiddleware, replicator=replication, write_paths=WRITE_PATHS)
+if tracer is not None:
+    app.add_middleware(TraceMiddleware, tracer=tracer)
+if admission is not None:
+    # Added last so it runs first and sheds requests before any other work
+    app.add_middleware(AdmissionMiddleware, admission=admission)
+
+def set_stage_timers(enabled):
+    metrics.set_stage_timers(enabled)
+    OrderTree.stage_timer = metrics.histogram("stage.book_update").observe if enabled else None
+
+set_stage_timers(metrics.stage_timers_enabled)
+
+def save_snapshots():
+    saved = {}
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    for symbol, order_book in order_books.items():
+        if not SNAPSHOT_SYMBOL_RE.match(symbol):
+            continue
+        path = os.path.join(SNAPSHOT_DIR, symbol + SNAPSHOT_SUFFIX)
+        saved[symbol] = write_snapshot(order_book, path, symbol)
+    return saved
+
+@app.on_event("startup")
+def load_snapshots():
+    if not SNAPSHOT_DIR or not os.path.isdir(SNAPSHOT_DIR):
+        return
+    for filename in sorted(os.listdir(SNAPSHOT_DIR)):
+        if not filename.endswith(SNAPSHOT_SUFFIX):
+            continue
+        symbol, order_book = load_snapshot(os.path.join(SNAPSHOT_DIR, filename))
+        order_books.add(symbol, order_book)
+
+@app.on_event("shutdown")
+def shutdown_snapshots():
+    if SNAPSHOT_DIR:
+        save_snapshots()
+
+@app.on_event("startup")
+def start_trade_writer():
+    global trade_writer
+    if DB_PATH:
+        trade_writer = TradeWriter(DB_PATH)
+        trade_writer.start()
+
+@app.on_event("shutdown")
+def stop_trade_writer():
+    if trade_writer is not None:
+        trade_writer.stop()
+
+@app.on_event("startup")
+def connect_engine():
+    global engine_client
+    if ENGINE_NAME:
+        engine_client = EngineClient(ENGINE_NAME, ENGINE_CHANNELS)
+
+@app.on_event("shutdown")
+def disconnect_engine():
+    if engine_client is not None:
+        engine_client.close()
+
+@app.on_event("startup")
+def start_replication():
+    if replication is not None:
+        replication.start()
+
+@app.on_event("shutdown")
+def stop_replication():
+    if replication is not None:
+        replication.stop()
+
+@app.on_event("startup")
+def start_response_cache():
+    response_cache.start()
+
+@app.on_event("shutdown")
+def stop_response_cache():
+    response_cache.stop()
+
+@app.on_event("startup")
+def start_tracer():
+    if tracer is not None:
+        tracer.start()
+
+@app.on_event("shutdown")
+def stop_tracer():
+    if tracer is not None:
+        tracer.stop()
+
+@app.on_event("startup")
+def start_auditor():
+    global audit_thread
+    if AUDIT_INTERVAL > 0 and not ENGINE_NAME:
+        audit_thread = AuditThread(auditor, order_books.items, AUDIT_INTERVAL,
+                                   metrics.histogram("audit.tick").observe)
+        audit_thread.start()
+
+@app.on_event("shutdown")
+def stop_auditor():
+    if audit_thread is not None:
+        audit_thread.stop()
+
+def replicated(symbol, op, args):
+    # Runs the book command in the with block under the book's lock and logs
+    # it for followers
+    if replication is None:
+        return book_lock(symbol)
+    return replication.command(symbol, op, args)
+
+def replicated_import(symbol, bulk, replace):
+    # Logs the orders of bulk for followers in chunks, then the load run in
+    # the with block, under the book's lock
+    if replication is None:
+        return book_lock(symbol)
+    return replication.bulk_import(symbol, bulk, replace)
+
+def replication_log_bytes(symbol):
+    # Memory held by the replication log for one book, see book_usage
+    return replication.log.bytes(symbol) if replication is not None else 0
+
+def rate_limited(endpoint, key):
+    # 429 response if key is over its limit for endpoint, otherwise None
+    retry_after = rate_limiter.acquire(endpoint, key)
+    if not retry_after:
+        return None
+    return JSONResponse(content={
+        "message": "Rate limit exceeded",
+        "status_code": 0
+    }, status_code=429, headers={"Retry-After": str(max(1, int(retry_after + 0.999)))})
+
+def client_key(request):
+    return request.client.host if request.client is not None else ""
+
+def get_book_for_read(symbol):
+    # Unknown markets read as the shared empty book instead of allocating one
+    assets = split_symbol(symbol)
+    if assets is None:
+        raise ValueError("Invalid symbol")
+    symbol = "%s_%s" % assets
+    order_book = order_books.get(symbol)
+    return symbol, order_book if order_book is not None else EMPTY_ORDER_BOOK
+
+def book_order_dict(order, is_valid):
+    # Serializable form of an Order object from the book
+    return {
+        'orderId': int(order.order_id),
+        'account': order.account,
+        'price': float(order.price),
+        'quantity': float(order.quantity),
+        'side': order.side,
+        'baseAsset': order.baseAsset,
+        'quoteAsset': order.quoteAsset,
+        'trade_id': order.trade_id,
+        'trades': [],
+        'isValid': is_valid,
+        'timestamp': order.timestamp
+    }
+
+def serialize_trades(trades):
+    # Left as before, likely largely redundant
+    converted_trades = []
+    for trade in trades:
+        # [trade_id, side, head_order.order_id, new_book_quantity]
+        party1 = [
+            trade['party1'][0],
+            trade['party1'][1],
+            int(trade['party1'][2]) if trade['party1'][2] is not None else None,
+            float(trade['party1'][3]) if trade['party1'][3] is not None else None
+        ]
+        party2 = [
+            trade['party2'][0],
+            trade['party2'][1],
+            int(trade['party2'][2]) if trade['party2'][2] is not None else None,
+            float(trade['party2'][3]) if trade['party2'][3] is not None else None
+        ]
+
+        converted_trade = {
+            'timestamp': int(trade['timestamp']),
+            'price': float(trade['price']),
+            'quantity': float(trade['quantity']),
+            'time': int(trade['time']),
+            'party1': party1,
+            'party2': party2,
+        }
+        converted_trades.append(converted_trade)
+    return converted_trades
+
+def serialize_triggered(triggered):
+    # Stops released by an order, see OrderBook.release_stops
+    return [{
+        'orderId': int(result['order_id']),
+        'type': result['type'],
+        'side': result['quote']['side'],
+        'success': result['success'],
+        'message': result.get('message'),
+        'trades': serialize_trades(result['trades']),
+        'taskId': result['task_id'],
+        'isValid': result['order'] is not None,
+        'quantity': float(result['order']['quantity']) if result['order'] is not None else 0
+    } for result in triggered]
+
+def serialize_order_result(trades, order, next_best_order):
+    # order is the quote dict returned by process_order, next_best_order an
+    # Order object or None
+    converted_trades = serialize_trades(trades)
+
+    # Convert order to a serializable format
+    # This should be the same info as _order
+    order_dict = {
+        'orderId': int(order['order_id']),
+        'account': order['account'],
+        'price': float(order['price']),
+        'quantity': float(order['quantity']),
+        'side': order['side'],
+        'baseAsset': order['baseAsset'],
+        'quoteAsset': order['quoteAsset'],
+        'trade_id': order['trade_id'],
+        'trades': converted_trades,
+        'isValid': True if order['order_id'] != 0 else False,
+        'timestamp': order['timestamp']
+    }
+
+    next_best_order_dict = None
+    if next_best_order is not None:
+        next_best_order_dict = book_order_dict(next_best_order, next_best_order.order_id != 0)
+    return order_dict, next_best_order_dict
+
+def submit_triggered(symbol, triggered):
+    # Persist the trades and resulting orders of released stops
+    for result in triggered:
+        trade_writer.submit_trades(symbol, result['trades'])
+        order = result['order']
+        if order is not None:
+            trade_writer.submit_order_event(symbol, "placed", order['timestamp'], order['order_id'],
+                                            order['account'], order['side'], order['price'], order['quantity'])
+
 @app.post("/api/register_order")
-def register_order(payload: str = Form(...)):
+def register_order(request: Request, payload: str = Form(...)):
+    stage_started = metrics.stage_clock()
+    if stage_started is not None:
+        stage_started = getattr(request.state, "received_at", stage_started)
+    trace = getattr(request.state, "trace", None)
     try:
         payload_json = json.loads(payload)
-        symbol = "%s_%s" % (payload_json["baseAsset"], payload_json["quoteAsset"])
+        stage_started = metrics.observe_stage("parse", stage_started)
+        if trace is not None:
+            trace.stage("parse")
+        limited = rate_limited("register_order", payload_json['account'])
+        if limited is not None:
+            return limited
+        base_asset = canonical_asset(payload_json["baseAsset"])
+        quote_asset = canonical_asset(payload_json["quoteAsset"])
 
-        if symbol not in order_books:
-            order_books[symbol] = OrderBook()
-
-        order_book = order_books[symbol]
+        symbol = make_symbol(base_asset, quote_asset)
 
         _order = {
             'type' : 'limit',
@@ -38,11 +437,35 @@ def register_order(payload: str = Form(...)):
             'price' : Decimal(payload_json['price']),
             'quantity' : Decimal(payload_json['quantity']),
             'side' : payload_json['side'],
-            'baseAsset' : payload_json['baseAsset'],
-            'quoteAsset' : payload_json['quoteAsset']
+            'baseAsset' : base_asset,
+            'quoteAsset' : quote_asset
         }
+        if payload_json.get('displayQuantity') is not None:
+            # Iceberg order, only this much of it is shown at a time
+            _order['displayQuantity'] = Decimal(payload_json['displayQuantity'])
+        rejection = order_rejection(_order['side'], _order['price'], _order['quantity'])
+        if rejection is not None:
+            # process_order would exit the process (or the engine) on these
+            return JSONResponse(content={
+                "message": rejection,
+                "status_code": 0
+            }, status_code=400)
 
-        process_result = order_book.process_order(_order, False, False)
+        try:
+            if engine_client is not None:
+                process_result = engine_client.process_order(_order)
+            else:
+                with replicated(symbol, "order", _order):
+                    order_book = order_books.get_or_create(symbol)
+                    process_result = order_book.process_order(_order, False, False)
+        except RegistryFull as e:
+            return JSONResponse(content={
+                "message": str(e),
+                "status_code": 0
+            }, status_code=503)
+        stage_started = metrics.observe_stage("match", stage_started)
+        if trace is not None:
+            trace.stage("match", symbol=symbol, side=_order['side'], success=process_result["success"])
         # Determine task id
         # Task 1: Order does not cross spread and is not best price
             # trades should be empty if we did not cross the spread
@@ -60,13 +483,22 @@ def register_order(payload: str = Form(...)):
         # This is the Failure case
         if not process_result["success"]:
             return JSONResponse(content={
-                "message": process_result["data"],
+                "message": process_result["message"],
                 "status_code": 0
             }, status_code=400)
 
         trades, order, task_id, next_best_order = process_result["data"]
+        triggered = process_result.get("triggered", [])
+        state_root = process_result["stateRoot"] if engine_client is not None else order_book.commitment.root()
         # Note: task_id only set for partial and complete order fills
 
+        if trade_writer is not None:
+            trade_writer.submit_trades(symbol, trades)
+            if order is not None:
+                trade_writer.submit_order_event(symbol, "placed", order['timestamp'], order['order_id'],
+                                                order['account'], order['side'], order['price'], order['quantity'])
+            submit_triggered(symbol, triggered)
+
         if order is None:
             # fill the partial order, so this order is not in the book
             # then we copy the original info to this order
@@ -76,102 +508,53 @@ def register_order(payload: str = Form(...)):
 
         assert order is not None
 
-        # Left as before, likely largely redundant
-        converted_trades = []
-        for trade in trades:
-            # [trade_id, side, head_order.order_id, new_book_quantity]
-            party1 = [
-                trade['party1'][0],
-                trade['party1'][1],
-                int(trade['party1'][2]) if trade['party1'][2] is not None else None,
-                float(trade['party1'][3]) if trade['party1'][3] is not None else None
-            ]
-            party2 = [
-                trade['party2'][0],
-                trade['party2'][1],
-                int(trade['party2'][2]) if trade['party2'][2] is not None else None,
-                float(trade['party2'][3]) if trade['party2'][3] is not None else None
-            ]
-
-            converted_trade = {
-                'timestamp': int(trade['timestamp']),
-                'price': float(trade['price']),
-                'quantity': float(trade['quantity']),
-                'time': int(trade['time']),
-                'party1': party1,
-                'party2': party2,
-            }
-            converted_trades.append(converted_trade)
-
-        # Convert order to a serializable format
-        # This should be the same info as _order
-        order_dict = {
-            'orderId': int(order['order_id']),
-            'account': order['account'],
-            'price': float(order['price']),
-            'quantity': float(order['quantity']),
-            'side': order['side'],
-            'baseAsset': order['baseAsset'],
-            'quoteAsset': order['quoteAsset'],
-            'trade_id': order['trade_id'],
-            'trades': converted_trades,
-            'isValid': True if order['order_id'] != 0 else False,
-            'timestamp': order['timestamp']
-        }
-
-        next_best_order_dict = None
-        if next_best_order is not None:
-
-            next_best_order_dict = {
-                'orderId': int(next_best_order.order_id),
-                'account': next_best_order.account,
-                'price': float(next_best_order.price),
-                'quantity': float(next_best_order.quantity),
-                'side': next_best_order.side,
-                'baseAsset': next_best_order.baseAsset,
-                'quoteAsset': next_best_order.quoteAsset,
-                'trade_id': next_best_order.trade_id,
-                'trades': [],
-                'isValid': True if next_best_order.order_id != 0 else False,
-                'timestamp': next_best_order.timestamp
-            }
+        order_dict, next_best_order_dict = serialize_order_result(trades, order, next_best_order)
 
-        return JSONResponse(content={
+        response = JSONResponse(content={
             "message": "Order registered successfully",
             "order": order_dict,
             "nextBest": next_best_order_dict,
             "taskId": task_id,
+            "triggeredStops": serialize_triggered(triggered),
+            "stateRoot": state_root.hex(),
             "status_code": 1
         }, status_code=200)
+        metrics.observe_stage("serialize", stage_started)
+        if trace is not None:
+            trace.stage("serialize", trades=len(trades))
+        return response
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/cancel_order")
-def cancel_order(payload: str = Form(...)):
+def cancel_order(request: Request, payload: str = Form(...)):
+    limited = rate_limited("cancel_order", client_key(request))
+    if limited is not None:
+        return limited
     try:
         payload_json = json.loads(payload)
         order_id = payload_json['orderId']
         side = payload_json['side']
-        symbol = "%s_%s" % (payload_json["baseAsset"], payload_json["quoteAsset"])
-
-        order_book = order_books[symbol]
-        order = order_book.bids.get_order(order_id) if order_id in order_book.bids.order_map else order_book.asks.get_order(order_id)
-        order_book.cancel_order(side, order_id)
+        if engine_client is not None:
+            order, cancelled_at = engine_client.cancel_order(canonical_asset(payload_json["baseAsset"]),
+                                                             canonical_asset(payload_json["quoteAsset"]),
+                                                             side, order_id)
+        else:
+            symbol = make_symbol(payload_json["baseAsset"], payload_json["quoteAsset"])
+            order_book = order_books.get(symbol)
+            if order_book is None:
+                raise KeyError("Order book not found")
+            order = order_book.bids.get_order(order_id) if order_id in order_book.bids.order_map else order_book.asks.get_order(order_id)
+            with replicated(symbol, "cancel", {"side": side, "orderId": order_id}):
+                order_book.cancel_order(side, order_id)
+            cancelled_at = order_book.time
+        if trade_writer is not None:
+            trade_writer.submit_order_event(make_symbol(payload_json["baseAsset"], payload_json["quoteAsset"]),
+                                            "cancelled", cancelled_at, order_id, order.account,
+                                            order.side, order.price, order.quantity)
 
         # Convert order to a serializable format
-        order_dict = {
-            'orderId': int(order_id),
-            'account': order.account,
-            'price': float(order.price),
-            'quantity': float(order.quantity),
-            'side': order.side,
-            'baseAsset': order.baseAsset,
-            'quoteAsset': order.quoteAsset,
-            'trade_id': order.trade_id,
-            'trades': [],
-            'isValid': False,
-            'timestamp': order.timestamp
-        }
+        order_dict = book_order_dict(order, False)
 
         return JSONResponse(content={
             "message": "Order cancelled successfully",
@@ -181,6 +564,205 @@ def cancel_order(payload: str = Form(...)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/amend_order")
+def amend_order(request: Request, payload: str = Form(...)):
+    limited = rate_limited("amend_order", client_key(request))
+    if limited is not None:
+        return limited
+    try:
+        payload_json = json.loads(payload)
+        symbol = make_symbol(payload_json["baseAsset"], payload_json["quoteAsset"])
+        order_book = order_books.get(symbol)
+        if order_book is None:
+            raise KeyError("Order book not found")
+
+        with replicated(symbol, "amend", {"side": payload_json['side'], "orderId": payload_json['orderId'],
+                                          "quantity": payload_json.get('quantity'),
+                                          "price": payload_json.get('price')}):
+            amend_result = order_book.amend_order(payload_json['side'], payload_json['orderId'],
+                                                  payload_json.get('quantity'), payload_json.get('price'))
+        if not amend_result["success"]:
+            return JSONResponse(content={
+                "message": amend_result["message"],
+                "status_code": 0
+            }, status_code=400)
+
+        order = amend_result["data"]
+        if trade_writer is not None:
+            trade_writer.submit_order_event(symbol, "amended", order_book.time, order.order_id, order.account,
+                                            order.side, order.price, order.quantity)
+
+        return JSONResponse(content={
+            "message": "Order amended successfully",
+            "order": book_order_dict(order, True),
+            "status_code": 1
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/cancel_replace_order")
+def cancel_replace_order(payload: str = Form(...)):
+    try:
+        payload_json = json.loads(payload)
+        limited = rate_limited("cancel_replace_order", payload_json['account'])
+        if limited is not None:
+            return limited
+        base_asset = canonical_asset(payload_json["baseAsset"])
+        quote_asset = canonical_asset(payload_json["quoteAsset"])
+        symbol = make_symbol(base_asset, quote_asset)
+        order_book = order_books.get(symbol)
+        if order_book is None:
+            raise KeyError("Order book not found")
+
+        _order = {
+            'type' : 'limit',
+            'trade_id' : payload_json['account'],
+            'account': payload_json['account'],
+            'price' : Decimal(payload_json['price']),
+            'quantity' : Decimal(payload_json['quantity']),
+            'side' : payload_json.get('newSide', payload_json['side']),
+            'baseAsset' : base_asset,
+            'quoteAsset' : quote_asset
+        }
+        if payload_json.get('displayQuantity') is not None:
+            # Iceberg order, only this much of it is shown at a time
+            _order['displayQuantity'] = Decimal(payload_json['displayQuantity'])
+
+        # Same task ids and failure cases as register_order; on failure the
+        # original order is still in the book, in its original place
+        with replicated(symbol, "cancel_replace", {"side": payload_json['side'], "orderId": payload_json['orderId'],
+                                                   "quote": _order}):
+            process_result = order_book.cancel_replace(payload_json['side'], payload_json['orderId'], _order)
+        if not process_result["success"]:
+            return JSONResponse(content={
+                "message": process_result["message"],
+                "status_code": 0
+            }, status_code=400)
+
+        trades, order, task_id, next_best_order = process_result["data"]
+        cancelled = process_result["cancelled"]
+
+        if trade_writer is not None:
+            trade_writer.submit_order_event(symbol, "cancelled", order_book.time, cancelled.order_id,
+                                            cancelled.account, cancelled.side, cancelled.price, cancelled.quantity)
+            trade_writer.submit_trades(symbol, trades)
+            if order is not None:
+                trade_writer.submit_order_event(symbol, "placed", order['timestamp'], order['order_id'],
+                                                order['account'], order['side'], order['price'], order['quantity'])
+            submit_triggered(symbol, process_result["triggered"])
+
+        if order is None:
+            # filled on arrival, see register_order
+            order = _order.copy()
+            order['order_id'] = 0
+
+        order_dict, next_best_order_dict = serialize_order_result(trades, order, next_best_order)
+
+        return JSONResponse(content={
+            "message": "Order replaced successfully",
+            "cancelled": book_order_dict(cancelled, False),
+            "order": order_dict,
+            "nextBest": next_best_order_dict,
+            "taskId": task_id,
+            "triggeredStops": serialize_triggered(process_result["triggered"]),
+            "status_code": 1
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+def stop_order_dict(quote):
+    return {
+        'orderId': int(quote['order_id']),
+        'type': quote['type'],
+        'account': quote['account'],
+        'side': quote['side'],
+        'quantity': float(quote['quantity']),
+        'stopPrice': float(quote['stopPrice']),
+        'price': float(quote['price']) if quote['type'] == 'stop_limit' else None,
+        'baseAsset': quote['baseAsset'],
+        'quoteAsset': quote['quoteAsset'],
+        'timestamp': quote['timestamp']
+    }
+
+@app.post("/api/register_stop_order")
+def register_stop_order(payload: str = Form(...)):
+    try:
+        payload_json = json.loads(payload)
+        limited = rate_limited("register_order", payload_json['account'])
+        if limited is not None:
+            return limited
+        base_asset = canonical_asset(payload_json["baseAsset"])
+        quote_asset = canonical_asset(payload_json["quoteAsset"])
+        symbol = make_symbol(base_asset, quote_asset)
+
+        # With a limit price the stop becomes a limit order at that price when
+        # triggered, otherwise one at the best opposite price
+        _order = {
+            'type': 'stop_limit' if payload_json.get('price') is not None else 'stop',
+            'trade_id': payload_json['account'],
+            'account': payload_json['account'],
+            'stopPrice': Decimal(payload_json['stopPrice']),
+            'quantity': Decimal(payload_json['quantity']),
+            'side': payload_json['side'],
+            'baseAsset': base_asset,
+            'quoteAsset': quote_asset
+        }
+        if _order['type'] == 'stop_limit':
+            _order['price'] = Decimal(payload_json['price'])
+
+        try:
+            with replicated(symbol, "order", _order):
+                order_book = order_books.get_or_create(symbol)
+                process_result = order_book.process_order(_order, False, False)
+        except RegistryFull as e:
+            return JSONResponse(content={
+                "message": str(e),
+                "status_code": 0
+            }, status_code=503)
+
+        if not process_result["success"]:
+            return JSONResponse(content={
+                "message": process_result["message"],
+                "status_code": 0
+            }, status_code=400)
+
+        if trade_writer is not None:
+            trade_writer.submit_order_event(symbol, "stop_placed", _order['timestamp'], _order['order_id'],
+                                            _order['account'], _order['side'], _order['stopPrice'],
+                                            _order['quantity'])
+
+        return JSONResponse(content={
+            "message": "Stop order registered successfully",
+            "order": stop_order_dict(_order),
+            "status_code": 1
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/cancel_stop_order")
+def cancel_stop_order(payload: str = Form(...)):
+    try:
+        payload_json = json.loads(payload)
+        symbol = make_symbol(payload_json["baseAsset"], payload_json["quoteAsset"])
+        order_book = order_books.get(symbol)
+        if order_book is None:
+            raise KeyError("Order book not found")
+        with replicated(symbol, "cancel_stop", {"orderId": payload_json['orderId']}):
+            quote = order_book.cancel_stop(payload_json['orderId'])
+        if quote is None:
+            raise KeyError("Stop order not found")
+        if trade_writer is not None:
+            trade_writer.submit_order_event(symbol, "stop_cancelled", order_book.time, quote['order_id'],
+                                            quote['account'], quote['side'], quote['stopPrice'], quote['quantity'])
+
+        return JSONResponse(content={
+            "message": "Stop order cancelled successfully",
+            "order": stop_order_dict(quote),
+            "status_code": 1
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/api/order")
 def get_order(payload: str = Form(...)):
     try:
@@ -188,9 +770,14 @@ def get_order(payload: str = Form(...)):
         order_id = payload_json['orderId']
 
         order = None
-        for symbol, order_book in order_books.items():
-            if order_id in order_book.bids.order_map or order_id in order_book.asks.order_map:
-                order = order_book.bids.get_order(order_id) if order_id in order_book.bids.order_map else order_book.asks.get_order(order_id)
+        if engine_client is not None:
+            # Book order ids are ints, other ids are not found like below
+            if type(order_id) is int:
+                order = engine_client.find_order(order_id)
+        else:
+            for symbol, order_book in order_books.items():
+                if order_id in order_book.bids.order_map or order_id in order_book.asks.order_map:
+                    order = order_book.bids.get_order(order_id) if order_id in order_book.bids.order_map else order_book.asks.get_order(order_id)
 
         if order is not None:
             order_dict = {
@@ -222,40 +809,266 @@ def get_order(payload: str = Form(...)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/orderbook")
-def get_orderbook(payload: str = Form(...)):
+def get_orderbook(request: Request, payload: str = Form(...)):
+    limited = rate_limited("orderbook", client_key(request))
+    if limited is not None:
+        return limited
     try:
         payload_json = json.loads(payload)
-        symbol = payload_json['symbol']
+        symbol, order_book = get_book_for_read(payload_json['symbol'])
+        if published_books is not None:
+            order_book = published_books.get(symbol) or EMPTY_ORDER_BOOK
 
-        if symbol not in order_books:
-            order_book = OrderBook()
-            order_books[symbol] = order_book
-        else:
-            order_book = order_books[symbol]
+        if order_book is EMPTY_ORDER_BOOK:
+            # Not cached, so polling made up symbols cannot evict real books
+            return JSONResponse(content={
+                "message": "Order book retrieved successfully",
+                "orderbook": order_book.get_orderbook(symbol),
+                "status_code": 1
+            })
+        key = (symbol, "orderbook")
+        entry = response_cache.get(key, order_book)
+        if entry is None:
+            sequence = order_book.sequence
+            if published_books is not None:
+                body = order_book.body
+            else:
+                body = JSONResponse(content={
+                    "message": "Order book retrieved successfully",
+                    "orderbook": order_book.get_orderbook(symbol),
+                    "status_code": 1
+                }).body
+            entry = response_cache.put(key, order_book, sequence, body)
+        encoding, body = response_cache.select(entry, request.headers.get("accept-encoding"))
+        headers = {"Vary": "Accept-Encoding"}
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(content=body, media_type="application/json", headers=headers)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/orderbook_page")
+def get_orderbook_page(payload: str = Form(...)):
+    try:
+        payload_json = json.loads(payload)
+        symbol, order_book = get_book_for_read(payload_json['symbol'])
+        limit = min(int(payload_json.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        if limit <= 0:
+            raise ValueError("limit must be positive")
+
+        orders, next_cursor = order_book.get_orders_page(payload_json['side'], payload_json.get('cursor'),
+                                                         payload_json.get('price'), limit)
+
+        return JSONResponse(content={
+            "message": "Order book page retrieved successfully",
+            "symbol": symbol,
+            "side": payload_json['side'],
+            "orders": orders,
+            "nextCursor": next_cursor,
+            "status_code": 1
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/state_root")
+def get_state_root(payload: str = Form(...)):
+    # Merkle root over the resting orders of a book, with an inclusion proof
+    # when an order is given (see orderbook/commitment.py)
+    try:
+        payload_json = json.loads(payload)
+        symbol, order_book = get_book_for_read(payload_json['symbol'])
+        proof = None
+        if payload_json.get('orderId') is not None:
+            proof = order_book.commitment.proof(payload_json['side'], int(payload_json['orderId']))
+            if proof is None:
+                return JSONResponse(content={
+                    "message": "Order not found",
+                    "status_code": 0
+                }, status_code=404)
+
+        return JSONResponse(content={
+            "message": "State root retrieved successfully",
+            "symbol": symbol,
+            "stateRoot": proof["root"] if proof is not None else order_book.commitment.root().hex(),
+            "sequence": order_book.sequence,
+            "orders": len(order_book.commitment),
+            "proof": proof,
+            "status_code": 1
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/trades")
+def get_trades(payload: str = Form(...)):
+    try:
+        payload_json = json.loads(payload)
+        symbol, order_book = get_book_for_read(payload_json['symbol'])
+        limit = min(int(payload_json.get('limit', DEFAULT_HISTORY_LIMIT)), MAX_HISTORY_LIMIT)
+
+        trades = order_book.trades.range(payload_json.get('start'), payload_json.get('end'), limit)
+
+        return JSONResponse(content={
+            "message": "Trades retrieved successfully",
+            "symbol": symbol,
+            "trades": trades,
+            "status_code": 1
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/candles")
+def get_candles(payload: str = Form(...)):
+    try:
+        payload_json = json.loads(payload)
+        symbol, order_book = get_book_for_read(payload_json['symbol'])
+        interval = payload_json.get('interval', '1m')
+        limit = min(int(payload_json.get('limit', DEFAULT_HISTORY_LIMIT)), MAX_HISTORY_LIMIT)
+
+        candles = order_book.trades.get_candles(interval, payload_json.get('start'), payload_json.get('end'), limit)
+
+        return JSONResponse(content={
+            "message": "Candles retrieved successfully",
+            "symbol": symbol,
+            "interval": interval,
+            "candles": candles,
+            "status_code": 1
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/route")
+def get_route(payload: str = Form(...)):
+    try:
+        payload_json = json.loads(payload)
+        source = canonical_asset(payload_json['fromAsset'])
+        target = canonical_asset(payload_json['toAsset'])
+        amount = float(payload_json['amount'])
+        max_hops = min(int(payload_json.get('maxHops', 3)), MAX_ROUTE_HOPS)
+
+        route = route_graph.best_route(source, target, amount, max_hops)
+        if route is None:
+            return JSONResponse(content={
+                "message": "No route can fill this amount",
+                "route": None,
+                "status_code": 0
+            })
+
+        return JSONResponse(content={
+            "message": "Route computed successfully",
+            "route": route,
+            "status_code": 1
+        })
+    except ValueError as e:
+        # Malformed payload or an amount that is not positive
+        return JSONResponse(content={
+            "message": str(e),
+            "route": None,
+            "status_code": 0
+        }, status_code=400)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        result = order_book.get_orderbook(payload_json['symbol'])
+def parse_pool(pool_json):
+    fee = float(pool_json.get('fee', 0.003))
+    if pool_json['type'] == 'constant_product':
+        return Pool.constant_product(float(pool_json['reserveBase']), float(pool_json['reserveQuote']), fee)
+    if pool_json['type'] == 'concentrated':
+        ranges = [(float(r['priceLower']), float(r['priceUpper']), float(r['liquidity'])) for r in pool_json['ranges']]
+        return Pool.concentrated(float(pool_json['price']), ranges, fee)
+    raise ValueError("Unknown pool type %s" % pool_json['type'])
+
+@app.post("/api/split_route")
+def get_split_route(payload: str = Form(...)):
+    # One call for the hook: how much of a swap should go to the book and how
+    # much to the pool, given the pool state it passes in
+    try:
+        payload_json = json.loads(payload)
+        side = payload_json['side']
+        if side not in ('bid', 'ask'):
+            raise ValueError("side must be bid or ask")
+        symbol, order_book = get_book_for_read(make_symbol(payload_json["baseAsset"], payload_json["quoteAsset"]))
+        pool = parse_pool(payload_json['pool'])
+
+        split = split_swap(order_book, side, float(payload_json['amount']), pool)
 
         return JSONResponse(content={
-            "message": "Order book retrieved successfully",
-            "orderbook": result,
+            "message": "Split route computed successfully",
+            "symbol": symbol,
+            "split": split,
             "status_code": 1
         })
+    except ValueError as e:
+        # Malformed payload, pool or an amount that is not a positive number
+        return JSONResponse(content={
+            "message": str(e),
+            "split": None,
+            "status_code": 0
+        }, status_code=400)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def get_engine_best_order(payload_json, side, started):
+    # get_best_order when matching runs in the engine process
+    try:
+        order = engine_client.best_order(canonical_asset(payload_json["baseAsset"]),
+                                         canonical_asset(payload_json["quoteAsset"]),
+                                         'bid' if side == 'bid' else 'ask')
+    except KeyError:
+        # Same as the in-process path for an unknown book
+        raise HTTPException(status_code=404, detail="Order book not found")
+    if order is None:
+        return JSONResponse(content={
+            "message": "no bid or ask order",
+            "order": {
+                'order_id': 1234567890,
+                'account': "0xf39Fd6e51aad88F6F4ce6aB8827279cffFb92266",
+                'price': 0,
+                'quantity': 0,
+                'side': side,
+                'baseAsset': payload_json["baseAsset"],
+                'quoteAsset': payload_json["quoteAsset"],
+                'trade_id': None,
+                'trades': [],
+                'isValid': False,
+                'timestamp': int(time.time() * 1000)
+            }
+        })
+    # Same fields as the order cached in OrderBook.top_of_book
+    response = JSONResponse(content={
+        "message": "Best order retrieved successfully",
+        "order": {
+            'order_id': int(order.order_id),
+            'account': order.account,
+            'price': float(order.price),
+            'quantity': float(order.quantity),
+            'side': order.side,
+            'baseAsset': order.baseAsset,
+            'quoteAsset': order.quoteAsset,
+            'trade_id': order.trade_id,
+            'trades': [],
+            'isValid': True,
+            'timestamp': order.timestamp
+        }
+    })
+    metrics.observe("get_best_order", time.perf_counter() - started)
+    return response
+
 @app.post("/api/get_best_order")
 def get_best_order(payload: str = Form(...)):
+    started = time.perf_counter()
     try:
         payload_json = json.loads(payload)
-        symbol = "%s_%s" % (payload_json["baseAsset"], payload_json["quoteAsset"])
         side = payload_json['side']
 
-        if symbol not in order_books:
+        if engine_client is not None:
+            return get_engine_best_order(payload_json, side, started)
+
+        order_book = order_books.get(make_symbol(payload_json["baseAsset"], payload_json["quoteAsset"]))
+        if order_book is None:
             raise HTTPException(status_code=404, detail="Order book not found")
 
-        order_book = order_books[symbol]
-        price = order_book.get_best_bid() if side == 'bid' else order_book.get_best_ask()
-        if price is None:
+        top = order_book.get_top_of_book('bid' if side == 'bid' else 'ask')
+        if top is None:
             # no bid or ask order
             # fake content
             return JSONResponse(content={
@@ -275,26 +1088,12 @@ def get_best_order(payload: str = Form(...)):
                 }
             })
 
-        price_list = order_book.bids.price_map[price] if side == 'bid' else order_book.asks.price_map[price]
-        current_order = price_list.head_order
-        order_dict = {
-            'order_id': int(current_order.order_id),
-            'account': current_order.account,
-            'price': float(current_order.price),
-            'quantity': float(current_order.quantity),
-            'side': current_order.side,
-            'baseAsset': current_order.baseAsset,
-            'quoteAsset': current_order.quoteAsset,
-            'trade_id': current_order.trade_id,
-            'trades': [],
-            'isValid': True,
-            'timestamp': current_order.timestamp
-        }
-
-        return JSONResponse(content={
-            "message": "Best order retrieved successfully",
-            "order": order_dict
-        })
+        # The order is serialized by the book whenever the best order changes,
+        # only the envelope is added here
+        response = Response(content=BEST_ORDER_PREFIX + top['encoded'] + b'}',
+                            media_type="application/json")
+        metrics.observe("get_best_order", time.perf_counter() - started)
+        return response
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -303,7 +1102,7 @@ def check_available_funds(payload: str = Form(...)):
     try:
         payload_json = json.loads(payload)
         account = payload_json['account']
-        asset = payload_json['asset']
+        asset = canonical_asset(payload_json['asset'])
         
         # Calculate total locked funds across all order books
         total_locked_amount = Decimal('0')
@@ -316,17 +1115,18 @@ def check_available_funds(payload: str = Form(...)):
             # Check bids (buying orders)
             if quote_asset == asset:  # If quote asset matches, check bids
                 for order_id, order in order_book.bids.order_map.items():
-                    if order['account'].lower() == account.lower():
-                        # For bids, the locked amount is price * quantity in quote asset
-                        locked_amount = order['price'] * order['quantity']
+                    if order.account.lower() == account.lower():
+                        # For bids, the locked amount is price * quantity in quote asset,
+                        # including the hidden reserve of iceberg orders
+                        locked_amount = order.price * (order.quantity + order.hidden)
                         total_locked_amount += locked_amount
             
             # Check asks (selling orders)
             if base_asset == asset:  # If base asset matches, check asks
                 for order_id, order in order_book.asks.order_map.items():
-                    if order['account'].lower() == account.lower():
+                    if order.account.lower() == account.lower():
                         # For asks, the locked amount is just the quantity in base asset
-                        total_locked_amount += order['quantity']
+                        total_locked_amount += order.quantity + order.hidden
         
         return JSONResponse(content={
             "message": "Available funds checked successfully",
@@ -338,5 +1138,180 @@ def check_available_funds(payload: str = Form(...)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/metrics")
+def get_metrics():
+    return JSONResponse(content={
+        "latency": metrics.snapshot(),
+        "markets": {symbol: order_book.get_market_stats() for symbol, order_book in order_books.items()},
+        "persistence": trade_writer.stats() if trade_writer is not None else None,
+        "rateLimits": rate_limiter.stats(),
+        "memory": {symbol: book_usage(order_book, replication_log_bytes(symbol))["total"]
+                   for symbol, order_book in order_books.items()},
+        "admission": admission.stats() if admission is not None else None,
+        "audit": auditor.stats(),
+        "responseCache": response_cache.stats(),
+        "replication": replication.stats() if replication is not None else None,
+        "tracing": tracer.stats() if tracer is not None else None,
+        "status_code": 1
+    })
+
+@app.get("/api/admin/memory")
+def admin_memory():
+    books = {}
+    total = 0
+    for symbol, order_book in order_books.items():
+        usage = book_usage(order_book, replication_log_bytes(symbol))
+        usage["limits"] = order_book.limits.as_dict() if order_book.limits is not None else None
+        books[symbol] = usage
+        total += usage["total"]
+    return JSONResponse(content={
+        "message": "Memory usage retrieved successfully",
+        "books": books,
+        "total": total,
+        "status_code": 1
+    })
+
+@app.post("/api/admin/audit")
+def admin_audit(payload: str = Form("{}")):
+    # Full check of one book, or of every book if no symbol is given
+    try:
+        payload_json = json.loads(payload)
+        symbol = payload_json.get("symbol")
+        if symbol is not None:
+            order_book = order_books.get(symbol)
+            if order_book is None:
+                raise KeyError("Order book not found")
+            books = [(symbol, order_book)]
+        else:
+            books = order_books.items()
+        violations = {}
+        for name, order_book in books:
+            found = audit_book(order_book)
+            if found:
+                violations[name] = found
+        return JSONResponse(content={
+            "message": "Audit completed",
+            "booksChecked": len(books),
+            "violations": violations,
+            "status_code": 1 if not violations else 0
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/admin/replication")
+def admin_replication():
+    return JSONResponse(content={
+        "message": "Replication status retrieved successfully",
+        "replication": replication.stats() if replication is not None else None,
+        "status_code": 1
+    })
+
+@app.post("/api/admin/promote")
+def admin_promote(payload: str = Form("{}")):
+    # Fences the primary, catches up with it and starts taking writes; with
+    # "force" the primary is not contacted, for when it is down
+    try:
+        payload_json = json.loads(payload)
+        if replication is None:
+            raise ValueError("Replication is not enabled")
+        last_seq = replication.promote(force=bool(payload_json.get("force")))
+        return JSONResponse(content={
+            "message": "Promoted to primary",
+            "lastSeq": last_seq,
+            "status_code": 1
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/admin/stage_timers")
+def admin_stage_timers(payload: str = Form(...)):
+    try:
+        payload_json = json.loads(payload)
+        set_stage_timers(payload_json["enabled"])
+        return JSONResponse(content={
+            "message": "Stage timers updated successfully",
+            "enabled": metrics.stage_timers_enabled,
+            "status_code": 1
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/admin/profile")
+def admin_profile(payload: str = Form(...)):
+    # Runs in the threadpool, so the service keeps serving while it samples
+    try:
+        payload_json = json.loads(payload)
+        samples, collapsed = profiler.sample(payload_json.get("seconds", 10),
+                                             payload_json.get("interval_ms", 5) / 1000.0)
+        return PlainTextResponse(collapsed, headers={"X-Profile-Samples": str(samples)})
+    except profiler.ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/import_orders")
+def import_book_orders(payload: str = Form(...), file: UploadFile = File(...)):
+    # Seeds a book with resting orders from an NDJSON or CSV upload, see
+    # orderbook/bulk.py. The upload is read from its spooled file a chunk at
+    # a time and nothing is matched.
+    try:
+        payload_json = json.loads(payload)
+        base_asset = canonical_asset(payload_json["baseAsset"])
+        quote_asset = canonical_asset(payload_json["quoteAsset"])
+        symbol = make_symbol(base_asset, quote_asset)
+        replace = bool(payload_json.get("replace", False))
+        file_format = payload_json.get("format") or ("csv" if (file.filename or "").endswith(".csv") else "ndjson")
+
+        started = time.perf_counter()
+        stream = io.TextIOWrapper(file.file, encoding="utf-8", newline="")
+        records = read_csv(stream) if file_format == "csv" else read_ndjson(stream)
+        bulk = BulkImport(base_asset, quote_asset)
+        try:
+            if file_format not in ("ndjson", "csv"):
+                raise ValueError("format must be ndjson or csv")
+            for chunk in chunks(records):
+                bulk.add(chunk)
+            with replicated_import(symbol, bulk, replace):
+                order_book = order_books.get_or_create(symbol)
+                loaded = bulk.load(order_book, replace)
+        except RegistryFull as e:
+            return JSONResponse(content={
+                "message": str(e),
+                "status_code": 0
+            }, status_code=503)
+        except ValueError as e:
+            # Invalid record, crossed or over the book's caps; the book is untouched
+            return JSONResponse(content={
+                "message": str(e),
+                "status_code": 0
+            }, status_code=400)
+        finally:
+            stream.detach()
+
+        return JSONResponse(content={
+            "message": "Orders imported successfully",
+            "orders": loaded,
+            "bids": len(order_book.bids),
+            "asks": len(order_book.asks),
+            "seconds": time.perf_counter() - started,
+            "status_code": 1
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/snapshot")
+def snapshot():
+    if not SNAPSHOT_DIR:
+        raise HTTPException(status_code=404, detail="Snapshots are not enabled")
+    try:
+        saved = save_snapshots()
+        return JSONResponse(content={
+            "message": "Snapshots written successfully",
+            "orders": saved,
+            "status_code": 1
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
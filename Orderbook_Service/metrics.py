@@ -0,0 +1,111 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds of the latency buckets, in microseconds. The last bucket is
+# open ended.
+LATENCY_BOUNDS_US = [1, 2, 5, 10, 20, 50, 100, 200, 500,
+                     1000, 2000, 5000, 10000, 20000, 50000,
+                     100000, 200000, 500000, 1000000]
+
+
+class Histogram(object):
+    '''
+    Fixed-bucket latency histogram. Observing a value is a bisect over the
+    bucket bounds plus a few integer adds, cheap enough for the hot path.
+    Percentiles are estimated as the upper bound of the bucket they land in.
+    '''
+
+    def __init__(self, bounds=LATENCY_BOUNDS_US):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        micros = seconds * 1e6
+        index = bisect_left(self.bounds, micros)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += micros
+            if micros > self.max:
+                self.max = micros
+
+    def percentile(self, fraction):
+        if self.count == 0:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                if index < len(self.bounds):
+                    return min(self.bounds[index], self.max)
+                return self.max
+        return self.max
+
+    def snapshot(self):
+        with self.lock:
+            buckets = {'le_%d' % bound: count for bound, count in zip(self.bounds, self.counts)}
+            buckets['inf'] = self.counts[-1]
+            return {
+                'count': self.count,
+                'mean_us': self.total / self.count if self.count else None,
+                'max_us': self.max,
+                'p50_us': self.percentile(0.5),
+                'p99_us': self.percentile(0.99),
+                'p999_us': self.percentile(0.999),
+                'buckets': buckets,
+            }
+
+
+histograms = {}  # name : Histogram
+_histograms_lock = threading.Lock()
+
+
+def histogram(name):
+    hist = histograms.get(name)
+    if hist is None:
+        with _histograms_lock:
+            hist = histograms.setdefault(name, Histogram())
+    return hist
+
+
+def observe(name, seconds):
+    histogram(name).observe(seconds)
+
+
+def snapshot():
+    return {name: hist.snapshot() for name, hist in list(histograms.items())}
+
+
+# Per-stage request timers are opt-in: when disabled, stage_clock() returns
+# None and observe_stage() is a no-op, so the instrumented code only pays for
+# a global lookup and a comparison.
+stage_timers_enabled = os.environ.get("ORDERBOOK_STAGE_TIMERS") == "1"
+
+
+def set_stage_timers(enabled):
+    global stage_timers_enabled
+    stage_timers_enabled = bool(enabled)
+
+
+def stage_clock():
+    if stage_timers_enabled:
+        return time.perf_counter()
+    return None
+
+
+def observe_stage(name, started):
+    '''Record the time since started (from stage_clock) under stage.<name>.
+    Returns a fresh clock reading so consecutive stages can be chained.
+    '''
+    if started is None:
+        return None
+    now = time.perf_counter()
+    histogram('stage.' + name).observe(now - started)
+    return now
@@ -0,0 +1,84 @@
+'''
+Ethereum address helpers. Assets are identified by token address, and the
+same address can arrive in any mix of upper and lower case, so every symbol
+is keyed by the EIP-55 checksummed form. Keccak-256 is implemented here
+because hashlib.sha3_256 uses different padding and would give wrong
+checksums.
+'''
+import re
+from functools import lru_cache
+
+ADDRESS_RE = re.compile(r'^0x[0-9a-fA-F]{40}$')
+
+_ROUND_CONSTANTS = [
+    0x0000000000000001, 0x0000000000008082, 0x800000000000808A, 0x8000000080008000,
+    0x000000000000808B, 0x0000000080000001, 0x8000000080008081, 0x8000000000008009,
+    0x000000000000008A, 0x0000000000000088, 0x0000000080008009, 0x000000008000000A,
+    0x000000008000808B, 0x800000000000008B, 0x8000000000008089, 0x8000000000008003,
+    0x8000000000008002, 0x8000000000000080, 0x000000000000800A, 0x800000008000000A,
+    0x8000000080008081, 0x8000000000008080, 0x0000000080000001, 0x8000000080008008,
+]
+_ROTATIONS = [
+    [0, 36, 3, 41, 18],
+    [1, 44, 10, 45, 2],
+    [62, 6, 43, 15, 61],
+    [28, 55, 25, 21, 56],
+    [27, 20, 39, 8, 14],
+]
+_MASK = (1 << 64) - 1
+_RATE = 136  # bytes absorbed per permutation for a 256 bit output
+
+
+def _rotl(value, shift):
+    return ((value << shift) | (value >> (64 - shift))) & _MASK if shift else value
+
+
+def _keccak_f(state):
+    for round_constant in _ROUND_CONSTANTS:
+        c = [state[x][0] ^ state[x][1] ^ state[x][2] ^ state[x][3] ^ state[x][4] for x in range(5)]
+        d = [c[(x - 1) % 5] ^ _rotl(c[(x + 1) % 5], 1) for x in range(5)]
+        state = [[state[x][y] ^ d[x] for y in range(5)] for x in range(5)]
+        b = [[0] * 5 for _ in range(5)]
+        for x in range(5):
+            for y in range(5):
+                b[y][(2 * x + 3 * y) % 5] = _rotl(state[x][y], _ROTATIONS[x][y])
+        state = [[b[x][y] ^ ((~b[(x + 1) % 5][y]) & b[(x + 2) % 5][y]) for y in range(5)]
+                 for x in range(5)]
+        state[0][0] ^= round_constant
+    return state
+
+
+def keccak256(data):
+    '''Keccak-256 as used by Ethereum (original padding, not SHA3-256).'''
+    padded = bytearray(data)
+    padded.append(0x01)
+    padded.extend(b'\x00' * (-len(padded) % _RATE))
+    padded[-1] |= 0x80
+    state = [[0] * 5 for _ in range(5)]
+    for offset in range(0, len(padded), _RATE):
+        block = padded[offset:offset + _RATE]
+        for i in range(_RATE // 8):
+            state[i % 5][i // 5] ^= int.from_bytes(block[8 * i:8 * i + 8], 'little')
+        state = _keccak_f(state)
+    return b''.join(state[i % 5][i // 5].to_bytes(8, 'little') for i in range(4))
+
+
+def is_address(value):
+    return isinstance(value, str) and ADDRESS_RE.match(value) is not None
+
+
+@lru_cache(maxsize=4096)
+def to_checksum_address(address):
+    '''EIP-55 checksummed form of a hex address, whatever its input case.'''
+    if not is_address(address):
+        raise ValueError('Not an address: %r' % (address,))
+    lower = address[2:].lower()
+    digest = keccak256(lower.encode('ascii')).hex()
+    return '0x' + ''.join(c.upper() if int(h, 16) >= 8 else c for c, h in zip(lower, digest))
+
+
+def canonical_asset(asset):
+    '''Checksummed address for addresses, other asset names unchanged.'''
+    if is_address(asset):
+        return to_checksum_address(asset)
+    return asset
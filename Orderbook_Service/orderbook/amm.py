@@ -0,0 +1,176 @@
+'''
+Split a swap between the order book and an AMM pool.
+
+Pools are described by the caller (this service never reads the chain) as
+either constant-product reserves or concentrated-liquidity ranges. Both are
+modelled as a list of price ranges with constant liquidity L, where, with
+s = sqrt(price) in quote per base:
+
+    quote amount for moving s to s'  = L * (s' - s)
+    base amount for moving s to s'   = L * (1/s - 1/s')
+
+A constant-product pool is a single range over (0, inf) with L = sqrt(x*y).
+
+The optimal split sends each unit of input to whichever venue gives the
+better marginal price, so the book's levels are merged with the pool curve:
+levels are taken while they beat the pool's marginal price, and between
+levels the pool is traded until its marginal price reaches the next level.
+Each step is closed form, so the cost is linear in the levels touched.
+'''
+import math
+
+
+class Pool(object):
+    def __init__(self, ranges, price, fee):
+        '''ranges: (price_lower, price_upper, liquidity) tuples, price in
+        quote per base; price: current pool price; fee: fraction of input.'''
+        if not (price > 0 and math.isfinite(price)):
+            raise ValueError('Pool price must be a positive number')
+        if not 0 <= fee < 1:
+            raise ValueError('Pool fee must be in [0, 1)')
+        self.segments = sorted((math.sqrt(lower), math.sqrt(upper) if upper != math.inf else math.inf, float(liquidity))
+                               for lower, upper, liquidity in ranges if liquidity > 0 and upper > lower)
+        self.sqrt_price = math.sqrt(price)
+        self.fee = fee
+
+    @classmethod
+    def constant_product(cls, reserve_base, reserve_quote, fee=0.003):
+        if not (0 < reserve_base < math.inf and 0 < reserve_quote < math.inf):
+            raise ValueError('Pool reserves must be positive numbers')
+        return cls([(0.0, math.inf, math.sqrt(reserve_base * reserve_quote))],
+                   reserve_quote / reserve_base, fee)
+
+    @classmethod
+    def concentrated(cls, price, ranges, fee=0.003):
+        return cls(ranges, price, fee)
+
+    def _segment_up(self, s):
+        # Range trading at s when the price moves up, or the next one above
+        for lower, upper, liquidity in self.segments:
+            if upper > s:
+                return max(lower, s), upper, liquidity
+        return None
+
+    def _segment_down(self, s):
+        for lower, upper, liquidity in reversed(self.segments):
+            if lower < s:
+                return lower, min(upper, s), liquidity
+        return None
+
+    def buy(self, budget, limit_price):
+        '''Spend up to budget quote buying base, stopping when the marginal
+        price including the fee reaches limit_price. Returns (quote spent,
+        base received) and moves the pool.'''
+        spent = received = 0.0
+        s = self.sqrt_price
+        target = math.sqrt(limit_price * (1 - self.fee)) if limit_price != math.inf else math.inf
+        while budget - spent > 0 and s < target:
+            segment = self._segment_up(s)
+            if segment is None:
+                break
+            start, upper, liquidity = segment
+            if start >= target:
+                break
+            s = start
+            end = min(upper, target)
+            net = (budget - spent) * (1 - self.fee)
+            if end == math.inf or liquidity * (end - s) >= net:
+                end = s + net / liquidity
+                spent = budget
+            else:
+                spent += liquidity * (end - s) / (1 - self.fee)
+            received += liquidity * (1 / s - 1 / end)
+            s = end
+        self.sqrt_price = s
+        return spent, received
+
+    def sell(self, budget, limit_price):
+        '''Sell up to budget base for quote, stopping when the marginal price
+        net of the fee falls to limit_price. Returns (base spent, quote
+        received) and moves the pool.'''
+        spent = received = 0.0
+        s = self.sqrt_price
+        target = math.sqrt(limit_price / (1 - self.fee)) if limit_price > 0 else 0.0
+        while budget - spent > 0 and s > target:
+            segment = self._segment_down(s)
+            if segment is None:
+                break
+            lower, start, liquidity = segment
+            if start <= target:
+                break
+            s = start
+            end = max(lower, target)
+            net = (budget - spent) * (1 - self.fee)
+            if end == 0 or liquidity * (1 / end - 1 / s) >= net:
+                end = 1 / (1 / s + net / liquidity)
+                spent = budget
+            else:
+                spent += liquidity * (1 / end - 1 / s) / (1 - self.fee)
+            received += liquidity * (s - end)
+            s = end
+        self.sqrt_price = s
+        return spent, received
+
+
+def split_swap(order_book, side, amount_in, pool):
+    '''
+    Optimal split of a swap between order_book and pool.
+
+    side is the side of the taker: 'bid' spends amount_in of the quote asset
+    buying base, 'ask' sells amount_in of the base asset. The pool object is
+    moved along its curve as it is used. Raises ValueError if amount_in is
+    not a positive number.
+    '''
+    if not (amount_in > 0 and math.isfinite(amount_in)):
+        raise ValueError('amount must be a positive number')
+    buying = side == 'bid'
+    tree = order_book.asks if buying else order_book.bids
+    prices = iter(tree.prices) if buying else reversed(tree.prices)
+    remaining = float(amount_in)
+    book_in = book_out = pool_in = pool_out = 0.0
+    levels = []
+    for price in prices:
+        if remaining <= 0:
+            break
+        level_price = float(price)
+        # Trade the pool until its marginal price reaches this level
+        if buying:
+            spent, received = pool.buy(remaining, level_price)
+        else:
+            spent, received = pool.sell(remaining, level_price)
+        pool_in += spent
+        pool_out += received
+        remaining -= spent
+        if remaining <= 0:
+            break
+        level_volume = float(tree.get_price_list(price).volume)
+        if buying:
+            taken_in = min(remaining, level_volume * level_price)
+            taken_out = taken_in / level_price
+        else:
+            taken_in = min(remaining, level_volume)
+            taken_out = taken_in * level_price
+        levels.append({'price': level_price, 'amountIn': taken_in, 'amountOut': taken_out})
+        book_in += taken_in
+        book_out += taken_out
+        remaining -= taken_in
+    if remaining > 0:
+        # Book exhausted, the pool takes the rest
+        if buying:
+            spent, received = pool.buy(remaining, math.inf)
+        else:
+            spent, received = pool.sell(remaining, 0.0)
+        pool_in += spent
+        pool_out += received
+        remaining -= spent
+    amount_out = book_out + pool_out
+    filled = float(amount_in) - max(remaining, 0.0)
+    return {
+        'side': side,
+        'amountIn': filled,
+        'amountOut': amount_out,
+        'unfilled': max(remaining, 0.0),
+        'averagePrice': (filled / amount_out if buying else amount_out / filled) if amount_out else None,
+        'book': {'amountIn': book_in, 'amountOut': book_out, 'levels': levels},
+        'amm': {'amountIn': pool_in, 'amountOut': pool_out, 'endPrice': pool.sqrt_price ** 2}
+    }
@@ -0,0 +1,251 @@
+'''
+Consistency checks of the counters that OrderTree and OrderList maintain by
+hand (volume, num_orders, depth, length) against the orders actually linked
+in the book.
+
+audit_book() checks a whole book and is meant for tests and offline use.
+Auditor spreads the same checks over time for a live service: each tick
+audits levels from where the previous tick stopped, until a CPU budget is
+used up, so a full rotation over every book happens in the background at a
+bounded cost per tick.
+'''
+import contextlib
+import itertools
+import threading
+import time
+from collections import deque
+
+SIDES = ('bid', 'ask')
+# Level prices copied per read of a side, so a read stays short on deep books
+LEVELS_PER_READ = 64
+# Reads of a structure a writer keeps changing under them before giving up
+READ_ATTEMPTS = 5
+
+
+def _violation(kind, side, price, expected, actual):
+    return {'kind': kind, 'side': side, 'price': None if price is None else str(price),
+            'expected': str(expected), 'actual': str(actual)}
+
+
+def check_level(tree, side, price, order_list):
+    '''Walk one OrderList and compare it with its counters and with the
+    tree's order_map. Returns (violations, orders walked).'''
+    violations = []
+    count = 0
+    volume = 0
+    prev = None
+    order = order_list.head_order
+    limit = len(tree.order_map) + 1
+    while order is not None:
+        count += 1
+        if count > limit:
+            violations.append(_violation('cycle', side, price, limit, count))
+            return violations, count
+        if order.prev_order is not prev:
+            violations.append(_violation('prev_link', side, price, prev and prev.order_id,
+                                         order.prev_order and order.prev_order.order_id))
+        if order.order_list is not order_list:
+            violations.append(_violation('order_list', side, price, 'level', order.order_id))
+        if order.price != price:
+            violations.append(_violation('order_price', side, price, price, order.price))
+        if tree.order_map.get(order.order_id) is not order:
+            violations.append(_violation('order_map', side, price, order.order_id, None))
+        volume += order.quantity
+        prev = order
+        order = order.next_order
+    if order_list.tail_order is not prev:
+        violations.append(_violation('tail', side, price, prev and prev.order_id,
+                                     order_list.tail_order and order_list.tail_order.order_id))
+    if count == 0:
+        violations.append(_violation('empty_level', side, price, '>0', 0))
+    if count != order_list.length:
+        violations.append(_violation('level_length', side, price, count, order_list.length))
+    if volume != order_list.volume:
+        violations.append(_violation('level_volume', side, price, volume, order_list.volume))
+    return violations, count
+
+
+def check_counters(tree, side):
+    '''O(1) tree counters.'''
+    violations = []
+    if tree.num_orders != len(tree.order_map):
+        violations.append(_violation('num_orders', side, None, len(tree.order_map), tree.num_orders))
+    if tree.depth != len(tree.price_map):
+        violations.append(_violation('depth', side, None, len(tree.price_map), tree.depth))
+    return violations
+
+
+def check_volume(tree, side):
+    '''Tree volume against the sum of its level volumes, O(depth).'''
+    volume = sum(order_list.volume for order_list in tree.price_map.values())
+    if volume != tree.volume:
+        return [_violation('tree_volume', side, None, volume, tree.volume)]
+    return []
+
+
+def _side_totals(tree, side):
+    # The counter and volume checks of a side, as (violations, orders walked)
+    return check_counters(tree, side) + check_volume(tree, side), 0
+
+
+def _check_price(tree, side, price):
+    order_list = tree.price_map.get(price)
+    if order_list is None:
+        return [], 0  # removed since the prices were read
+    return check_level(tree, side, price, order_list)
+
+
+def _prices_after(tree, cursor):
+    if cursor is None:
+        prices = tree.price_map.irange()
+    else:
+        prices = tree.price_map.irange(minimum=cursor, inclusive=(False, True))
+    return list(itertools.islice(prices, LEVELS_PER_READ))
+
+
+def audit_book(order_book):
+    '''Full check of both sides of order_book; returns every violation.'''
+    violations = []
+    for side in SIDES:
+        tree = order_book.bids if side == 'bid' else order_book.asks
+        violations += check_counters(tree, side)
+        violations += check_volume(tree, side)
+        for price, order_list in list(tree.price_map.items()):
+            violations += check_level(tree, side, price, order_list)[0]
+    return violations
+
+
+class Auditor(object):
+    '''
+    Rotating, budgeted audit of every book in a registry.
+
+    The position is kept as (book, side, last price audited), so a rotation
+    survives levels being added and removed between ticks. The books are
+    mutated by request threads while a tick runs: every read of a book is
+    taken under lock(symbol), the lock its writers hold if they hold one,
+    and retried when a writer resized what it iterates. A failed check is
+    read a second time after yielding the GIL and only reported if it fails
+    again, which filters out updates caught half way.
+    '''
+
+    def __init__(self, budget=0.0005, clock=time.perf_counter, lock=None):
+        self.budget = budget  # seconds of checking per tick
+        self.clock = clock
+        self.lock = lock or (lambda symbol: contextlib.nullcontext())
+        self.book_index = 0
+        self.side_index = 0
+        self.cursor = None  # last price audited on the current side
+        self.ticks = 0
+        self.rotations = 0
+        self.levels_checked = 0
+        self.orders_checked = 0
+        self.retries = 0  # reads repeated as a writer changed the book under them
+        self.errors = 0  # ticks that failed, counted by AuditThread
+        self.last_error = None
+        self.drift = {}  # kind : number of times seen
+        self.recent = deque(maxlen=20)  # latest violations, with symbol
+
+    def _read(self, symbol, read, *args):
+        '''read(*args) under the book's lock, or None if a writer changed
+        what it iterates on every attempt.'''
+        for _ in range(READ_ATTEMPTS):
+            with self.lock(symbol):
+                try:
+                    return read(*args)
+                except (IndexError, KeyError, RuntimeError):
+                    # sortedcontainers and dict iterators fail this way
+                    self.retries += 1
+            time.sleep(0)
+        return None
+
+    def _confirm(self, symbol, check, *args):
+        '''(violations, orders walked) of check, with the violations of a
+        second read if the first found any.'''
+        result = self._read(symbol, check, *args)
+        if result is not None and result[0]:
+            time.sleep(0)
+            result = self._read(symbol, check, *args)
+        return result if result is not None else ([], 0)
+
+    def _report(self, symbol, violations):
+        for violation in violations:
+            self.drift[violation['kind']] = self.drift.get(violation['kind'], 0) + 1
+            self.recent.append(dict(violation, symbol=symbol))
+
+    def tick(self, books):
+        '''Audit books ((symbol, OrderBook) pairs, e.g. registry.items()) for
+        up to budget seconds, continuing from the previous tick.'''
+        self.ticks += 1
+        if not books:
+            return
+        deadline = self.clock() + self.budget
+        visited = 0
+        while self.clock() < deadline and visited <= 2 * len(books):
+            if self.book_index >= len(books):
+                self.book_index = 0
+                self.rotations += 1
+            symbol, order_book = books[self.book_index]
+            side = SIDES[self.side_index]
+            tree = order_book.bids if side == 'bid' else order_book.asks
+            if self.cursor is None:
+                self._report(symbol, self._confirm(symbol, _side_totals, tree, side)[0])
+            prices = self._read(symbol, _prices_after, tree, self.cursor) or []
+            finished = len(prices) < LEVELS_PER_READ
+            for price in prices:
+                violations, walked = self._confirm(symbol, _check_price, tree, side, price)
+                self._report(symbol, violations)
+                self.levels_checked += 1
+                self.orders_checked += walked
+                self.cursor = price
+                if self.clock() >= deadline:
+                    finished = False
+                    break
+            if finished:
+                self.cursor = None
+                visited += 1
+                self.side_index += 1
+                if self.side_index == len(SIDES):
+                    self.side_index = 0
+                    self.book_index += 1
+
+    def stats(self):
+        return {
+            'ticks': self.ticks,
+            'rotations': self.rotations,
+            'levelsChecked': self.levels_checked,
+            'ordersChecked': self.orders_checked,
+            'retries': self.retries,
+            'errors': self.errors,
+            'lastError': self.last_error,
+            'drift': dict(self.drift),
+            'recent': list(self.recent)
+        }
+
+
+class AuditThread(threading.Thread):
+    '''Runs auditor.tick(books()) every interval seconds until stopped.
+    observe, if given, is called with the duration of each tick.'''
+
+    def __init__(self, auditor, books, interval=1.0, observe=None):
+        threading.Thread.__init__(self, name='book-auditor', daemon=True)
+        self.auditor = auditor
+        self.books = books
+        self.interval = interval
+        self.observe = observe
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            started = time.perf_counter()
+            try:
+                self.auditor.tick(self.books())
+            except Exception as e:
+                # The thread must keep auditing the next ticks
+                self.auditor.errors += 1
+                self.auditor.last_error = str(e)
+            if self.observe is not None:
+                self.observe(time.perf_counter() - started)
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        self.join(timeout)
@@ -0,0 +1,262 @@
+'''
+Bulk import of resting orders, to seed a book or migrate a market from
+another venue without sending every order through process_order.
+
+Orders come as NDJSON, one object per line, or CSV with a header row, with
+the fields
+
+    side, price, quantity, account        required
+    order_id, timestamp, trade_id         optional
+    displayQuantity                       optional, makes it an iceberg order
+
+Records are validated as they are read, a chunk at a time, into compact
+tuples; nothing is matched. Once the input is exhausted each side is sorted
+by price, timestamp and input order (an export that is already in book order
+sorts in linear time), the OrderLists are linked by hand and the levels are
+handed to OrderTree.bulk_load, which builds the SortedDict in one pass.
+
+Orders without an order_id are numbered after the highest id of the book and
+of the import, in book order; orders without a timestamp get the book's
+current time. An import that would cross the book, exceed its BookLimits or
+reuse an order id is rejected as a whole, before the book is touched.
+
+    bulk = BulkImport(base_asset, quote_asset)
+    with open('orders.ndjson') as f:
+        for chunk in chunks(read_ndjson(f)):
+            bulk.add(chunk)
+    bulk.load(order_book)
+'''
+import csv
+import gc
+import itertools
+import json
+from decimal import Decimal, InvalidOperation
+from .orderlist import OrderList
+from .order import Order
+
+CHUNK_SIZE = 10000
+# Sort key of orders without a timestamp: behind the timestamped orders of
+# their level, they get the time of the import
+LATEST = float('inf')
+FIELDS = ('side', 'price', 'quantity', 'account', 'order_id', 'timestamp', 'trade_id', 'displayQuantity')
+
+
+def read_ndjson(f, chunk_size=CHUNK_SIZE):
+    # A chunk of lines is decoded as one JSON array, several times faster
+    # than a json.loads per line; a chunk that does not decode is retried
+    # line by line to report the bad line.
+    decoder = json.JSONDecoder(parse_float=Decimal)
+    number = 0
+    while True:
+        lines = list(itertools.islice(f, chunk_size))
+        if not lines:
+            return
+        lines = [line for line in lines if line.strip()]
+        if not lines:
+            continue
+        try:
+            records = decoder.decode('[' + ','.join(lines) + ']')
+        except ValueError:
+            for line in lines:
+                number += 1
+                try:
+                    decoder.decode(line)
+                except ValueError as e:
+                    raise ValueError('record %d: %s' % (number, e))
+            raise
+        number += len(lines)
+        yield from records
+
+
+def read_csv(f):
+    for row in csv.DictReader(f):
+        yield {key: value for key, value in row.items() if value not in (None, '')}
+
+
+def chunks(records, size=CHUNK_SIZE):
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class BulkImport(object):
+    '''
+    Collects validated orders for one book; add() takes the records a chunk
+    at a time and load() puts them in the book. Errors are ValueErrors naming
+    the 1-based position of the offending record.
+    '''
+
+    def __init__(self, base_asset, quote_asset):
+        self.base_asset = base_asset
+        self.quote_asset = quote_asset
+        # (price, timestamp, position, order_id, quantity, trade_id, account, peak)
+        self.rows = {'bid': [], 'ask': []}
+        self.order_ids = set()
+        self.count = 0
+        self.decimals = {}  # text : validated Decimal, prices and sizes repeat a lot
+
+    def _decimal(self, value, name):
+        key = value if isinstance(value, str) else str(value)
+        number = self.decimals.get(key)
+        if number is None:
+            try:
+                number = Decimal(key)
+            except InvalidOperation:
+                raise ValueError('%s is not a number' % name)
+            if not number.is_finite() or number <= 0:
+                raise ValueError('%s must be greater than 0' % name)
+            self.decimals[key] = number
+        return number
+
+    def add(self, records):
+        '''Validate a chunk of records and keep them for load().'''
+        rows = self.rows
+        order_ids = self.order_ids
+        position = self.count
+        for record in records:
+            position += 1
+            try:
+                side = record.get('side')
+                if side not in ('bid', 'ask'):
+                    raise ValueError('side must be "bid" or "ask"')
+                price = self._decimal(record.get('price'), 'price')
+                quantity = self._decimal(record.get('quantity'), 'quantity')
+                account = record.get('account')
+                if not account:
+                    raise ValueError('account is required')
+                order_id = record.get('order_id')
+                if order_id is not None:
+                    order_id = int(order_id)
+                    if order_id <= 0:
+                        raise ValueError('order_id must be greater than 0')
+                    if order_id in order_ids:
+                        raise ValueError('duplicate order_id %d' % order_id)
+                    order_ids.add(order_id)
+                timestamp = record.get('timestamp')
+                timestamp = LATEST if timestamp is None else int(timestamp)
+                peak = record.get('displayQuantity')
+                if peak is not None:
+                    peak = self._decimal(peak, 'displayQuantity')
+                    if peak >= quantity:
+                        peak = None
+            except (ValueError, TypeError) as e:
+                raise ValueError('record %d: %s' % (position, e))
+            except AttributeError:
+                raise ValueError('record %d is not an object' % position)
+            trade_id = record.get('trade_id')
+            rows[side].append((price, timestamp, position, order_id, quantity,
+                               account if trade_id is None else trade_id, account, peak))
+        self.count = position
+
+    def _check(self, order_book):
+        bids, asks = self.rows['bid'], self.rows['ask']
+        if bids and asks and bids[-1][0] >= asks[0][0]:
+            raise ValueError('Imported orders cross the book: best bid %s, best ask %s'
+                             % (bids[-1][0], asks[0][0]))
+        limits = order_book.limits
+        if limits is None:
+            return
+        for side, rows in self.rows.items():
+            if limits.max_orders is not None and len(rows) > limits.max_orders:
+                raise ValueError('%d %s orders exceed the cap of %d orders' % (len(rows), side, limits.max_orders))
+            if limits.max_levels is not None:
+                levels = sum(1 for _ in itertools.groupby(row[0] for row in rows))
+                if levels > limits.max_levels:
+                    raise ValueError('%d %s price levels exceed the cap of %d levels'
+                                     % (levels, side, limits.max_levels))
+
+    def _build_levels(self, rows, side, timestamp, next_order_id):
+        # Linked by hand like snapshot._build_levels, each level's length
+        # and volume set once when it is closed
+        levels = []
+        order_list = None
+        tail = None
+        price = None
+        from_fields = Order.from_fields
+        base_asset, quote_asset = self.base_asset, self.quote_asset
+        for (order_price, order_timestamp, _, order_id, quantity, trade_id, account, peak) in rows:
+            if order_price != price:
+                if order_list is not None:
+                    order_list.tail_order = tail
+                price = order_price
+                order_list = OrderList()
+                levels.append((price, order_list))
+                tail = None
+            if order_id is None:
+                next_order_id += 1
+                order_id = next_order_id
+            order = from_fields(order_list, order_id, timestamp if order_timestamp is LATEST else order_timestamp,
+                                price, quantity, trade_id, account, side, base_asset, quote_asset)
+            if peak is not None:
+                order.peak = peak
+                order.hidden = quantity - peak
+                order.quantity = peak
+            if tail is None:
+                order_list.head_order = order
+            else:
+                tail.next_order = order
+                order.prev_order = tail
+            tail = order
+            order_list.length += 1
+            order_list.volume += order.quantity
+        if order_list is not None:
+            order_list.tail_order = tail
+        return levels, next_order_id
+
+    def load(self, order_book, replace=False):
+        '''
+        Put the imported orders in order_book, which must be empty unless
+        replace is set, in which case its resting orders are dropped (pending
+        stops are kept). Returns the number of orders loaded.
+        '''
+        if not replace and (len(order_book.bids) or len(order_book.asks)):
+            raise ValueError('Order book is not empty, import with replace to overwrite it')
+        for rows in self.rows.values():
+            rows.sort()
+        self._check(order_book)
+        for order_id in self.order_ids:
+            if order_id in order_book.stops:
+                raise ValueError('order_id %d is already used by a pending stop' % order_id)
+        order_book.update_time()
+        next_order_id = max(order_book.next_order_id, max(self.order_ids) if self.order_ids else 0)
+        # Like load_snapshot: nothing allocated here is garbage
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            bid_levels, next_order_id = self._build_levels(self.rows['bid'], 'bid', order_book.time, next_order_id)
+            ask_levels, next_order_id = self._build_levels(self.rows['ask'], 'ask', order_book.time, next_order_id)
+            order_book.bids.bulk_load(bid_levels)
+            order_book.asks.bulk_load(ask_levels)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+        order_book.next_order_id = next_order_id
+        order_book.refresh_top_of_book()
+        return self.count
+
+    def field_rows(self):
+        '''The validated orders as lists of FIELDS values, None where not
+        given; importing them again into the same book gives the same
+        result. Used to replicate an import.'''
+        for side, rows in self.rows.items():
+            for (price, timestamp, _, order_id, quantity, trade_id, account, peak) in rows:
+                yield [side, price, quantity, account, order_id, None if timestamp is LATEST else timestamp,
+                       trade_id, peak]
+
+
+def records_from_rows(rows):
+    '''Records back from lists of FIELDS values.'''
+    for row in rows:
+        yield {name: value for name, value in zip(FIELDS, row) if value is not None}
+
+
+def import_orders(order_book, base_asset, quote_asset, records, replace=False, chunk_size=CHUNK_SIZE):
+    '''Validate records chunk by chunk and load them into order_book; see
+    BulkImport.load.'''
+    bulk = BulkImport(base_asset, quote_asset)
+    for chunk in chunks(records, chunk_size):
+        bulk.add(chunk)
+    return bulk.load(order_book, replace)
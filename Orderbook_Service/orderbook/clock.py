@@ -0,0 +1,57 @@
+'''
+Clocks for OrderBook.clock: callables returning the current time in
+milliseconds, the unit of every order and trade timestamp. A clock whose
+calls have side effects also has peek(), used by reads (see OrderBook.now).
+'''
+import time
+
+
+def wall_clock():
+    return int(time.time() * 1000)
+
+
+class LogicalClock(object):
+    '''
+    Deterministic clock for replays and tests. Each call returns the next
+    tick, start + step * calls so far, so a replay of the same order log
+    always stamps the same times. set() moves it forward, e.g. to the
+    timestamp of the last replayed record; it never goes back.
+    '''
+
+    def __init__(self, start=0, step=1):
+        self.now = start - step
+        self.step = step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+    def set(self, now):
+        if now > self.now:
+            self.now = now
+
+    def peek(self):
+        '''The last tick handed out, without advancing; for reads.'''
+        return self.now
+
+
+class PinnedClock(object):
+    '''
+    Wall clock that can be pinned to a given time. Followers pin it to the
+    time the primary's book used for a command while they replay it, so
+    their books stamp the same timestamps; unpinned it reads the wall clock.
+    '''
+
+    def __init__(self):
+        self.pinned = None
+
+    def __call__(self):
+        if self.pinned is not None:
+            return self.pinned
+        return wall_clock()
+
+    def pin(self, now):
+        self.pinned = now
+
+    def unpin(self):
+        self.pinned = None
@@ -0,0 +1,161 @@
+'''
+Merkle commitment over the resting orders of an OrderBook, so that a
+validator holding only a root can check an order against the book state
+behind a task without the full book.
+
+Each resting order owns a leaf of a binary Merkle tree (sha256, with
+domain-separated leaf and node hashes):
+
+    leaf = sha256(0x00 || side, order id, price, quantity, account, timestamp
+                          [, peak, hidden reserve for iceberg orders])
+           the fields as text, joined by 0x1f
+    node = sha256(0x01 || left || right)
+    empty leaf = 32 zero bytes
+
+An order gets a leaf slot when it enters the book and gives it back when it
+leaves; freed slots are reused last freed first, and the tree doubles when
+it runs out. Slots are handed out as the book changes, not when the root is
+computed, so the root only depends on the order flow and two books that
+processed the same operations have the same root.
+
+OrderTree reports every order it inserts, changes or removes through
+on_touch. touch() only records the slot as dirty; root() rehashes the dirty
+leaves and their ancestors, O(log n) per changed order, once for however
+many changes happened since the previous root.
+'''
+import hashlib
+import threading
+
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+EMPTY_LEAF = b'\x00' * 32
+FIELD_SEPARATOR = '\x1f'
+
+
+def leaf_fields(side, order):
+    fields = [side, str(order.order_id), str(order.price), str(order.quantity),
+              str(order.account), str(order.timestamp)]
+    if order.peak is not None:
+        # Iceberg orders also commit to their peak and hidden reserve
+        fields += [str(order.peak), str(order.hidden)]
+    return fields
+
+
+def leaf_hash(fields):
+    return hashlib.sha256(LEAF_PREFIX + FIELD_SEPARATOR.join(fields).encode('utf-8')).digest()
+
+
+def node_hash(left, right):
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+def verify_proof(fields, index, siblings, root):
+    '''Check an inclusion proof as returned by BookCommitment.proof, with
+    the hashes as bytes.'''
+    digest = leaf_hash(fields)
+    for sibling in siblings:
+        digest = node_hash(sibling, digest) if index & 1 else node_hash(digest, sibling)
+        index >>= 1
+    return digest == root
+
+
+class BookCommitment(object):
+
+    def __init__(self, bids, asks):
+        self.trees = {'bid': bids, 'ask': asks}
+        self.levels = [[EMPTY_LEAF]]  # leaves first, the last level holds the root
+        self.empty = [EMPTY_LEAF]  # hash of an empty subtree, per level
+        self.slots = {}  # (side, order_id) : leaf index
+        self.free = []  # freed leaf indexes
+        self.size = 0  # leaf indexes handed out so far
+        self.dirty = {}  # leaf index : (side, order_id), or None once emptied
+        self.lock = threading.Lock()
+
+    def touch(self, side, order_id):
+        '''Record that order_id was inserted, changed or removed on side.'''
+        key = (side, order_id)
+        with self.lock:
+            slot = self.slots.get(key)
+            if order_id in self.trees[side].order_map:
+                if slot is None:
+                    if self.free:
+                        slot = self.free.pop()
+                    else:
+                        slot = self.size
+                        self.size += 1
+                    self.slots[key] = slot
+                self.dirty[slot] = key
+            elif slot is not None:
+                del self.slots[key]
+                self.free.append(slot)
+                self.dirty[slot] = None
+
+    def restore(self, slots, free):
+        '''Take over the leaf slots of a saved book, {(side, order_id): index}
+        for its resting orders and its free list, so the root and the slots
+        handed out next are those of the book that was saved.'''
+        with self.lock:
+            self.levels = [[EMPTY_LEAF]]
+            self.empty = [EMPTY_LEAF]
+            self.slots = dict(slots)
+            self.free = list(free)
+            self.size = len(self.slots) + len(self.free)
+            self.dirty = {slot: key for key, slot in self.slots.items()}
+
+    def _grow(self):
+        while len(self.levels[0]) < self.size:
+            for k, level in enumerate(self.levels):
+                level.extend([self.empty[k]] * len(level))
+            top = self.levels[-1]
+            self.levels.append([node_hash(top[0], top[1])])
+            self.empty.append(node_hash(self.empty[-1], self.empty[-1]))
+
+    def _flush(self):
+        if not self.dirty:
+            return
+        self._grow()
+        leaves = self.levels[0]
+        for slot, key in self.dirty.items():
+            if key is None:
+                leaves[slot] = EMPTY_LEAF
+            else:
+                side, order_id = key
+                leaves[slot] = leaf_hash(leaf_fields(side, self.trees[side].order_map[order_id]))
+        indexes = set(self.dirty)
+        self.dirty = {}
+        for k in range(len(self.levels) - 1):
+            level = self.levels[k]
+            parents = self.levels[k + 1]
+            indexes = set(index >> 1 for index in indexes)
+            for index in indexes:
+                parents[index] = node_hash(level[2 * index], level[2 * index + 1])
+
+    def root(self):
+        with self.lock:
+            self._flush()
+            return self.levels[-1][0]
+
+    def proof(self, side, order_id):
+        '''Inclusion proof of a resting order, or None if it is not in the
+        book: the leaf fields, its index and the sibling hashes from the
+        leaf up, with the root they lead to.'''
+        with self.lock:
+            self._flush()
+            index = self.slots.get((side, order_id))
+            if index is None:
+                return None
+            order = self.trees[side].order_map[order_id]
+            siblings = []
+            position = index
+            for level in self.levels[:-1]:
+                siblings.append(level[position ^ 1].hex())
+                position >>= 1
+            return {
+                'fields': leaf_fields(side, order),
+                'index': index,
+                'siblings': siblings,
+                'root': self.levels[-1][0].hex()
+            }
+
+    def __len__(self):
+        return len(self.slots)
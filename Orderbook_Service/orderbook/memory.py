@@ -0,0 +1,214 @@
+'''
+Approximate memory accounting and capacity limits for order books.
+
+Walking a book to measure it is too slow to do on every metrics scrape, so
+usage is derived from the counters the book already keeps up to date on
+every insert and removal (orders, price levels, pending stops, tape and
+trade history lengths), multiplied by the cost of one of each object. The unit costs are
+measured once at import, so they follow the running interpreter, and they
+count the objects an entry owns (Decimal quantities, id and timestamp ints,
+the account string) plus its slot in the containers that index it. Strings shared between orders, such as the
+canonical asset addresses, are not counted.
+'''
+import sys
+import tracemalloc
+from collections import deque
+from decimal import Decimal
+from .order import Order
+from .orderlist import OrderList
+from .registry import canonical_symbol
+
+# Bytes per entry in a dict or list holding the object (hash, key and value
+# pointers of a dict entry plus index slack, or one list pointer)
+DICT_ENTRY_BYTES = 40
+LIST_SLOT_BYTES = 8
+
+
+def _instance_bytes(factory, samples=256):
+    # Instances keep their attributes in a values array rather than a real
+    # __dict__ on recent interpreters, which getsizeof cannot see, so measure
+    # what the allocator hands out when tracemalloc is free to use
+    if tracemalloc.is_tracing():
+        obj = factory()
+        return sys.getsizeof(obj) + sys.getsizeof(vars(obj))
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        objects = [factory() for _ in range(samples)]
+        allocated = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    return allocated // len(objects) - LIST_SLOT_BYTES
+
+
+def _measure():
+    decimal_bytes = sys.getsizeof(Decimal('1234.5678'))
+    int_bytes = sys.getsizeof(2 ** 40)
+    account_bytes = sys.getsizeof('0x' + '0' * 40)
+    order_bytes = _instance_bytes(lambda: Order.from_fields(None, 0, 0, None, None, None, None,
+                                                            'bid', None, None))
+    record = {'timestamp': 0, 'price': 0, 'quantity': 0, 'time': 0,
+              'party1': [None] * 4, 'party2': [None] * 4}
+    quote = {'type': 'limit', 'side': 'bid', 'price': 0, 'quantity': 0, 'trade_id': None,
+             'account': None, 'baseAsset': None, 'quoteAsset': None, 'order_id': 0, 'timestamp': 0}
+    return {
+        # Order with its price, quantity, id, timestamp and account, and its
+        # entry in OrderTree.order_map
+        'order': (order_bytes + 2 * decimal_bytes + 2 * int_bytes + account_bytes
+                  + int_bytes + DICT_ENTRY_BYTES),
+        # OrderList with its price key, its entry in the SortedDict's dict and
+        # its slot in the sorted key list
+        'level': _instance_bytes(OrderList) + decimal_bytes + DICT_ENTRY_BYTES + LIST_SLOT_BYTES,
+        # Transaction record dict, its two party lists and the deque slot
+        'tape': (sys.getsizeof(record) + 2 * sys.getsizeof(record['party1']) + int_bytes
+                 + LIST_SLOT_BYTES),
+        # One row of TradeStore columns (the price is shared with the order)
+        'trade': 5 * LIST_SLOT_BYTES + decimal_bytes + int_bytes,
+        # One candle: seven column slots, four prices shared with trades, a
+        # volume Decimal and a start int
+        'candle': 7 * LIST_SLOT_BYTES + decimal_bytes + int_bytes,
+        # One node of the commitment's Merkle tree: a 32 byte digest and its
+        # list slot
+        'node': sys.getsizeof(b'\x00' * 32) + LIST_SLOT_BYTES,
+        # Leaf slot of one order in BookCommitment.slots: (side, id) key
+        'slot': sys.getsizeof(('bid', 0)) + int_bytes + DICT_ENTRY_BYTES,
+        # Replication log entry: (seq, symbol, op, args, time, wall) tuple,
+        # its list slot, the copied quote with its Decimals and ints, and
+        # the ints of the tuple
+        'command': (sys.getsizeof((0,) * 6) + LIST_SLOT_BYTES + sys.getsizeof(quote) + 2 * decimal_bytes
+                    + 5 * int_bytes + account_bytes),
+        # One order of an import command: its list of field values
+        'command_row': (sys.getsizeof([None] * 8) + LIST_SLOT_BYTES + 2 * decimal_bytes + 2 * int_bytes
+                        + account_bytes),
+        # Pending stop: its quote dict with stop price, limit price and
+        # quantity, id, timestamp and account, and its entries in
+        # TriggerBook.stop_map and in its trigger level
+        'stop': (sys.getsizeof(dict(quote, stopPrice=0)) + 3 * decimal_bytes + 2 * int_bytes + account_bytes
+                 + 2 * DICT_ENTRY_BYTES),
+    }
+
+
+UNIT_BYTES = _measure()
+
+
+def command_bytes(op, args):
+    '''Approximate bytes held by one replication log entry.'''
+    rows = args.get('orders')
+    return UNIT_BYTES['command'] + (len(rows) * UNIT_BYTES['command_row'] if rows else 0)
+
+
+def book_usage(order_book, replication_bytes=0):
+    '''Approximate bytes used by order_book, per component. O(1).
+    replication_bytes is what the replication log holds for its symbol.'''
+    orders = len(order_book.bids) + len(order_book.asks)
+    levels = order_book.bids.depth + order_book.asks.depth
+    tape = len(order_book.tape)
+    trades = len(order_book.trades)
+    candles = sum(len(c) for c in order_book.trades.candles.values())
+    stops = len(order_book.stops)
+    # A tree with n leaves has n - 1 inner nodes
+    nodes = 2 * len(order_book.commitment.levels[0]) - 1
+    usage = {
+        'orders': orders * UNIT_BYTES['order'],
+        'levels': levels * UNIT_BYTES['level'],
+        'tape': tape * UNIT_BYTES['tape'],
+        'trades': trades * UNIT_BYTES['trade'] + candles * UNIT_BYTES['candle'],
+        'commitment': nodes * UNIT_BYTES['node'] + orders * UNIT_BYTES['slot'],
+        'stops': stops * UNIT_BYTES['stop'],
+        'replication': replication_bytes,
+    }
+    usage['total'] = sum(usage.values())
+    usage['counts'] = {'orders': orders, 'levels': levels, 'tape': tape,
+                       'trades': trades, 'candles': candles, 'nodes': nodes, 'stops': stops}
+    return usage
+
+
+class BookFull(Exception):
+    pass
+
+
+class BookLimits(object):
+    '''
+    Caps on the resting orders and price levels of one book, per side, on
+    its pending stops, and on the length of its tape, its trade history and
+    its candles (per interval). None means unlimited.
+
+    An order that would rest beyond max_orders, or open a price level beyond
+    max_levels, is rejected with BookFull before anything is matched, and so
+    is a stop beyond max_stops. The
+    history is bounded instead: once max_tape trades are on the tape, or
+    max_trades trades or max_candles candles in OrderBook.trades, the oldest
+    ones are dropped.
+    '''
+
+    def __init__(self, max_orders=None, max_levels=None, max_tape=None, max_trades=None, max_candles=None,
+                 max_stops=None):
+        self.max_orders = max_orders
+        self.max_levels = max_levels
+        self.max_tape = max_tape
+        self.max_trades = max_trades
+        self.max_candles = max_candles
+        self.max_stops = max_stops
+
+    def check(self, tree, price, new_order=True):
+        '''Raise BookFull if tree has no room for an order at price. With
+        new_order False (an order moving between levels) only the level cap
+        applies.'''
+        if new_order and self.max_orders is not None and len(tree) >= self.max_orders:
+            raise BookFull('Order book is full (%d resting orders)' % self.max_orders)
+        if self.max_levels is not None and tree.depth >= self.max_levels and not tree.price_exists(price):
+            raise BookFull('Order book is full (%d price levels)' % self.max_levels)
+
+    def check_stop(self, stops):
+        '''Raise BookFull if the TriggerBook stops has no room for a stop.'''
+        if self.max_stops is not None and len(stops) >= self.max_stops:
+            raise BookFull('Order book is full (%d pending stops)' % self.max_stops)
+
+    def apply(self, order_book):
+        order_book.limits = self
+        if order_book.tape.maxlen != self.max_tape:
+            order_book.tape = deque(order_book.tape, maxlen=self.max_tape)
+        order_book.trades.set_limits(self.max_trades, self.max_candles)
+
+    def as_dict(self):
+        return {'maxOrders': self.max_orders, 'maxLevels': self.max_levels, 'maxTape': self.max_tape,
+                'maxTrades': self.max_trades, 'maxCandles': self.max_candles, 'maxStops': self.max_stops}
+
+
+def parse_book_limits(text):
+    '''Parse "symbol=orders:levels:tape[:trades[:candles[:stops]]],..." into
+    {symbol: BookLimits}. Empty or missing fields are unlimited and the
+    symbol * sets the default for every book.'''
+    limits = {}
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        symbol, spec = part.split('=')
+        fields = [int(field) if field else None for field in spec.split(':')]
+        if not 3 <= len(fields) <= 6:
+            raise ValueError('Book limits must be orders:levels:tape[:trades[:candles[:stops]]], got %s' % spec)
+        limits[symbol.strip()] = BookLimits(*fields)
+    return limits
+
+
+class BookLimitPolicy(object):
+    '''Registry listener applying per-symbol BookLimits to every book that
+    enters the registry, whether created on the order path, configured at
+    startup or loaded from a snapshot.'''
+
+    def __init__(self, limits):
+        self.default = limits.get('*')
+        self.limits = {canonical_symbol(symbol): book_limits
+                       for symbol, book_limits in limits.items() if symbol != '*'}
+
+    def for_symbol(self, symbol):
+        return self.limits.get(symbol, self.default)
+
+    def add_book(self, symbol, order_book):
+        limits = self.for_symbol(symbol)
+        if limits is not None:
+            limits.apply(order_book)
+
+    def remove_book(self, symbol):
+        pass
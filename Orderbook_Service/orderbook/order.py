@@ -7,7 +7,15 @@ class Order(object):
     Orders are doubly linked and have helper functions (next_order, prev_order)
     to help the exchange fullfill orders with quantities larger than a single
     existing Order.
+
+    An iceberg order (quote['displayQuantity']) shows at most peak of its size
+    at a time: quantity is the displayed slice and hidden the reserve behind
+    it, which OrderTree.replenish_order draws on when a slice fills. Plain
+    orders keep the class defaults and carry no extra fields.
     '''
+    peak = None
+    hidden = 0
+
     def __init__(self, quote, order_list):
         self.timestamp = int(quote['timestamp']) # integer representing the timestamp of order creation
         self.quantity = Decimal(quote['quantity']) # decimal representing amount of thing - can be partial amounts
@@ -24,6 +32,34 @@ class Order(object):
         self.baseAsset = quote['baseAsset']
         self.quoteAsset = quote['quoteAsset']
 
+        peak = quote.get('displayQuantity')
+        if peak is not None and Decimal(peak) < self.quantity:
+            self.peak = Decimal(peak)
+            self.hidden = self.quantity - self.peak
+            self.quantity = self.peak
+
+    @classmethod
+    def from_fields(cls, order_list, order_id, timestamp, price, quantity,
+                    trade_id, account, side, base_asset, quote_asset):
+        '''Build an Order from already-typed fields, skipping the quote dict
+        and the Decimal/int conversions done in __init__. Used by the bulk
+        loaders, which create orders by the million.
+        '''
+        order = cls.__new__(cls)
+        order.timestamp = timestamp
+        order.quantity = quantity
+        order.price = price
+        order.order_id = order_id
+        order.trade_id = trade_id
+        order.next_order = None
+        order.prev_order = None
+        order.order_list = order_list
+        order.account = account
+        order.side = side
+        order.baseAsset = base_asset
+        order.quoteAsset = quote_asset
+        return order
+
     # helper functions to get Orders in linked list
     def next_order(self):
         return self.next_order
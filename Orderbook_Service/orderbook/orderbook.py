@@ -4,23 +4,57 @@ from collections import deque # a faster insert/pop queue
 from six.moves import cStringIO as StringIO
 from decimal import Decimal
 import json
+import functools
 from .ordertree import OrderTree
-import time
+from .trades import TradeStore
+from .stats import MarketStats
+from .stops import TriggerBook
+from .clock import wall_clock
+from .commitment import BookCommitment
 
 class OrderBook(object):
-    def __init__(self, tick_size = 0.0001):
+    def __init__(self, tick_size = 0.0001, clock=wall_clock):
         self.tape = deque(maxlen=None) # Index[0] is most recent trade
+        self.trades = TradeStore() # Time-indexed trade history and candles
+        self.stats = MarketStats() # Last price, VWAP and rolling 24h statistics
         self.bids = OrderTree()
         self.asks = OrderTree()
+        # Merkle commitment over the resting orders, see commitment.py
+        self.commitment = BookCommitment(self.bids, self.asks)
+        self.bids.on_touch = functools.partial(self.commitment.touch, 'bid')
+        self.asks.on_touch = functools.partial(self.commitment.touch, 'ask')
         self.last_tick = None
         self.last_timestamp = 0
         self.tick_size = tick_size
         self.time = 0
         self.next_order_id = 0
+        # Bumped on every operation that can change the book, lets callers
+        # cache anything derived from it, see refresh_top_of_book
+        self.sequence = 0
+        # Cached best order per side, see refresh_top_of_book
+        self.top_of_book = {'bid': None, 'ask': None}
+        # Optional callable(order_book) run when the best price or the volume
+        # at the best price of either side changes
+        self.on_top_change = None
+        self.last_top = None
+        # Optional BookLimits capping resting orders, levels, stops and the tape
+        self.limits = None
+        # Pending stop and stop-limit orders, and the range of prices traded
+        # since stops were last released
+        self.stops = TriggerBook()
+        self.print_high = None
+        self.print_low = None
+        # Callable returning the time in milliseconds, see clock.py
+        self.clock = clock
 
     def update_time(self):
-        # self.time += 1
-        self.time = int(time.time() * 1000) # convert to milliseconds
+        self.time = self.clock()
+
+    def now(self):
+        '''Current time for reads, which must not advance a LogicalClock:
+        interleaved reads would change the timestamps of later writes.'''
+        peek = getattr(self.clock, 'peek', None)
+        return peek() if peek is not None else self.clock()
 
     def process_order(self, quote, from_data, verbose):
         order_type = quote['type']
@@ -47,14 +81,93 @@ class OrderBook(object):
                     "success": False,
                     "message": str(e)
                 }
+        elif order_type in ('stop', 'stop_limit'):
+            try:
+                order_in_book = self.place_stop(quote, from_data)
+            except Exception as e:
+                return {
+                    "success": False,
+                    "message": str(e)
+                }
+            trades = []
         else:
-            sys.exit("order_type for process_order() is neither 'market' or 'limit'")
-        
+            sys.exit("order_type for process_order() is neither 'market', 'limit', 'stop' or 'stop_limit'")
+
+        triggered = self.release_stops()
+        self.refresh_top_of_book()
         return {
             "success": True,
-            "data": [trades, order_in_book, task_id, next_best_order]
+            "data": [trades, order_in_book, task_id, next_best_order],
+            "triggered": triggered
         }
 
+    def place_stop(self, quote, from_data):
+        '''Add a stop ('stop', becomes a limit order at the best opposite
+        price) or stop-limit order ('stop_limit', becomes a limit order at
+        quote['price']) to the trigger book. A stop that the last trade has already reached is rejected.'''
+        side = quote['side']
+        if side not in ('bid', 'ask'):
+            raise Exception('side must be "bid" or "ask"')
+        quote['stopPrice'] = Decimal(quote['stopPrice'])
+        if quote['type'] == 'stop_limit':
+            quote['price'] = Decimal(quote['price'])
+        last_price = self.stats.last_price
+        if last_price is not None and (quote['stopPrice'] <= last_price if side == 'bid'
+                                       else quote['stopPrice'] >= last_price):
+            raise Exception("Stop price has already been reached by the last trade")
+        if self.limits is not None:
+            self.limits.check_stop(self.stops)
+        if not from_data:
+            quote['order_id'] = self.next_order_id
+        self.stops.add(quote)
+        return quote
+
+    def cancel_stop(self, order_id):
+        '''Remove a pending stop; returns its quote, or None if unknown.'''
+        return self.stops.remove(order_id)
+
+    def release_stops(self):
+        '''
+        Run the stops triggered by the trades printed since the last call, and
+        the stops triggered in turn by their trades, until none is left. Each
+        round releases stops in TriggerBook.triggered order, so the outcome
+        only depends on the order flow. Returns one result per stop run.
+        '''
+        results = []
+        while self.print_high is not None:
+            high, low = self.print_high, self.print_low
+            self.print_high = self.print_low = None
+            for quote in self.stops.triggered(high, low):
+                results.append(self._run_stop(quote))
+        return results
+
+    def _run_stop(self, quote):
+        # A stop is run as a limit order at the best opposite price, so like
+        # any order it fills against the best order only (funds are locked
+        # on-chain for that order alone) and is rejected if it is larger
+        quote['timestamp'] = self.time
+        stop_type = quote['type']
+        order_in_book = None
+        task_id = 0
+        next_best_order = None
+        if stop_type == 'stop':
+            opposite = self.asks if quote['side'] == 'bid' else self.bids
+            if not opposite:
+                return {'order_id': quote['order_id'], 'type': stop_type, 'success': False,
+                        'message': 'No order to fill the stop order against', 'quote': quote,
+                        'trades': [], 'order': None, 'task_id': 0, 'next_best_order': None}
+            quote['price'] = opposite.min_price() if quote['side'] == 'bid' else opposite.max_price()
+        quote['type'] = 'limit'
+        try:
+            # from_data keeps the order id the stop was given
+            trades, order_in_book, task_id, next_best_order = self.process_limit_order(quote, True, False)
+        except Exception as e:
+            return {'order_id': quote['order_id'], 'type': stop_type, 'success': False, 'message': str(e),
+                    'quote': quote, 'trades': [], 'order': None, 'task_id': 0, 'next_best_order': None}
+        return {'order_id': quote['order_id'], 'type': stop_type, 'success': True, 'quote': quote,
+                'trades': trades, 'order': order_in_book, 'task_id': task_id,
+                'next_best_order': next_best_order}
+
     def process_order_list(self, side, order_list, quantity_still_to_trade, quote, verbose):
         '''
         Takes an OrderList (stack of orders at one price) and an incoming order and matches
@@ -72,20 +185,23 @@ class OrderBook(object):
                 # Do the transaction
                 new_book_quantity = head_order.quantity - quantity_to_trade
                 head_order.update_quantity(new_book_quantity, head_order.timestamp)
-                quantity_to_trade = 0
-            elif quantity_to_trade == head_order.quantity:
-                traded_quantity = quantity_to_trade
+                # update_quantity only adjusts the OrderList volume
                 if side == 'bid':
-                    self.bids.remove_order_by_id(head_order.order_id)
+                    self.bids.volume -= quantity_to_trade
+                    self.bids.touch(head_order.order_id)
                 else:
-                    self.asks.remove_order_by_id(head_order.order_id)
+                    self.asks.volume -= quantity_to_trade
+                    self.asks.touch(head_order.order_id)
                 quantity_to_trade = 0
-            else: # quantity to trade is larger than the head order
+            else: # quantity to trade covers the head order
                 traded_quantity = head_order.quantity
-                if side == 'bid':
-                    self.bids.remove_order_by_id(head_order.order_id)
+                tree = self.bids if side == 'bid' else self.asks
+                if head_order.hidden:
+                    # Iceberg slice filled, the order stays with its next slice
+                    tree.replenish_order(head_order, self.time)
+                    new_book_quantity = head_order.quantity
                 else:
-                    self.asks.remove_order_by_id(head_order.order_id)
+                    tree.remove_order_by_id(head_order.order_id)
                 quantity_to_trade -= traded_quantity
             if verbose:
                 print(("TRADE: Time - {}, Price - {}, Quantity - {}, TradeID - {}, Matching TradeID - {}".format(self.time, traded_price, traded_quantity, counter_party, quote['trade_id'])))
@@ -105,6 +221,13 @@ class OrderBook(object):
                 transaction_record['party2'] = [quote['trade_id'], 'bid', None, None]
 
             self.tape.append(transaction_record)
+            self.trades.record(self.time, traded_price, traded_quantity,
+                               'ask' if side == 'bid' else 'bid', head_order.order_id)
+            self.stats.record(self.time, traded_price, traded_quantity)
+            if self.print_high is None or traded_price > self.print_high:
+                self.print_high = traded_price
+            if self.print_low is None or traded_price < self.print_low:
+                self.print_low = traded_price
             trades.append(transaction_record)
         return quantity_to_trade, trades
                     
@@ -143,6 +266,10 @@ class OrderBook(object):
 
         if quantity_to_trade <= 0:
             raise Exception("No orders of size 0 or less")
+        if quote.get('displayQuantity') is not None:
+            quote['displayQuantity'] = Decimal(quote['displayQuantity'])
+            if quote['displayQuantity'] <= 0:
+                raise Exception("Display quantity must be greater than 0")
 
         if side == 'bid':
             # If we have asks, and we cross the spread, and we're covering more than one order, reject
@@ -155,7 +282,10 @@ class OrderBook(object):
                     # Complete fill
                     task_id = 4
                     if (len(min_price_orders) > 1):
-                        next_best_order = min_price_orders[1]
+                        next_best_order = min_price_orders.head_order.next_order
+                    elif min_price_orders.head_order.hidden:
+                        # An iceberg alone at its level is its own next best order
+                        next_best_order = min_price_orders.head_order
                 else:
                     # More than one order covered, reject this for now
                     # This is disabled for now as we only track and lock funds for the best order on-chain
@@ -166,6 +296,9 @@ class OrderBook(object):
                     task_id = 2
                 else:
                     task_id = 1
+                # The order will rest, make sure the book has room for it
+                if self.limits is not None:
+                    self.limits.check(self.bids, price)
 
             # Some of this is redundant now but should still work
             while (self.asks and price >= self.asks.min_price() and quantity_to_trade > 0):
@@ -191,6 +324,9 @@ class OrderBook(object):
                     task_id = 4
                     if (len(max_price_orders) > 1):
                         next_best_order = max_price_orders.head_order.next_order
+                    elif max_price_orders.head_order.hidden:
+                        # An iceberg alone at its level is its own next best order
+                        next_best_order = max_price_orders.head_order
                 else:
                     # More than one order covered, reject this for now
                     # This is disabled for now as we only track and lock funds for the best order on-chain
@@ -200,6 +336,8 @@ class OrderBook(object):
                     task_id = 2
                 else:
                     task_id = 1
+                if self.limits is not None:
+                    self.limits.check(self.asks, price)
 
             # Partly redundant but should still work
             while (self.bids and price <= self.bids.max_price() and quantity_to_trade > 0):
@@ -232,6 +370,7 @@ class OrderBook(object):
                 self.asks.remove_order_by_id(order_id)
         else:
             sys.exit('cancel_order() given neither "bid" nor "ask"')
+        self.refresh_top_of_book()
 
     def modify_order(self, order_id, order_update, time=None):
         if time:
@@ -249,6 +388,130 @@ class OrderBook(object):
                 self.asks.update_order(order_update)
         else:
             sys.exit('modify_order() given neither "bid" nor "ask"')
+        self.refresh_top_of_book()
+
+    def amend_order(self, side, order_id, quantity=None, price=None):
+        '''
+        Amend the quantity and/or price of a resting order in place (see
+        OrderTree.amend_order): reducing the size keeps time priority, a
+        price change relinks the same Order object at the new level.
+
+        A new price that would cross the spread is rejected, such an amend
+        has to go through cancel_replace so it can match. Returns the same
+        success/message/data dict as process_order, data being the Order.
+
+        For an iceberg order quantity is its total size: the displayed slice
+        is refilled up to its peak from it and the rest kept in reserve.
+        '''
+        if side == 'bid':
+            tree, opposite = self.bids, self.asks
+        elif side == 'ask':
+            tree, opposite = self.asks, self.bids
+        else:
+            return {"success": False, "message": 'side must be "bid" or "ask"'}
+        if not tree.order_exists(order_id):
+            return {"success": False, "message": "Order not found"}
+        order = tree.get_order(order_id)
+        quantity = order.quantity + order.hidden if quantity is None else Decimal(quantity)
+        price = order.price if price is None else Decimal(price)
+        if quantity <= 0:
+            return {"success": False, "message": "No orders of size 0 or less"}
+        if price != order.price:
+            if opposite and (price >= opposite.min_price() if side == 'bid' else price <= opposite.max_price()):
+                return {"success": False, "message": "Amended price crosses the spread, use cancel-replace"}
+            if self.limits is not None:
+                try:
+                    self.limits.check(tree, price, new_order=False)
+                except Exception as e:
+                    return {"success": False, "message": str(e)}
+        self.update_time()
+        if order.peak is not None:
+            order.hidden = quantity - min(order.peak, quantity)
+            quantity -= order.hidden
+        tree.amend_order(order_id, price, quantity, self.time)
+        self.refresh_top_of_book()
+        return {"success": True, "data": order}
+
+    def cancel_replace(self, side, order_id, quote):
+        '''
+        Cancel a resting order and process quote in its place, atomically: if
+        the new order is rejected, the old one is put back exactly where it
+        was in its queue. Returns process_order's result, with the cancelled
+        Order added as "cancelled" on success.
+        '''
+        tree = self.bids if side == 'bid' else self.asks
+        if side not in ('bid', 'ask') or not tree.order_exists(order_id):
+            return {"success": False, "message": "Order not found"}
+        if quote['quantity'] <= 0:
+            return {"success": False, "message": "No orders of size 0 or less"}
+        order = tree.get_order(order_id)
+        prev_order = order.prev_order
+        tree.remove_order_by_id(order_id)
+        # process_order only rejects an order before it touches the book
+        result = self.process_order(quote, False, False)
+        if not result["success"]:
+            tree.restore_order(order, prev_order)
+            self.refresh_top_of_book()
+            return result
+        result["cancelled"] = order
+        return result
+
+    def refresh_top_of_book(self):
+        '''Bring the cached best order of each side up to date.
+
+        Called after every operation that can touch the book. The best order
+        is only re-serialized when the head order of the best level, or its
+        price/quantity/timestamp, differs from the cached one, so the cost on
+        an unchanged side is a single price lookup.
+        '''
+        self.sequence += 1
+        best_bids = self.bids.max_price_list()
+        best_asks = self.asks.min_price_list()
+        self._refresh_side('bid', best_bids)
+        self._refresh_side('ask', best_asks)
+        if self.on_top_change is not None:
+            top = (self.bids.max_price(), best_bids.volume if best_bids is not None else 0,
+                   self.asks.min_price(), best_asks.volume if best_asks is not None else 0)
+            if top != self.last_top:
+                self.last_top = top
+                self.on_top_change(self)
+
+    def _refresh_side(self, side, price_list):
+        head_order = price_list.head_order if price_list is not None else None
+        cached = self.top_of_book[side]
+        if head_order is None:
+            self.top_of_book[side] = None
+            return
+        if (cached is not None and cached['head_order'] is head_order
+                and cached['price'] == head_order.price
+                and cached['quantity'] == head_order.quantity
+                and cached['timestamp'] == head_order.timestamp):
+            return
+        order_dict = {
+            'order_id': int(head_order.order_id),
+            'account': head_order.account,
+            'price': float(head_order.price),
+            'quantity': float(head_order.quantity),
+            'side': head_order.side,
+            'baseAsset': head_order.baseAsset,
+            'quoteAsset': head_order.quoteAsset,
+            'trade_id': head_order.trade_id,
+            'trades': [],
+            'isValid': True,
+            'timestamp': head_order.timestamp
+        }
+        self.top_of_book[side] = {
+            'head_order': head_order,
+            'price': head_order.price,
+            'quantity': head_order.quantity,
+            'timestamp': head_order.timestamp,
+            'order': order_dict,
+            'encoded': json.dumps(order_dict, separators=(',', ':')).encode('utf-8')
+        }
+
+    def get_top_of_book(self, side):
+        '''Cached best order record for side, or None if that side is empty.'''
+        return self.top_of_book[side]
 
     def get_volume_at_price(self, side, price):
         price = Decimal(price)
@@ -309,15 +572,105 @@ class OrderBook(object):
         tempfile.write("\n")
         return tempfile.getvalue()
 
+    def get_market_stats(self):
+        return self.stats.snapshot(self.now())
+
+    def get_orders_page(self, side, cursor=None, start_price=None, limit=100):
+        '''
+        One page of the resting orders of side, best price first and in time
+        priority within a level. Returns (orders, next_cursor); next_cursor is
+        None on the last page.
+
+        The cursor names the last order returned and the timestamp it had
+        ("price:order_id:timestamp"). When that order still rests at that
+        price with that timestamp, the next page starts right after it, from
+        order_map. An order that left the book, moved to another price or was
+        sent to the back of its queue (a larger amend, an iceberg refill)
+        cannot say where it was. Orders queue in (timestamp, order_id) order,
+        so the page resumes in the cursor's level after the orders that come
+        no later than the cursor's, which were on earlier pages. Orders are
+        never skipped and only an order sent to the back of its queue since it
+        was returned is returned again (with a cursor without timestamp, the
+        whole level is). Orders are read straight from price_map and the
+        OrderList links, so a page only touches the orders it returns.
+        '''
+        if side == 'bid':
+            tree = self.bids
+        elif side == 'ask':
+            tree = self.asks
+        else:
+            raise ValueError('side must be "bid" or "ask"')
+        descending = side == 'bid'
+        order = None
+        # Price, timestamp and order_id of the cursor, when it left its place
+        skip_through = None
+        if cursor is not None:
+            fields = cursor.split(':')
+            if len(fields) not in (2, 3):
+                raise ValueError('Invalid cursor')
+            price = Decimal(fields[0])
+            order_id = int(fields[1])
+            timestamp = int(fields[2]) if len(fields) == 3 else None
+            resting = tree.order_map.get(order_id)
+            if (resting is not None and resting.price == price
+                    and (timestamp is None or resting.timestamp == timestamp)):
+                order = resting.next_order
+                inclusive = (True, False) if descending else (False, True)
+            else:
+                inclusive = (True, True)
+                if timestamp is not None:
+                    skip_through = (price, timestamp, order_id)
+            if descending:
+                prices = tree.price_map.irange(maximum=price, inclusive=inclusive, reverse=True)
+            else:
+                prices = tree.price_map.irange(minimum=price, inclusive=inclusive)
+        elif start_price is not None:
+            price = Decimal(start_price)
+            if descending:
+                prices = tree.price_map.irange(maximum=price, reverse=True)
+            else:
+                prices = tree.price_map.irange(minimum=price)
+        else:
+            prices = reversed(tree.prices) if descending else iter(tree.prices)
+
+        orders = []
+        last = None
+        while len(orders) < limit:
+            if order is None:
+                price = next(prices, None)
+                if price is None:
+                    break
+                order = tree.get_price_list(price).head_order
+                if skip_through is not None:
+                    if price == skip_through[0]:
+                        while order is not None and (order.timestamp, order.order_id) <= skip_through[1:]:
+                            order = order.next_order
+                    skip_through = None
+                continue
+            orders.append({
+                "price": float(order.price),
+                "amount": float(order.quantity),
+                "total": float(order.price * order.quantity),
+                "account": order.account,
+                "orderId": order.order_id
+            })
+            last = order
+            order = order.next_order
+        if last is None or (order is None and next(prices, None) is None):
+            return orders, None
+        return orders, '%s:%d:%d' % (last.price, last.order_id, last.timestamp)
+
     def get_orderbook(self, symbol):
         base_asset = symbol.split("_")[0]
         quote_asset = symbol.split("_")[1]
+        stats = self.get_market_stats()
 
         orderbook = {
             "baseAsset": base_asset,
             "quoteAsset": quote_asset,
-            # "lastTradePrice": 95362.08,
-            # "priceChangeIndicator": "up",
+            "lastTradePrice": stats["lastTradePrice"],
+            "priceChangeIndicator": stats["priceChangeIndicator"],
+            "stats": stats,
             "asks": [],
             "bids": []
         }
@@ -55,31 +55,66 @@ class OrderList(object):
         self.volume += order.quantity
 
     def remove_order(self, order):
+        '''Unlink order from the list.
+
+        The removed Order's own links and its order_list back-reference are
+        cleared too, and so are head_order/tail_order when it was the last
+        one, so that nothing in the book keeps a removed order (or, through
+        it, its old neighbours) alive, and no reference cycle is left for
+        the cyclic GC to find.
+        '''
         self.volume -= order.quantity
         self.length -= 1
-        if len(self) == 0: # if there are no more Orders, stop/return
-            return
 
         # Remove an Order from the OrderList. First grab next / prev order
         # from the Order we are removing. Then relink everything. Finally
         # remove the Order.
         next_order = order.next_order
         prev_order = order.prev_order
-        if next_order != None and prev_order != None:
-            next_order.prev_order = prev_order
+        if prev_order is not None:
             prev_order.next_order = next_order
-        elif next_order != None: # There is no previous order
-            next_order.prev_order = None
+        else: # There is no previous order
             self.head_order = next_order # The next order becomes the first order in the OrderList after this Order is removed
-        elif prev_order != None: # There is no next order
-            prev_order.next_order = None
+        if next_order is not None:
+            next_order.prev_order = prev_order
+        else: # There is no next order
             self.tail_order = prev_order # The previous order becomes the last order in the OrderList after this Order is removed
+        if self.last is order:
+            # Removed while iterating, carry on with the order behind it
+            self.last = next_order
+        order.next_order = None
+        order.prev_order = None
+        order.order_list = None
+
+    def insert_after(self, order, prev_order):
+        '''Link order back in right behind prev_order, or at the head if
+        prev_order is None. Used to put a removed order back in its place.'''
+        if prev_order is None:
+            order.prev_order = None
+            order.next_order = self.head_order if len(self) > 0 else None
+            if order.next_order is not None:
+                order.next_order.prev_order = order
+            else:
+                self.tail_order = order
+            self.head_order = order
+        else:
+            order.prev_order = prev_order
+            order.next_order = prev_order.next_order
+            if order.next_order is not None:
+                order.next_order.prev_order = order
+            else:
+                self.tail_order = order
+            prev_order.next_order = order
+        self.length += 1
+        self.volume += order.quantity
 
     def move_to_tail(self, order):
         '''After updating the quantity of an existing Order, move it to the tail of the OrderList
 
         Check to see that the quantity is larger than existing, update the quantities, then move to tail.
         '''
+        if order is self.tail_order:
+            return
         if order.prev_order != None: # This Order is not the first Order in the OrderList
             order.prev_order.next_order = order.next_order # Link the previous Order to the next Order, then move the Order to tail
         else: # This Order is the first Order in the OrderList
@@ -1,7 +1,28 @@
+import functools
+import time
 from sortedcontainers import SortedDict
 from .orderlist import OrderList
 from .order import Order
 
+def _book_update(method):
+    '''Report the time spent in an OrderTree mutation to OrderTree.stage_timer
+    when one is installed. Nested mutations (insert_order replacing an existing
+    order, update_order re-inserting on a price change) are counted once.
+    '''
+    @functools.wraps(method)
+    def timed(self, *args):
+        timer = self.stage_timer
+        if timer is None or self._in_update:
+            return method(self, *args)
+        self._in_update = True
+        started = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            self._in_update = False
+            timer(time.perf_counter() - started)
+    return timed
+
 class OrderTree(object):
     '''A red-black tree used to store OrderLists in price order
 
@@ -9,6 +30,11 @@ class OrderTree(object):
     Keeping the information in a red black tree makes it easier/faster to detect a match.
     '''
 
+    # Callable taking elapsed seconds, installed on the class to time the
+    # book-update stage of every tree. None disables the timing.
+    stage_timer = None
+    _in_update = False
+
     def __init__(self):
         self.price_map = SortedDict() # Dictionary containing price : OrderList object
         self.prices = self.price_map.keys()
@@ -16,6 +42,13 @@ class OrderTree(object):
         self.volume = 0 # Contains total quantity from all Orders in tree
         self.num_orders = 0 # Contains count of Orders in tree
         self.depth = 0 # Number of different prices in tree (http://en.wikipedia.org/wiki/Order_book_(trading)#Book_depth)
+        # Optional callable(order_id), called after an order is inserted,
+        # changed or removed; see commitment.py
+        self.on_touch = None
+
+    def touch(self, order_id):
+        if self.on_touch is not None:
+            self.on_touch(order_id)
 
     def __len__(self):
         return len(self.order_map)
@@ -41,6 +74,7 @@ class OrderTree(object):
     def order_exists(self, order):
         return order in self.order_map
 
+    @_book_update
     def insert_order(self, quote):
         if self.order_exists(quote['order_id']):
             self.remove_order_by_id(quote['order_id'])
@@ -51,30 +85,122 @@ class OrderTree(object):
         self.price_map[order.price].append_order(order) # Add the order to the OrderList in Price Map
         self.order_map[order.order_id] = order
         self.volume += order.quantity
+        self.touch(order.order_id)
+
+    def bulk_load(self, levels):
+        '''Replace the contents of the tree with pre-built price levels.
 
+        levels is a sequence of (price, OrderList) pairs whose OrderLists are
+        already linked up. No matching is done and the SortedDict is built in
+        one pass instead of one insert per order.
+        '''
+        removed = list(self.order_map)
+        self.price_map = SortedDict(levels)
+        self.prices = self.price_map.keys()
+        self.order_map = {}
+        self.volume = 0
+        self.num_orders = 0
+        for order_list in self.price_map.values():
+            order = order_list.head_order
+            while order is not None:
+                self.order_map[order.order_id] = order
+                order = order.next_order
+            self.volume += order_list.volume
+            self.num_orders += order_list.length
+        self.depth = len(self.price_map)
+        if self.on_touch is not None:
+            for order_id in removed:
+                self.on_touch(order_id)
+            for order_id in self.order_map:
+                self.on_touch(order_id)
+
+    @_book_update
     def update_order(self, order_update):
         order = self.order_map[order_update['order_id']]
-        original_quantity = order.quantity
         if order_update['price'] != order.price:
-            # Price changed. Remove order and update tree.
-            order_list = self.price_map[order.price]
-            order_list.remove_order(order)
-            if len(order_list) == 0: # If there is nothing else in the OrderList, remove the price from RBtree
-                self.remove_price(order.price)
+            # Price changed. Remove order and update tree. Going through
+            # remove_order_by_id keeps volume and num_orders in step.
+            self.remove_order_by_id(order.order_id)
             self.insert_order(order_update)
         else:
             # Quantity changed. Price is the same.
+            original_quantity = order.quantity
             order.update_quantity(order_update['quantity'], order_update['timestamp'])
-        self.volume += order.quantity - original_quantity
+            self.volume += order.quantity - original_quantity
+            self.touch(order.order_id)
+
+    @_book_update
+    def amend_order(self, order_id, price, quantity, timestamp):
+        '''Amend a resting order without reallocating it.
+
+        At the same price, a smaller quantity is changed in place and keeps
+        the order's queue position and timestamp; a larger one sends it to
+        the back of the queue. On a price change the order is unlinked from
+        its OrderList and appended to the one at the new price.
+        '''
+        order = self.order_map[order_id]
+        if price != order.price:
+            old_list = order.order_list
+            old_list.remove_order(order)
+            if len(old_list) == 0:
+                self.remove_price(order.price)
+            if price not in self.price_map:
+                self.create_price(price)
+            self.volume += quantity - order.quantity
+            order.price = price
+            order.quantity = quantity
+            order.timestamp = timestamp
+            order.order_list = self.price_map[price]
+            order.order_list.append_order(order)
+        elif quantity < order.quantity:
+            order.order_list.volume -= order.quantity - quantity
+            self.volume -= order.quantity - quantity
+            order.quantity = quantity
+        elif quantity > order.quantity:
+            self.volume += quantity - order.quantity
+            order.update_quantity(quantity, timestamp)
+        self.touch(order_id)
+        return order
+
+    @_book_update
+    def replenish_order(self, order, timestamp):
+        '''Show the next slice of an iceberg order whose displayed quantity
+        just filled, taken from its reserve, and send it to the back of its
+        queue like a fresh order. O(1): the same Order stays in order_map and
+        in its OrderList, and price_map is not touched.'''
+        shown = min(order.peak, order.hidden)
+        order.hidden -= shown
+        order.order_list.volume += shown - order.quantity
+        self.volume += shown - order.quantity
+        order.quantity = shown
+        order.timestamp = timestamp
+        order.order_list.move_to_tail(order)
+        self.touch(order.order_id)
+
+    @_book_update
+    def restore_order(self, order, prev_order):
+        '''Put back an order removed by remove_order_by_id, right behind
+        prev_order (its neighbour before removal), as if it never left.'''
+        if order.price not in self.price_map:
+            self.create_price(order.price)
+        order.order_list = self.price_map[order.price]
+        order.order_list.insert_after(order, prev_order)
+        self.order_map[order.order_id] = order
+        self.num_orders += 1
+        self.volume += order.quantity
+        self.touch(order.order_id)
 
+    @_book_update
     def remove_order_by_id(self, order_id):
         self.num_orders -= 1
         order = self.order_map[order_id]
         self.volume -= order.quantity
-        order.order_list.remove_order(order)
-        if len(order.order_list) == 0:
+        order_list = order.order_list
+        order_list.remove_order(order)
+        if len(order_list) == 0:
             self.remove_price(order.price)
         del self.order_map[order_id]
+        self.touch(order_id)
 
     def max_price(self):
         if self.depth > 0:
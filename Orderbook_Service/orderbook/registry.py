@@ -0,0 +1,167 @@
+import threading
+import time
+from collections import OrderedDict
+from .orderbook import OrderBook
+from .address import canonical_asset
+
+
+class RegistryFull(Exception):
+    pass
+
+
+def split_symbol(symbol):
+    '''Split a base_quote symbol into canonical (base, quote), or None if the
+    symbol is not of that form.'''
+    if not isinstance(symbol, str):
+        return None
+    parts = symbol.split('_')
+    if len(parts) != 2 or not parts[0] or not parts[1]:
+        return None
+    return canonical_asset(parts[0]), canonical_asset(parts[1])
+
+
+def canonical_symbol(symbol):
+    assets = split_symbol(symbol)
+    if assets is None:
+        return None
+    return '%s_%s' % assets
+
+
+def make_symbol(base_asset, quote_asset):
+    return '%s_%s' % (canonical_asset(base_asset), canonical_asset(quote_asset))
+
+
+class SymbolRegistry(object):
+    '''
+    Owns the OrderBook of every market, keyed by canonical symbol (see
+    canonical_symbol), so case variants of the same token pair share a book.
+
+    Reads never allocate: get() returns None for a market that does not
+    exist yet. Books are only created by get_or_create(), which is used on
+    the order path. Configured markets are created up front and kept forever;
+    any other book that holds no orders and no trades, and has not been used
+    for idle_seconds, is evicted when a new book would exceed max_books.
+    '''
+
+    def __init__(self, markets=(), max_books=1000, idle_seconds=300, clock=time.monotonic):
+        self.books = OrderedDict()  # symbol : OrderBook, least recently used first
+        self.last_used = {}  # symbol : clock() of last access
+        self.pinned = set()
+        self.max_books = max_books
+        self.idle_seconds = idle_seconds
+        self.clock = clock
+        self.evicted = 0
+        self.lock = threading.Lock()
+        # Objects with add_book(symbol, order_book) and remove_book(symbol),
+        # told about every book entering or leaving the registry
+        self.listeners = []
+        for symbol in markets:
+            symbol = canonical_symbol(symbol)
+            if symbol is None:
+                raise ValueError('Invalid market symbol')
+            self.pinned.add(symbol)
+            self.books[symbol] = OrderBook()
+            self.last_used[symbol] = clock()
+
+    def __len__(self):
+        return len(self.books)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+        for symbol, order_book in self.items():
+            listener.add_book(symbol, order_book)
+
+    def __contains__(self, symbol):
+        return canonical_symbol(symbol) in self.books
+
+    def items(self):
+        return list(self.books.items())
+
+    def _touch(self, symbol):
+        self.last_used[symbol] = self.clock()
+        try:
+            self.books.move_to_end(symbol)
+        except KeyError:
+            # evicted concurrently
+            self.last_used.pop(symbol, None)
+
+    def get(self, symbol):
+        symbol = canonical_symbol(symbol)
+        order_book = self.books.get(symbol)
+        if order_book is not None:
+            self._touch(symbol)
+        return order_book
+
+    def get_or_create(self, symbol):
+        symbol = canonical_symbol(symbol)
+        if symbol is None:
+            raise ValueError('Invalid market symbol')
+        order_book = self.books.get(symbol)
+        if order_book is not None:
+            self._touch(symbol)
+            return order_book
+        with self.lock:
+            order_book = self.books.get(symbol)
+            if order_book is None:
+                if len(self.books) >= self.max_books:
+                    self._evict_idle()
+                if len(self.books) >= self.max_books:
+                    raise RegistryFull('Too many markets, cannot open %s' % symbol)
+                order_book = OrderBook()
+                self.books[symbol] = order_book
+                for listener in self.listeners:
+                    listener.add_book(symbol, order_book)
+            self._touch(symbol)
+            return order_book
+
+    def add(self, symbol, order_book):
+        '''Register an existing book, e.g. one loaded from a snapshot.'''
+        symbol = canonical_symbol(symbol)
+        if symbol is None:
+            raise ValueError('Invalid market symbol')
+        with self.lock:
+            replaced = symbol in self.books
+            self.books[symbol] = order_book
+            self._touch(symbol)
+            for listener in self.listeners:
+                if replaced:
+                    listener.remove_book(symbol)
+                listener.add_book(symbol, order_book)
+
+    def remove(self, symbol):
+        '''Drop a book regardless of its contents, e.g. to mirror an eviction
+        done elsewhere. Returns whether it was there.'''
+        symbol = canonical_symbol(symbol)
+        with self.lock:
+            if self.books.pop(symbol, None) is None:
+                return False
+            self.last_used.pop(symbol, None)
+            for listener in self.listeners:
+                listener.remove_book(symbol)
+            return True
+
+    def is_evictable(self, symbol, order_book):
+        return (symbol not in self.pinned
+                and len(order_book.bids) == 0 and len(order_book.asks) == 0
+                and len(order_book.tape) == 0 and len(order_book.stops) == 0)
+
+    def _evict_idle(self):
+        # Oldest first; stop at the first book that was used too recently,
+        # everything after it in the OrderedDict is more recent still.
+        cutoff = self.clock() - self.idle_seconds
+        evicted = 0
+        for symbol, order_book in list(self.books.items()):
+            if self.last_used.get(symbol, 0) > cutoff:
+                break
+            if self.is_evictable(symbol, order_book):
+                del self.books[symbol]
+                del self.last_used[symbol]
+                for listener in self.listeners:
+                    listener.remove_book(symbol)
+                evicted += 1
+        self.evicted += evicted
+        return evicted
+
+    def evict_idle(self):
+        with self.lock:
+            return self._evict_idle()
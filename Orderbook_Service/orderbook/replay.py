@@ -0,0 +1,323 @@
+'''
+Offline replay of recorded order flow, for backtests, what-if runs with
+different book parameters, and checking that two nodes that saw the same
+orders reached the same state.
+
+A log is a sequence of records, one per operation:
+
+    {"op": "order", "symbol": "WETH_USDC", "type": "limit", "side": "bid",
+     "price": "1800.5", "quantity": "2", "order_id": 17, "timestamp": 1700000000000,
+     "trade_id": "0xabc", "account": "0xabc"}
+    {"op": "cancel", "symbol": "WETH_USDC", "side": "bid", "order_id": 17, "timestamp": ...}
+    {"op": "cancel_stop", "symbol": "WETH_USDC", "order_id": 18}
+
+op defaults to "order"; stop and stop_limit orders also carry "stopPrice" and
+iceberg orders "displayQuantity".
+Logs are either NDJSON, one record per line, or the binary format written by
+write_binary (see RECORD). read_log tells them apart by the magic bytes.
+
+Orders are run through process_order with from_data=True, so they keep their
+recorded ids and timestamps, at full speed, on books whose clock is a
+LogicalClock: nothing in a replay reads the wall clock. Records without a
+timestamp are stamped from that clock and records without an order id get
+the next id of their book, so any log replays the same way every time.
+
+After every step replay() yields a digest: a sha256 chained over the previous
+digest and the outcome of the step (trades, resting order, triggered stops,
+rejection). Equal digests at step n mean both runs matched identically up
+to n, and the first differing step is where two runs diverged.
+
+Independent runs, e.g. one per symbol or one per set of BookLimits, can be
+fanned out over a process pool with replay_many, or from the command line:
+
+    python -m orderbook.replay flow.ndjson --split-symbols --processes 4
+    python -m orderbook.replay flow.ndjson --limits "*=1000::" --digests steps.txt
+'''
+import argparse
+import hashlib
+import json
+import struct
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+from .orderbook import OrderBook
+from .clock import LogicalClock
+from .memory import parse_book_limits, BookLimitPolicy
+from .registry import canonical_symbol, split_symbol
+
+MAGIC = b'OBLOG001'
+
+# op, side, order type, body size in bytes, order id, timestamp; the body
+# holds the BODY_FIELDS as NUL separated utf-8 strings, empty for None
+RECORD = struct.Struct('<BBBxIqq')
+BODY_FIELDS = ('symbol', 'price', 'quantity', 'stopPrice', 'trade_id', 'account', 'displayQuantity')
+NO_VALUE = -1 << 63  # order id or timestamp not recorded
+
+OPS = ('order', 'cancel', 'cancel_stop')
+SIDES = ('bid', 'ask')
+ORDER_TYPES = ('limit', 'market', 'stop', 'stop_limit')
+DECIMAL_FIELDS = ('price', 'quantity', 'stopPrice', 'displayQuantity')
+
+GENESIS = b'\x00' * 32
+
+
+def read_ndjson(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line, parse_float=Decimal)
+
+
+def write_ndjson(records, f):
+    for record in records:
+        f.write(json.dumps(record, default=str, separators=(',', ':')) + '\n')
+
+
+def read_binary(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a binary order log')
+    while True:
+        header = f.read(RECORD.size)
+        if not header:
+            return
+        if len(header) < RECORD.size:
+            raise ValueError('Truncated order log')
+        op, side, order_type, size, order_id, timestamp = RECORD.unpack(header)
+        fields = f.read(size).decode('utf-8').split('\x00')
+        record = {'op': OPS[op], 'side': SIDES[side], 'type': ORDER_TYPES[order_type]}
+        if order_id != NO_VALUE:
+            record['order_id'] = order_id
+        if timestamp != NO_VALUE:
+            record['timestamp'] = timestamp
+        for name, value in zip(BODY_FIELDS, fields):
+            if value:
+                record[name] = value
+        yield record
+
+
+def write_binary(records, f):
+    f.write(MAGIC)
+    for record in records:
+        body = '\x00'.join('' if record.get(name) is None else str(record[name])
+                           for name in BODY_FIELDS).encode('utf-8')
+        order_id = record.get('order_id')
+        timestamp = record.get('timestamp')
+        f.write(RECORD.pack(OPS.index(record.get('op', 'order')),
+                            SIDES.index(record.get('side', 'bid')),
+                            ORDER_TYPES.index(record.get('type', 'limit')),
+                            len(body),
+                            NO_VALUE if order_id is None else int(order_id),
+                            NO_VALUE if timestamp is None else int(timestamp)))
+        f.write(body)
+
+
+def read_log(path):
+    '''Records of the NDJSON or binary log at path, streamed.'''
+    with open(path, 'rb') as f:
+        binary = f.read(len(MAGIC)) == MAGIC
+    if binary:
+        with open(path, 'rb') as f:
+            yield from read_binary(f)
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            yield from read_ndjson(f)
+
+
+def _decimal(value):
+    return value if isinstance(value, Decimal) else Decimal(str(value))
+
+
+def _text(value):
+    return None if value is None else str(value)
+
+
+def _order_outcome(order):
+    if order is None:
+        return None
+    return [order['order_id'], order['side'], _text(order.get('price')), _text(order['quantity'])]
+
+
+def _trades_outcome(trades):
+    return [[trade['timestamp'], _text(trade['price']), _text(trade['quantity']),
+             [_text(value) for value in trade['party1']], [_text(value) for value in trade['party2']]]
+            for trade in trades]
+
+
+def step_outcome(op, result):
+    '''Everything about the result of one step that the digest covers.'''
+    if op == 'order':
+        if not result['success']:
+            return ['rejected', result['message']]
+        trades, order_in_book, task_id, _ = result['data']
+        triggered = [[stop['order_id'], stop['success'], stop.get('message'),
+                      _trades_outcome(stop['trades']), _order_outcome(stop['order'])]
+                     for stop in result['triggered']]
+        return ['order', task_id, _trades_outcome(trades), _order_outcome(order_in_book), triggered]
+    return [op, result]
+
+
+def step_digest(previous, outcome):
+    data = json.dumps(outcome, separators=(',', ':')).encode('utf-8')
+    return hashlib.sha256(previous + data).digest()
+
+
+class Replay(object):
+    '''
+    Replays records onto a book per symbol. books and limits
+    ({symbol: BookLimits}, see parse_book_limits) let a run start from
+    existing books or with different caps than the service.
+    '''
+
+    def __init__(self, books=None, limits=None, tick_size=0.0001):
+        self.books = {} if books is None else books
+        self.policy = BookLimitPolicy(limits or {})
+        self.tick_size = tick_size
+        self.digest = GENESIS
+        self.steps = 0
+        self.trades = 0
+        self.rejected = 0
+
+    def book(self, symbol):
+        order_book = self.books.get(symbol)
+        if order_book is None:
+            order_book = self.books[symbol] = OrderBook(self.tick_size, clock=LogicalClock())
+            self.policy.add_book(symbol, order_book)
+        return order_book
+
+    def apply(self, record):
+        '''Run one record; returns (symbol, outcome).'''
+        symbol = record.get('symbol', '')
+        symbol = canonical_symbol(symbol) or symbol
+        order_book = self.book(symbol)
+        op = record.get('op', 'order')
+        timestamp = record.get('timestamp')
+        if timestamp is None:
+            timestamp = order_book.clock()
+        elif isinstance(order_book.clock, LogicalClock):
+            order_book.clock.set(timestamp)
+        if op == 'order':
+            quote = {key: value for key, value in record.items() if key not in ('op', 'symbol')}
+            for name in DECIMAL_FIELDS:
+                if quote.get(name) is not None:
+                    quote[name] = _decimal(quote[name])
+            quote['timestamp'] = timestamp
+            if quote.get('order_id') is None:
+                order_book.next_order_id += 1
+                quote['order_id'] = order_book.next_order_id
+            quote.setdefault('trade_id', quote.get('account'))
+            assets = split_symbol(symbol) or (None, None)
+            quote.setdefault('baseAsset', assets[0])
+            quote.setdefault('quoteAsset', assets[1])
+            if quote['quantity'] <= 0:
+                # process_order exits on these
+                result = {'success': False, 'message': 'No orders of size 0 or less'}
+            else:
+                result = order_book.process_order(quote, True, False)
+            if result['success']:
+                self.trades += len(result['data'][0]) + sum(len(stop['trades']) for stop in result['triggered'])
+            else:
+                self.rejected += 1
+            return symbol, step_outcome(op, result)
+        if op == 'cancel':
+            tree = order_book.bids if record['side'] == 'bid' else order_book.asks
+            found = tree.order_exists(record['order_id'])
+            order_book.cancel_order(record['side'], record['order_id'], timestamp)
+            return symbol, step_outcome(op, [record['order_id'], found])
+        if op == 'cancel_stop':
+            return symbol, step_outcome(op, order_book.cancel_stop(record['order_id']) is not None)
+        raise ValueError('Unknown op %r' % op)
+
+    def run(self, records):
+        '''Replay records, yielding (step, symbol, digest) after each one.'''
+        for record in records:
+            symbol, outcome = self.apply(record)
+            self.digest = step_digest(self.digest, outcome)
+            self.steps += 1
+            yield self.steps, symbol, self.digest
+
+
+def replay_job(job):
+    '''
+    One replay run, described by a dict so that it can be sent to a pool
+    worker: path, and optionally symbols (only replay these), limits (book
+    limits spec, as ORDERBOOK_BOOK_LIMITS), tick_size and digests (file to
+    write "step symbol digest" lines to).
+    '''
+    symbols = job.get('symbols')
+    if symbols is not None:
+        symbols = set(canonical_symbol(symbol) or symbol for symbol in symbols)
+    replay = Replay(limits=parse_book_limits(job.get('limits') or ''),
+                    tick_size=job.get('tick_size', 0.0001))
+    records = read_log(job['path'])
+    if symbols is not None:
+        records = (record for record in records
+                   if (canonical_symbol(record.get('symbol', '')) or record.get('symbol', '')) in symbols)
+    started = time.perf_counter()
+    digests = open(job['digests'], 'w') if job.get('digests') else None
+    try:
+        for step, symbol, digest in replay.run(records):
+            if digests is not None:
+                digests.write('%d %s %s\n' % (step, symbol, digest.hex()))
+    finally:
+        if digests is not None:
+            digests.close()
+    seconds = time.perf_counter() - started
+    return {
+        'path': job['path'],
+        'symbols': sorted(symbols) if symbols is not None else sorted(replay.books),
+        'limits': job.get('limits'),
+        'steps': replay.steps,
+        'trades': replay.trades,
+        'rejected': replay.rejected,
+        'digest': replay.digest.hex(),
+        'seconds': seconds,
+        'stepsPerSecond': replay.steps / seconds if seconds else None
+    }
+
+
+def replay_many(jobs, processes=None):
+    '''Run independent replay jobs in a process pool, results in job order.'''
+    jobs = list(jobs)
+    if processes == 1 or len(jobs) == 1:
+        return [replay_job(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(replay_job, jobs))
+
+
+def log_symbols(path):
+    return sorted(set(canonical_symbol(record.get('symbol', '')) or record.get('symbol', '')
+                      for record in read_log(path)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a recorded order log deterministically.')
+    parser.add_argument('path', help='NDJSON or binary order log')
+    parser.add_argument('--symbol', action='append', help='only replay this symbol (repeatable)')
+    parser.add_argument('--split-symbols', action='store_true', help='one run per symbol, in parallel')
+    parser.add_argument('--limits', action='append',
+                        help='book limits spec, one run per spec (repeatable)')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--digests', help='write per-step digests here (single run only)')
+    parser.add_argument('--to-binary', metavar='OUT', help='convert the log to the binary format and exit')
+    args = parser.parse_args(argv)
+
+    if args.to_binary:
+        with open(args.to_binary, 'wb') as f:
+            write_binary(read_log(args.path), f)
+        return 0
+
+    symbol_sets = [[symbol] for symbol in log_symbols(args.path)] if args.split_symbols else [args.symbol]
+    jobs = [{'path': args.path, 'symbols': symbols, 'limits': limits}
+            for symbols in symbol_sets for limits in (args.limits or [None])]
+    if args.digests:
+        if len(jobs) > 1:
+            parser.error('--digests needs a single run')
+        jobs[0]['digests'] = args.digests
+    for result in replay_many(jobs, args.processes):
+        print(json.dumps(result))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,211 @@
+import heapq
+import itertools
+import threading
+from .registry import split_symbol
+
+
+class Edge(object):
+    '''
+    One direction of trading through a book. Selling the base asset walks
+    the bids, buying it with the quote asset walks the asks. rate is the
+    amount out per unit in at the best level and capacity the amount in that
+    the best level absorbs, both cached from the book's top of book.
+    '''
+
+    def __init__(self, symbol, order_book, sells_base):
+        self.symbol = symbol
+        self.order_book = order_book
+        self.sells_base = sells_base
+        self.rate = None
+        self.capacity = 0.0
+
+    def refresh(self):
+        if self.sells_base:
+            price = self.order_book.bids.max_price()
+            if price is None:
+                self.rate, self.capacity = None, 0.0
+            else:
+                self.rate = float(price)
+                self.capacity = float(self.order_book.bids.get_price_list(price).volume)
+        else:
+            price = self.order_book.asks.min_price()
+            if price is None:
+                self.rate, self.capacity = None, 0.0
+            else:
+                self.rate = 1.0 / float(price)
+                self.capacity = float(self.order_book.asks.get_price_list(price).volume * price)
+
+    def execute(self, amount_in):
+        '''Walk the book's levels and return the amount out for amount_in, or
+        None if the book is not deep enough.'''
+        if self.rate is not None and amount_in <= self.capacity:
+            return amount_in * self.rate  # fits in the best level
+        remaining = amount_in
+        amount_out = 0.0
+        if self.sells_base:
+            tree = self.order_book.bids
+            prices = reversed(tree.prices)
+        else:
+            tree = self.order_book.asks
+            prices = iter(tree.prices)
+        for price in prices:
+            level_price = float(price)
+            level_volume = float(tree.get_price_list(price).volume)
+            if self.sells_base:
+                filled = min(remaining, level_volume)
+                amount_out += filled * level_price
+            else:
+                filled = min(remaining, level_volume * level_price)
+                amount_out += filled / level_price
+            remaining -= filled
+            if remaining <= 0:
+                return amount_out
+        return None
+
+
+class RouteGraph(object):
+    '''
+    Graph of assets with one edge per book direction, used to price swaps
+    between assets that have no direct book (A/C and C/B for an A to B swap).
+
+    Edges cache the best rate and best-level capacity of their book and are
+    refreshed from OrderBook.on_top_change, so a query never scans books to
+    rank paths. A path is scored by the product of its best rates, an upper
+    bound on what it can return. Paths are searched best first: a partial
+    path is ranked by its score times the best product of rates from its
+    last asset to the target, so complete paths come out highest score first
+    and branches that cannot reach the target in the hops left are never
+    expanded. Books are only walked for the most promising paths, and the
+    search stops as soon as no remaining path can beat the best executable
+    result found so far.
+    '''
+
+    def __init__(self):
+        self.edges = {}  # asset : {asset : [Edge]}
+        self.books = {}  # symbol : (Edge selling base, Edge buying base)
+        self.lock = threading.Lock()
+
+    def add_book(self, symbol, order_book):
+        assets = split_symbol(symbol)
+        if assets is None:
+            return
+        base, quote = assets
+        sell = Edge(symbol, order_book, True)
+        buy = Edge(symbol, order_book, False)
+        sell.refresh()
+        buy.refresh()
+        with self.lock:
+            self.books[symbol] = (sell, buy)
+            self.edges.setdefault(base, {}).setdefault(quote, []).append(sell)
+            self.edges.setdefault(quote, {}).setdefault(base, []).append(buy)
+        order_book.on_top_change = lambda book: self.refresh_book(symbol)
+
+    def remove_book(self, symbol):
+        with self.lock:
+            edges = self.books.pop(symbol, None)
+            if edges is None:
+                return
+            base, quote = split_symbol(symbol)
+            self.edges[base][quote].remove(edges[0])
+            self.edges[quote][base].remove(edges[1])
+        edges[0].order_book.on_top_change = None
+
+    def refresh_book(self, symbol):
+        edges = self.books.get(symbol)
+        if edges is not None:
+            edges[0].refresh()
+            edges[1].refresh()
+
+    def _reach(self, target, max_hops):
+        # Copy of the edges that have a rate, and for each number of hops h
+        # the best product of rates from each asset to target in at most h
+        # hops. Repeated assets are allowed here, so it is an upper bound on
+        # what any simple path can do. Called with the lock held.
+        adjacency = {}
+        for asset, neighbours in self.edges.items():
+            out = [(neighbour, edge, edge.rate) for neighbour, edges in neighbours.items()
+                   for edge in edges if edge.rate is not None]
+            if out:
+                adjacency[asset] = out
+        reach = [{target: 1.0}]
+        for _ in range(max_hops):
+            previous = reach[-1]
+            current = {target: 1.0}
+            for asset, out in adjacency.items():
+                if asset == target:
+                    continue
+                best = None
+                for neighbour, edge, rate in out:
+                    if neighbour in previous and (best is None or rate * previous[neighbour] > best):
+                        best = rate * previous[neighbour]
+                if best is not None:
+                    current[asset] = best
+            reach.append(current)
+        return adjacency, reach
+
+    def _candidate_paths(self, source, target, max_hops):
+        # Best-first search over simple paths. Yields (score, path) for the
+        # complete paths in order of decreasing score, expanding only as many
+        # partial paths as the caller consumes.
+        if source == target:
+            return
+        with self.lock:
+            adjacency, reach = self._reach(target, max_hops)
+        if source not in reach[max_hops]:
+            return
+        order = itertools.count()
+        heap = [(-reach[max_hops][source], next(order), source, 1.0, (), frozenset((source,)))]
+        while heap:
+            _, _, asset, bound, path, visited = heapq.heappop(heap)
+            if asset == target:
+                yield bound, list(path)
+                continue
+            hops_left = max_hops - len(path) - 1
+            for neighbour, edge, rate in adjacency.get(asset, ()):
+                if neighbour in visited:
+                    continue
+                remaining = reach[hops_left].get(neighbour)
+                if remaining is None:
+                    continue  # target is out of reach in the hops left
+                next_bound = bound * rate
+                heapq.heappush(heap, (-next_bound * remaining, next(order), neighbour, next_bound,
+                                      path + (edge,), visited | {neighbour}))
+
+    def best_route(self, source, target, amount, max_hops=3):
+        '''
+        Best executable path to swap amount of source into target.
+
+        Returns None if no path can fill the amount, otherwise a dict with
+        amountOut, the average price (target per source) and one entry per
+        hop with the book used and the amounts in and out. Raises ValueError
+        if amount is not positive.
+        '''
+        if not amount > 0:
+            raise ValueError("amount must be positive")
+        best = None
+        for bound, path in self._candidate_paths(source, target, max_hops):
+            if best is not None and bound * amount <= best['amountOut']:
+                break  # no remaining path can do better, even at top-of-book rates
+            hops = []
+            amount_in = amount
+            for edge in path:
+                amount_out = edge.execute(amount_in)
+                if amount_out is None:
+                    break
+                hops.append({
+                    'symbol': edge.symbol,
+                    'side': 'ask' if edge.sells_base else 'bid',
+                    'amountIn': amount_in,
+                    'amountOut': amount_out
+                })
+                amount_in = amount_out
+            else:
+                if best is None or amount_in > best['amountOut']:
+                    best = {
+                        'amountIn': amount,
+                        'amountOut': amount_in,
+                        'averagePrice': amount_in / amount,
+                        'topOfBookPrice': bound,
+                        'hops': hops
+                    }
+        return best
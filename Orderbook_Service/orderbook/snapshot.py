@@ -0,0 +1,355 @@
+'''
+Binary snapshot of a whole OrderBook, used to bring the service back up after
+a restart without replaying every order through process_order.
+
+Layout (little endian):
+
+    header        HEADER struct, see below
+    string table  NUL separated utf-8 strings (accounts, assets, trade ids,
+                  and the decimal text of every price and quantity)
+    padding       up to an 8 byte boundary
+    bid records   RECORD structs, ascending price, queue order within a price
+    ask records   RECORD structs, ascending price, queue order within a price
+    stop records  STOP_RECORD structs, pending stops in arrival order
+    free slots    uint32 leaf indexes of the commitment's free list
+
+Prices and quantities are kept as string table references rather than fixed
+point integers, because the Decimals built from JSON floats carry far more
+digits than an int64 can hold and must round trip exactly.
+
+Each order record carries its leaf slot in the book's Merkle commitment and
+the free slots are saved in the order they would be reused, so a loaded book
+has the same state root, and keeps handing out the same slots, as the book
+that was saved.
+'''
+import gc
+import mmap
+import os
+import struct
+import tempfile
+from decimal import Decimal
+from .orderbook import OrderBook
+from .orderlist import OrderList
+from .order import Order
+
+MAGIC = b'OBSNAP01'
+VERSION = 3
+
+# magic, version, symbol ref, tick size, time, next order id, last timestamp,
+# number of bid records, number of ask records, number of stop records,
+# number of free slots, string table size in bytes
+HEADER = struct.Struct('<8sHIdqqqQQQQQ')
+# Version 1 and 2 headers, without the stop count
+HEADER_V2 = struct.Struct('<8sHIdqqqQQQ')
+
+# order id, timestamp, price ref, quantity ref, trade id ref, account ref,
+# base asset ref, quote asset ref, peak ref, hidden ref, commitment slot,
+# flags; the peak and hidden refs are NONE_REF except for iceberg orders
+RECORD = struct.Struct('<qqIIIIIIIIIB')
+# Version 2 records, without the slot
+RECORD_V2 = struct.Struct('<qqIIIIIIIIB')
+# Version 1 records, without the iceberg fields either
+RECORD_V1 = struct.Struct('<qqIIIIIIB')
+SLOT = struct.Struct('<I')
+
+# order id, timestamp, stop price ref, limit price ref (NONE_REF for a
+# plain stop), quantity ref, trade id ref, account ref, base asset ref,
+# quote asset ref, side, flags
+STOP_RECORD = struct.Struct('<qqIIIIIIIBB')
+SIDES = ('bid', 'ask')
+
+NONE_REF = 0xFFFFFFFF
+FLAG_INT_TRADE_ID = 0x01
+
+
+class _StringTable(object):
+    '''Interns strings and hands out their index in the table.'''
+
+    def __init__(self):
+        self.index = {}
+        self.strings = []
+
+    def ref(self, value):
+        if value is None:
+            return NONE_REF
+        value = str(value)
+        ref = self.index.get(value)
+        if ref is None:
+            if '\x00' in value:
+                raise ValueError('Cannot snapshot string containing NUL: %r' % value)
+            ref = len(self.strings)
+            self.index[value] = ref
+            self.strings.append(value)
+        return ref
+
+    def encode(self):
+        return '\x00'.join(self.strings).encode('utf-8')
+
+
+def _pack_tree(tree, side, slots, strings, out):
+    count = 0
+    for price in tree.prices:
+        price_ref = strings.ref(price)
+        order = tree.price_map[price].head_order
+        while order is not None:
+            flags = FLAG_INT_TRADE_ID if isinstance(order.trade_id, int) else 0
+            out.append(RECORD.pack(order.order_id, order.timestamp, price_ref,
+                                   strings.ref(order.quantity),
+                                   strings.ref(order.trade_id),
+                                   strings.ref(order.account),
+                                   strings.ref(order.baseAsset),
+                                   strings.ref(order.quoteAsset),
+                                   strings.ref(order.peak),
+                                   strings.ref(order.hidden if order.peak is not None else None),
+                                   slots[(side, order.order_id)],
+                                   flags))
+            count += 1
+            order = order.next_order
+    return count
+
+
+def _pack_stops(stops, strings, out):
+    # stop_map keeps arrival order, loading them back in that order restores
+    # the order of every trigger level
+    for quote in stops.stop_map.values():
+        flags = FLAG_INT_TRADE_ID if isinstance(quote.get('trade_id'), int) else 0
+        out.append(STOP_RECORD.pack(quote['order_id'], quote['timestamp'],
+                                    strings.ref(quote['stopPrice']),
+                                    strings.ref(quote['price'] if quote['type'] == 'stop_limit' else None),
+                                    strings.ref(quote['quantity']),
+                                    strings.ref(quote.get('trade_id')),
+                                    strings.ref(quote.get('account')),
+                                    strings.ref(quote.get('baseAsset')),
+                                    strings.ref(quote.get('quoteAsset')),
+                                    SIDES.index(quote['side']),
+                                    flags))
+    return len(stops)
+
+
+def write_snapshot(order_book, path, symbol=''):
+    '''Write order_book to path.
+
+    The file is written next to its destination, fsynced and then renamed
+    over it, so a crash mid-write never leaves a truncated snapshot behind.
+    '''
+    strings = _StringTable()
+    symbol_ref = strings.ref(symbol)
+    bid_records = []
+    ask_records = []
+    stop_records = []
+    commitment = order_book.commitment
+    with commitment.lock:
+        slots = commitment.slots
+        free = list(commitment.free)
+    num_bids = _pack_tree(order_book.bids, 'bid', slots, strings, bid_records)
+    num_asks = _pack_tree(order_book.asks, 'ask', slots, strings, ask_records)
+    num_stops = _pack_stops(order_book.stops, strings, stop_records)
+    table = strings.encode()
+    padding = b'\x00' * (-(HEADER.size + len(table)) % 8)
+
+    header = HEADER.pack(MAGIC, VERSION, symbol_ref, float(order_book.tick_size),
+                         int(order_book.time), int(order_book.next_order_id),
+                         int(order_book.last_timestamp), num_bids, num_asks,
+                         num_stops, len(free), len(table))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.snapshot-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header)
+            f.write(table)
+            f.write(padding)
+            f.write(b''.join(bid_records))
+            f.write(b''.join(ask_records))
+            f.write(b''.join(stop_records))
+            f.write(b''.join(SLOT.pack(slot) for slot in free))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return num_bids + num_asks + num_stops
+
+
+def _close_level(order_list, tail, length, volume):
+    order_list.tail_order = tail
+    order_list.length = length
+    order_list.volume = volume
+
+
+def _build_levels(records, strings, side, slots):
+    # Orders are linked by hand rather than through OrderList.append_order,
+    # and each level's length/volume is set once when the level is closed.
+    levels = []
+    decimals = {}
+    order_list = None
+    tail = None
+    length = 0
+    volume = 0
+    last_price_ref = None
+    price = None
+    from_fields = Order.from_fields
+    for (order_id, timestamp, price_ref, quantity_ref, trade_id_ref, account_ref,
+         base_ref, quote_ref, peak_ref, hidden_ref, slot, flags) in records:
+        if price_ref != last_price_ref:
+            if order_list is not None:
+                _close_level(order_list, tail, length, volume)
+            price = decimals.get(price_ref)
+            if price is None:
+                price = decimals[price_ref] = Decimal(strings[price_ref])
+            order_list = OrderList()
+            levels.append((price, order_list))
+            last_price_ref = price_ref
+            tail = None
+            length = 0
+            volume = 0
+        quantity = decimals.get(quantity_ref)
+        if quantity is None:
+            quantity = decimals[quantity_ref] = Decimal(strings[quantity_ref])
+        if trade_id_ref == NONE_REF:
+            trade_id = None
+        elif flags & FLAG_INT_TRADE_ID:
+            trade_id = int(strings[trade_id_ref])
+        else:
+            trade_id = strings[trade_id_ref]
+        order = from_fields(order_list, order_id, timestamp, price, quantity,
+                            trade_id,
+                            strings[account_ref] if account_ref != NONE_REF else None,
+                            side,
+                            strings[base_ref] if base_ref != NONE_REF else None,
+                            strings[quote_ref] if quote_ref != NONE_REF else None)
+        if peak_ref != NONE_REF:
+            order.peak = Decimal(strings[peak_ref])
+            order.hidden = Decimal(strings[hidden_ref])
+        if slot != NONE_REF:
+            slots[(side, order_id)] = slot
+        if tail is None:
+            order_list.head_order = order
+        else:
+            tail.next_order = order
+            order.prev_order = tail
+        tail = order
+        length += 1
+        volume += quantity
+    if order_list is not None:
+        _close_level(order_list, tail, length, volume)
+    return levels
+
+
+def _build_stops(records, strings):
+    stops = []
+    for (order_id, timestamp, stop_price_ref, price_ref, quantity_ref, trade_id_ref, account_ref,
+         base_ref, quote_ref, side, flags) in records:
+        quote = {
+            'type': 'stop' if price_ref == NONE_REF else 'stop_limit',
+            'side': SIDES[side],
+            'order_id': order_id,
+            'timestamp': timestamp,
+            'stopPrice': Decimal(strings[stop_price_ref]),
+            'quantity': Decimal(strings[quantity_ref]),
+            'account': strings[account_ref] if account_ref != NONE_REF else None,
+            'baseAsset': strings[base_ref] if base_ref != NONE_REF else None,
+            'quoteAsset': strings[quote_ref] if quote_ref != NONE_REF else None
+        }
+        if trade_id_ref == NONE_REF:
+            quote['trade_id'] = None
+        elif flags & FLAG_INT_TRADE_ID:
+            quote['trade_id'] = int(strings[trade_id_ref])
+        else:
+            quote['trade_id'] = strings[trade_id_ref]
+        if price_ref != NONE_REF:
+            quote['price'] = Decimal(strings[price_ref])
+        stops.append(quote)
+    return stops
+
+
+def load_snapshot(path):
+    '''Load a snapshot written by write_snapshot.
+
+    Returns (symbol, OrderBook). Price levels are rebuilt directly from the
+    records through OrderTree.bulk_load; no order goes through matching.
+    Pending stops are put back in the trigger book.
+    '''
+    # A million freshly allocated orders would otherwise trigger a stream of
+    # pointless cyclic GC passes; nothing allocated here is garbage.
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        bid_levels, ask_levels, stops, slots, free, header = _read_snapshot(path)
+        (symbol, tick_size, book_time, next_order_id, last_timestamp) = header
+        order_book = OrderBook(tick_size)
+        if free is None:
+            # Older snapshots have no slots, hand them out afresh
+            order_book.bids.bulk_load(bid_levels)
+            order_book.asks.bulk_load(ask_levels)
+        else:
+            touches = order_book.bids.on_touch, order_book.asks.on_touch
+            order_book.bids.on_touch = order_book.asks.on_touch = None
+            order_book.bids.bulk_load(bid_levels)
+            order_book.asks.bulk_load(ask_levels)
+            order_book.bids.on_touch, order_book.asks.on_touch = touches
+            order_book.commitment.restore(slots, free)
+        for quote in stops:
+            order_book.stops.add(quote)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    order_book.time = book_time
+    order_book.next_order_id = next_order_id
+    order_book.last_timestamp = last_timestamp
+    order_book.refresh_top_of_book()
+    return symbol, order_book
+
+
+def _read_snapshot(path):
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                magic, version = struct.unpack_from('<8sH', view, 0)
+                if magic != MAGIC:
+                    raise ValueError('%s is not an order book snapshot' % path)
+                if version not in (1, 2, VERSION):
+                    raise ValueError('Unsupported snapshot version %d' % version)
+                if version == VERSION:
+                    header_struct = HEADER
+                    (_, _, symbol_ref, tick_size, book_time, next_order_id, last_timestamp,
+                     num_bids, num_asks, num_stops, num_free, table_size) = HEADER.unpack_from(view, 0)
+                else:
+                    header_struct = HEADER_V2
+                    (_, _, symbol_ref, tick_size, book_time, next_order_id, last_timestamp,
+                     num_bids, num_asks, table_size) = HEADER_V2.unpack_from(view, 0)
+                    num_stops = num_free = 0
+                record = {1: RECORD_V1, 2: RECORD_V2}.get(version, RECORD)
+
+                offset = header_struct.size
+                strings = bytes(view[offset:offset + table_size]).decode('utf-8').split('\x00')
+                offset += table_size
+                offset += -offset % 8
+
+                bids_end = offset + num_bids * record.size
+                asks_end = bids_end + num_asks * record.size
+                stops_end = asks_end + num_stops * STOP_RECORD.size
+                free_end = stops_end + num_free * SLOT.size
+                if free_end > len(view):
+                    raise ValueError('Snapshot %s is truncated' % path)
+                bid_records = record.iter_unpack(view[offset:bids_end])
+                ask_records = record.iter_unpack(view[bids_end:asks_end])
+                if record is RECORD_V1:
+                    bid_records = (fields[:8] + (NONE_REF, NONE_REF, NONE_REF) + fields[8:] for fields in bid_records)
+                    ask_records = (fields[:8] + (NONE_REF, NONE_REF, NONE_REF) + fields[8:] for fields in ask_records)
+                elif record is RECORD_V2:
+                    bid_records = (fields[:10] + (NONE_REF,) + fields[10:] for fields in bid_records)
+                    ask_records = (fields[:10] + (NONE_REF,) + fields[10:] for fields in ask_records)
+                slots = {}
+                bid_levels = _build_levels(bid_records, strings, 'bid', slots)
+                ask_levels = _build_levels(ask_records, strings, 'ask', slots)
+                stops = _build_stops(STOP_RECORD.iter_unpack(view[asks_end:stops_end]), strings)
+                free = ([slot for (slot,) in SLOT.iter_unpack(view[stops_end:free_end])]
+                        if record is RECORD else None)
+            finally:
+                view.release()
+    header = (strings[symbol_ref], tick_size, book_time, next_order_id, last_timestamp)
+    return bid_levels, ask_levels, stops, slots, free, header
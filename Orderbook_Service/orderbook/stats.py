@@ -0,0 +1,115 @@
+from decimal import Decimal
+
+WINDOW_MS = 24 * 60 * 60 * 1000
+BUCKET_MS = 5 * 60 * 1000
+
+
+class MarketStats(object):
+    '''
+    Running market statistics of one book: last trade price and direction,
+    session VWAP, and volume/high/low over a rolling 24h window.
+
+    The rolling window is a ring of fixed-width buckets. Recording a trade
+    touches only the current bucket and the running totals. When a bucket
+    falls out of the window its volume is subtracted; the high/low are only
+    recomputed from the ring when the expiring bucket held the extreme.
+    '''
+
+    def __init__(self, window=WINDOW_MS, bucket=BUCKET_MS):
+        self.bucket = bucket
+        self.num_buckets = window // bucket
+        self.bucket_starts = [None] * self.num_buckets
+        self.bucket_volumes = [Decimal(0)] * self.num_buckets
+        self.bucket_highs = [None] * self.num_buckets
+        self.bucket_lows = [None] * self.num_buckets
+        self.current_start = None  # start of the newest bucket in the ring
+
+        self.last_price = None
+        self.price_change_indicator = None  # 'up' or 'down' vs the previous trade
+        self.session_volume = Decimal(0)
+        self.session_notional = Decimal(0)
+        self.rolling_volume = Decimal(0)
+        self.rolling_high = None
+        self.rolling_low = None
+
+    def _expiring(self, start):
+        # Ring indexes of the non-empty buckets that fall out of the window
+        # when the newest bucket moves to start
+        if self.current_start is None or start <= self.current_start:
+            return []
+        expired = min((start - self.current_start) // self.bucket, self.num_buckets)
+        first = self.current_start // self.bucket
+        indexes = [(first + step) % self.num_buckets for step in range(1, expired + 1)]
+        return [index for index in indexes if self.bucket_starts[index] is not None]
+
+    def _window_extremes(self, excluded):
+        highs = [h for index, h in enumerate(self.bucket_highs) if h is not None and index not in excluded]
+        lows = [l for index, l in enumerate(self.bucket_lows) if l is not None and index not in excluded]
+        return (max(highs) if highs else None), (min(lows) if lows else None)
+
+    def _advance(self, timestamp):
+        # Expire every bucket that is now older than the window
+        start = timestamp - timestamp % self.bucket
+        if self.current_start is not None and start <= self.current_start:
+            return
+        recompute = False
+        for index in self._expiring(start):
+            self.rolling_volume -= self.bucket_volumes[index]
+            if self.bucket_highs[index] == self.rolling_high or self.bucket_lows[index] == self.rolling_low:
+                recompute = True
+            self.bucket_starts[index] = None
+            self.bucket_volumes[index] = Decimal(0)
+            self.bucket_highs[index] = None
+            self.bucket_lows[index] = None
+        self.current_start = start
+        if recompute:
+            self.rolling_high, self.rolling_low = self._window_extremes(())
+
+    def record(self, timestamp, price, quantity):
+        self._advance(timestamp)
+        start = timestamp - timestamp % self.bucket
+        if start < self.current_start:
+            start = self.current_start  # late trade, count it in the newest bucket
+        index = (start // self.bucket) % self.num_buckets
+        if self.bucket_starts[index] is None:
+            self.bucket_starts[index] = start
+        self.bucket_volumes[index] += quantity
+        if self.bucket_highs[index] is None or price > self.bucket_highs[index]:
+            self.bucket_highs[index] = price
+        if self.bucket_lows[index] is None or price < self.bucket_lows[index]:
+            self.bucket_lows[index] = price
+
+        self.rolling_volume += quantity
+        if self.rolling_high is None or price > self.rolling_high:
+            self.rolling_high = price
+        if self.rolling_low is None or price < self.rolling_low:
+            self.rolling_low = price
+
+        if self.last_price is not None and price != self.last_price:
+            self.price_change_indicator = 'up' if price > self.last_price else 'down'
+        self.last_price = price
+        self.session_volume += quantity
+        self.session_notional += price * quantity
+
+    def snapshot(self, now):
+        '''Statistics as of now (milliseconds), as plain floats. Read only:
+        the buckets that expired since the last trade are left out of the
+        result but stay in the ring until record() expires them, so reads
+        from other threads never modify the stats.'''
+        rolling_volume, rolling_high, rolling_low = self.rolling_volume, self.rolling_high, self.rolling_low
+        expiring = self._expiring(now - now % self.bucket)
+        if expiring:
+            for index in expiring:
+                rolling_volume -= self.bucket_volumes[index]
+            if any(self.bucket_highs[index] == rolling_high or self.bucket_lows[index] == rolling_low
+                   for index in expiring):
+                rolling_high, rolling_low = self._window_extremes(set(expiring))
+        return {
+            'lastTradePrice': float(self.last_price) if self.last_price is not None else None,
+            'priceChangeIndicator': self.price_change_indicator,
+            'vwap': float(self.session_notional / self.session_volume) if self.session_volume else None,
+            'sessionVolume': float(self.session_volume),
+            'volume24h': float(rolling_volume),
+            'high24h': float(rolling_high) if rolling_high is not None else None,
+            'low24h': float(rolling_low) if rolling_low is not None else None
+        }
@@ -0,0 +1,65 @@
+from sortedcontainers import SortedDict
+
+
+class TriggerBook(object):
+    '''
+    Pending stop and stop-limit orders of one book, waiting for their
+    trigger price to trade.
+
+    Each side is a SortedDict of trigger price : {order_id : quote}, the
+    inner dict keeping arrival order. Buy stops trigger when a trade prints
+    at or above their stop price and sell stops when one prints at or below
+    it, so the triggered stops are always a prefix of the buy side (lowest
+    first) and a suffix of the sell side (highest first). Releasing them
+    pops just those levels, pending stops that did not trigger are never
+    looked at.
+    '''
+
+    def __init__(self):
+        self.buy_stops = SortedDict()
+        self.sell_stops = SortedDict()
+        self.stop_map = {}  # order_id : quote
+
+    def __len__(self):
+        return len(self.stop_map)
+
+    def __contains__(self, order_id):
+        return order_id in self.stop_map
+
+    def add(self, quote):
+        stops = self.buy_stops if quote['side'] == 'bid' else self.sell_stops
+        level = stops.get(quote['stopPrice'])
+        if level is None:
+            level = stops[quote['stopPrice']] = {}
+        level[quote['order_id']] = quote
+        self.stop_map[quote['order_id']] = quote
+
+    def remove(self, order_id):
+        '''Remove a pending stop; returns its quote, or None if unknown.'''
+        quote = self.stop_map.pop(order_id, None)
+        if quote is None:
+            return None
+        stops = self.buy_stops if quote['side'] == 'bid' else self.sell_stops
+        level = stops[quote['stopPrice']]
+        del level[order_id]
+        if not level:
+            del stops[quote['stopPrice']]
+        return quote
+
+    def get(self, order_id):
+        return self.stop_map.get(order_id)
+
+    def triggered(self, high, low):
+        '''Remove and return the stops triggered by trades printed between
+        low and high: buy stops by ascending stop price, then sell stops by
+        descending stop price, in arrival order within a price.'''
+        released = []
+        while self.buy_stops and self.buy_stops.peekitem(0)[0] <= high:
+            _, level = self.buy_stops.popitem(0)
+            released.extend(level.values())
+        while self.sell_stops and self.sell_stops.peekitem(-1)[0] >= low:
+            _, level = self.sell_stops.popitem(-1)
+            released.extend(level.values())
+        for quote in released:
+            del self.stop_map[quote['order_id']]
+        return released
@@ -0,0 +1,226 @@
+'''
+Memory soak test of the order lifecycle.
+
+Runs millions of add / fill / cancel / amend / cancel-replace cycles through
+one OrderBook, keeping the number of resting orders bounded, and checks at
+the end of every window that memory retained since the warm-up does not keep
+growing and that no Order outlives its removal from the book. The cyclic GC
+is off while the cycles run, so a removed order has to be freed by reference
+counting alone: anything left for gc.collect() is a reference cycle the
+lifecycle failed to break.
+
+    python -m orderbook.test.soak
+    python -m orderbook.test.soak --cycles 5000000 --windows 20 --resting 20000
+
+Trade history (tape, TradeStore and candles) is bounded by the book's
+BookLimits, filled up to its caps during the warm-up. Exits with status 1,
+and the allocation sites that grew the most, on a leak.
+'''
+import argparse
+import gc
+import random
+import sys
+import time
+import tracemalloc
+from collections import deque
+from decimal import Decimal
+from orderbook import OrderBook
+from orderbook.order import Order
+from orderbook.clock import LogicalClock
+from orderbook.memory import BookLimits
+from orderbook.audit import audit_book
+
+MID = 1000
+SPREAD = 5
+ACCOUNTS = ['0x%040x' % i for i in range(64)]
+# Tape, trade history and candles per interval kept by the soaked book
+HISTORY = BookLimits(max_tape=10000, max_trades=8000, max_candles=60)
+
+
+def quote(side, price, quantity, account, display=None):
+    order = {'type': 'limit',
+             'side': side,
+             'price': Decimal(price),
+             'quantity': Decimal(quantity),
+             'trade_id': account,
+             'account': account,
+             'baseAsset': 'BASE',
+             'quoteAsset': 'QUOTE'}
+    if display is not None:
+        order['displayQuantity'] = Decimal(display)
+    return order
+
+
+def resting_price(rng, side):
+    # Away from the touch so that resting orders never cross
+    if side == 'bid':
+        return MID - SPREAD - rng.randint(0, 200)
+    return MID + SPREAD + rng.randint(0, 200)
+
+
+class Soak(object):
+
+    def __init__(self, seed, max_resting):
+        self.rng = random.Random(seed)
+        self.order_book = OrderBook(clock=LogicalClock(step=10))
+        HISTORY.apply(self.order_book)
+        self.max_resting = max_resting
+        self.placed = deque()  # (side, order_id), oldest first
+        self.counts = dict.fromkeys(('add', 'fill', 'partial', 'cancel', 'amend', 'replace', 'iceberg'), 0)
+
+    def resting(self):
+        return len(self.order_book.bids) + len(self.order_book.asks)
+
+    def add(self, iceberg=False):
+        rng = self.rng
+        side = rng.choice(('bid', 'ask'))
+        quantity = rng.randint(1, 100)
+        display = rng.randint(1, quantity) if iceberg else None
+        result = self.order_book.process_order(
+            quote(side, resting_price(rng, side), quantity, rng.choice(ACCOUNTS), display), False, False)
+        if result['success'] and result['data'][1] is not None:
+            self.placed.append((side, result['data'][1]['order_id']))
+            self.counts['iceberg' if iceberg else 'add'] += 1
+
+    def fill(self):
+        # Take all or part of the best order of a random side
+        rng = self.rng
+        side = rng.choice(('bid', 'ask'))
+        tree = self.order_book.bids if side == 'bid' else self.order_book.asks
+        best = tree.max_price_list() if side == 'bid' else tree.min_price_list()
+        if best is None:
+            return
+        head = best.head_order
+        partial = head.quantity > 1 and rng.random() < 0.3
+        quantity = rng.randint(1, int(head.quantity) - 1) if partial else head.quantity
+        taker = 'ask' if side == 'bid' else 'bid'
+        result = self.order_book.process_order(quote(taker, head.price, quantity, rng.choice(ACCOUNTS)), False, False)
+        if result['success']:
+            self.counts['partial' if partial else 'fill'] += 1
+
+    def oldest(self):
+        while self.placed:
+            side, order_id = self.placed.popleft()
+            tree = self.order_book.bids if side == 'bid' else self.order_book.asks
+            if tree.order_exists(order_id):
+                return side, order_id
+        return None
+
+    def cancel(self):
+        found = self.oldest()
+        if found is not None:
+            self.order_book.cancel_order(found[0], found[1])
+            self.counts['cancel'] += 1
+
+    def amend(self):
+        found = self.oldest()
+        if found is None:
+            return
+        side, order_id = found
+        result = self.order_book.amend_order(side, order_id, self.rng.randint(1, 100),
+                                             resting_price(self.rng, side))
+        if result['success']:
+            self.placed.append(found)
+            self.counts['amend'] += 1
+
+    def replace(self):
+        found = self.oldest()
+        if found is None:
+            return
+        side, order_id = found
+        result = self.order_book.cancel_replace(side, order_id, quote(side, resting_price(self.rng, side),
+                                                                      self.rng.randint(1, 100), ACCOUNTS[0]))
+        if result['success'] and result['data'][1] is not None:
+            self.placed.append((side, result['data'][1]['order_id']))
+            self.counts['replace'] += 1
+
+    def cycle(self):
+        roll = self.rng.random()
+        if roll < 0.02:
+            self.add(iceberg=True)
+        else:
+            self.add()
+        if roll < 0.45:
+            self.fill()
+        elif roll < 0.55:
+            self.amend()
+        elif roll < 0.6:
+            self.replace()
+        if self.resting() > self.max_resting or roll >= 0.6:
+            self.cancel()
+        if len(self.placed) > 2 * self.max_resting:
+            # Forget filled orders so the soak itself does not grow
+            self.placed = deque(found for found in self.placed
+                                if (self.order_book.bids if found[0] == 'bid' else self.order_book.asks)
+                                .order_exists(found[1]))
+
+
+def live_orders():
+    return sum(1 for obj in gc.get_objects() if type(obj) is Order)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Order lifecycle memory soak test.')
+    parser.add_argument('--cycles', type=int, default=2000000)
+    parser.add_argument('--windows', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=200000)
+    parser.add_argument('--resting', type=int, default=10000, help='cap on resting orders')
+    parser.add_argument('--tolerance', type=float, default=1024,
+                        help='growth in KiB over all windows tolerated before failing')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    soak = Soak(args.seed, args.resting)
+    for _ in range(args.warmup):
+        soak.cycle()
+    gc.collect()
+
+    # One frame per allocation keeps the tracing overhead bearable over
+    # millions of cycles, and is enough to point at the leaking line
+    tracemalloc.start(1)
+    baseline = tracemalloc.take_snapshot()
+    gc.disable()
+    per_window = args.cycles // args.windows
+    retained = []
+    failed = False
+    started = time.time()
+    for window in range(args.windows):
+        for _ in range(per_window):
+            soak.cycle()
+        live = live_orders()
+        cycles = gc.collect()
+        memory = tracemalloc.get_traced_memory()[0]
+        retained.append(memory)
+        resting = soak.resting()
+        print('window %2d: retained %8.1f KiB, resting %6d, live orders %6d, gc cycles %d, %.0fs' %
+              (window + 1, memory / 1024.0, resting, live, cycles, time.time() - started))
+        if live != resting:
+            print('  %d removed orders were not freed' % (live - resting))
+            failed = True
+        if live_orders() != resting:
+            print('  %d removed orders are still reachable' % (live_orders() - resting))
+            failed = True
+
+    growth = retained[-1] - retained[0]
+    growing = all(b > a for a, b in zip(retained, retained[1:]))
+    print('growth over %d windows: %.1f KiB' % (args.windows - 1, growth / 1024.0))
+    print('operations: %s' % ', '.join('%s %d' % item for item in sorted(soak.counts.items())))
+    if growing and growth > args.tolerance * 1024:
+        print('retained memory grew in every window')
+        failed = True
+    violations = audit_book(soak.order_book)
+    if violations:
+        print('book counters drifted: %s' % violations[:5])
+        failed = True
+
+    if failed:
+        for stat in tracemalloc.take_snapshot().compare_to(baseline, 'lineno')[:10]:
+            print(stat)
+        print('FAIL')
+        return 1
+    print('OK')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,127 @@
+'''
+Checks of the amend path (OrderBook.amend_order) and cancel-replace: a size
+reduction keeps the order's queue position, a size increase or a price
+change sends the same Order object to the back of a queue, and a rejected
+cancel-replace puts the old order back exactly where it was.
+
+    python -m pytest orderbook/test/test_amend.py
+'''
+from decimal import Decimal
+from orderbook import OrderBook
+from orderbook.clock import LogicalClock
+
+
+def limit(side, price, quantity, trade_id='maker', display=None):
+    quote = {'type': 'limit', 'side': side, 'price': Decimal(price), 'quantity': Decimal(quantity),
+             'trade_id': trade_id, 'account': trade_id, 'baseAsset': 'BASE', 'quoteAsset': 'QUOTE'}
+    if display is not None:
+        quote['displayQuantity'] = Decimal(display)
+    return quote
+
+
+def book_with_bids():
+    '''Three bids at 100 (ids 1, 2, 3), one at 99 (id 4) and an ask at 105.'''
+    order_book = OrderBook(clock=LogicalClock())
+    for price in (100, 100, 100, 99):
+        order_book.process_order(limit('bid', price, 5), False, False)
+    order_book.process_order(limit('ask', 105, 5), False, False)
+    return order_book
+
+
+def queue(order_book, price, side='bid'):
+    tree = order_book.bids if side == 'bid' else order_book.asks
+    return [order.order_id for order in tree.get_price_list(Decimal(price))]
+
+
+def state(order_book):
+    '''Everything a rejected command must leave as it was.'''
+    return ([(price, queue(order_book, price), order_book.bids.get_price_list(price).volume)
+             for price in order_book.bids.prices],
+            order_book.bids.volume, order_book.bids.num_orders, order_book.bids.depth,
+            order_book.commitment.root(), order_book.top_of_book['bid']['encoded'])
+
+
+def test_size_down_keeps_priority():
+    order_book = book_with_bids()
+    order = order_book.bids.get_order(1)
+    timestamp = order.timestamp
+    result = order_book.amend_order('bid', 1, 2)
+    assert result['success'] and result['data'] is order
+    assert queue(order_book, 100) == [1, 2, 3]
+    assert order.quantity == 2 and order.timestamp == timestamp
+    assert order_book.bids.get_price_list(Decimal(100)).volume == 12
+    assert order_book.bids.volume == 17
+    assert order_book.top_of_book['bid']['quantity'] == 2
+
+
+def test_size_up_goes_to_the_back():
+    order_book = book_with_bids()
+    order = order_book.bids.get_order(1)
+    assert order_book.amend_order('bid', 1, 8)['success']
+    assert queue(order_book, 100) == [2, 3, 1]
+    assert order_book.bids.get_order(1) is order
+    assert order_book.bids.get_price_list(Decimal(100)).volume == 18
+
+
+def test_price_change_relinks_the_same_order():
+    order_book = book_with_bids()
+    order = order_book.bids.get_order(2)
+    assert order_book.amend_order('bid', 2, price=99)['success']
+    assert queue(order_book, 100) == [1, 3]
+    assert queue(order_book, 99) == [4, 2]
+    assert order_book.bids.get_order(2) is order and order.price == 99
+    # Moving the last order of a level removes the level
+    order_book.amend_order('bid', 4, price=101)
+    order_book.amend_order('bid', 2, price=101)
+    assert list(order_book.bids.prices) == [100, 101]
+    assert order_book.bids.num_orders == 4 and order_book.bids.depth == 2
+
+
+def test_amend_that_crosses_is_rejected():
+    order_book = book_with_bids()
+    before = state(order_book)
+    result = order_book.amend_order('bid', 1, price=105)
+    assert not result['success'] and 'cancel-replace' in result['message']
+    assert not order_book.amend_order('bid', 1, 0)['success']
+    assert not order_book.amend_order('bid', 42, 1)['success']
+    assert state(order_book) == before
+
+
+def test_iceberg_amend_keeps_the_peak():
+    order_book = book_with_bids()
+    order_id = order_book.process_order(limit('bid', 98, 10, display=2), False, False)['data'][1]['order_id']
+    order = order_book.bids.get_order(order_id)
+    assert order_book.amend_order('bid', order_id, 7)['success']
+    assert order.quantity == 2 and order.hidden == 5
+    assert order_book.amend_order('bid', order_id, 1)['success']
+    assert order.quantity == 1 and order.hidden == 0
+
+
+def test_rejected_cancel_replace_restores_the_order():
+    order_book = book_with_bids()
+    before = state(order_book)
+    order = order_book.bids.get_order(2)
+    # Larger than the best ask, which the one-fill rule rejects
+    result = order_book.cancel_replace('bid', 2, limit('bid', 105, 50))
+    assert not result['success']
+    assert order_book.bids.get_order(2) is order
+    assert state(order_book) == before
+    # The head of a level goes back to the head
+    assert not order_book.cancel_replace('bid', 1, limit('bid', 105, 50))['success']
+    assert state(order_book) == before
+    # And the only order of a level brings its level back
+    assert not order_book.cancel_replace('bid', 4, limit('bid', 105, 50))['success']
+    assert state(order_book) == before
+    assert not order_book.cancel_replace('bid', 42, limit('bid', 100, 1))['success']
+
+
+def test_cancel_replace_matches():
+    order_book = book_with_bids()
+    result = order_book.cancel_replace('bid', 3, limit('bid', 105, 2))
+    assert result['success']
+    assert result['cancelled'].order_id == 3
+    trades = result['data'][0]
+    assert len(trades) == 1 and trades[0]['price'] == 105 and trades[0]['quantity'] == 2
+    assert queue(order_book, 100) == [1, 2]
+    assert order_book.asks.volume == 3
+
@@ -0,0 +1,126 @@
+'''
+Checks of the background book audit (audit.py): ticks keep going while
+another thread writes to the books and report no drift when they read under
+the writer's lock, real drift is reported, and the audit thread survives a
+failing tick.
+
+    python -m pytest orderbook/test/test_audit.py
+'''
+import random
+import sys
+import threading
+import time
+from decimal import Decimal
+import pytest
+from orderbook import OrderBook
+from orderbook.audit import Auditor, AuditThread
+
+SYMBOL = 'BASE_QUOTE'
+
+
+def limit(side, price, quantity):
+    return {'type': 'limit', 'side': side, 'price': Decimal(price), 'quantity': Decimal(quantity),
+            'trade_id': 'maker', 'account': 'maker', 'baseAsset': 'BASE', 'quoteAsset': 'QUOTE'}
+
+
+@pytest.fixture
+def fast_switching():
+    # Hand the GIL over as often as possible, so the writer lands inside reads
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+def run_writer(order_book, lock, stop):
+    rng = random.Random(7)
+    resting = []
+    while not stop.is_set():
+        with lock:
+            if resting and rng.random() < 0.5:
+                side, order_id = resting.pop(rng.randrange(len(resting)))
+                if (order_book.bids if side == 'bid' else order_book.asks).order_exists(order_id):
+                    order_book.cancel_order(side, order_id)
+            else:
+                # Bids and asks never cross, so every order rests on its own level or joins one
+                side = rng.choice(('bid', 'ask'))
+                price = rng.randint(1, 400) if side == 'bid' else rng.randint(401, 800)
+                order = order_book.process_order(limit(side, price, rng.randint(1, 5)), False, False)['data'][1]
+                resting.append((side, order['order_id']))
+
+
+def audit_while_writing(lock, auditor):
+    order_book = OrderBook()
+    for i in range(300):
+        order_book.process_order(limit('bid', 1 + i, 1), False, False)
+    stop = threading.Event()
+    writer = threading.Thread(target=run_writer, args=(order_book, lock, stop))
+    writer.start()
+    try:
+        deadline = time.monotonic() + 1.5
+        while time.monotonic() < deadline:
+            auditor.tick([(SYMBOL, order_book)])
+    finally:
+        stop.set()
+        writer.join()
+    return order_book
+
+
+def test_no_drift_under_the_writers_lock(fast_switching):
+    lock = threading.Lock()
+    auditor = Auditor(budget=0.001, lock=lambda symbol: lock)
+    audit_while_writing(lock, auditor)
+    stats = auditor.stats()
+    assert stats['rotations'] > 0 and stats['levelsChecked'] > 0
+    assert stats['drift'] == {}, stats['recent']
+    assert stats['retries'] == 0
+
+
+def test_reads_racing_a_writer_are_retried(fast_switching):
+    # The writer does not hold the auditor's lock: reads that fail as the
+    # writer resizes a level map are retried instead of ending the tick
+    auditor = Auditor(budget=0.001)
+    order_book = audit_while_writing(threading.Lock(), auditor)
+    assert auditor.stats()['rotations'] > 0
+    # Once the writer stopped, a full rotation finds nothing new
+    drift = dict(auditor.drift)
+    for _ in range(4):
+        auditor.tick([(SYMBOL, order_book)])
+    assert auditor.drift == drift
+
+
+def test_drift_is_reported():
+    order_book = OrderBook()
+    for i in range(10):
+        order_book.process_order(limit('ask', 10 + i, 1), False, False)
+    order_book.asks.num_orders += 1
+    order_book.asks.price_map[Decimal(12)].volume += 1
+    auditor = Auditor(budget=1.0)
+    auditor.tick([(SYMBOL, order_book)])
+    assert auditor.drift == {'num_orders': 1, 'level_volume': 1, 'tree_volume': 1}
+    assert {v['symbol'] for v in auditor.recent} == {SYMBOL}
+
+
+def test_thread_survives_a_failing_tick():
+    order_book = OrderBook()
+    order_book.process_order(limit('bid', 10, 1), False, False)
+    calls = []
+
+    def books():
+        calls.append(None)
+        if len(calls) == 1:
+            raise RuntimeError('books unavailable')
+        return [(SYMBOL, order_book)]
+
+    auditor = Auditor(budget=0.01)
+    thread = AuditThread(auditor, books, interval=0.01)
+    thread.start()
+    try:
+        deadline = time.monotonic() + 5
+        while auditor.rotations == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        thread.stop(5)
+    assert auditor.errors == 1
+    assert auditor.stats()['lastError'] == 'books unavailable'
+    assert auditor.rotations > 0
@@ -0,0 +1,148 @@
+'''
+Checks of the bulk import (bulk.py): NDJSON and CSV load in book order with
+ids and timestamps filled in, every invalid record is reported by position,
+and an import that would cross the book, exceed its caps or reuse an order
+id is rejected before the book is touched.
+
+    python -m pytest orderbook/test/test_bulk_import.py
+'''
+import io
+import json
+from decimal import Decimal
+import pytest
+from orderbook import OrderBook
+from orderbook.bulk import BulkImport, import_orders, read_csv, read_ndjson, records_from_rows
+from orderbook.clock import LogicalClock
+from orderbook.memory import BookLimits
+
+
+def ndjson(records):
+    return io.StringIO(''.join(json.dumps(record) + '\n' for record in records))
+
+
+def book():
+    order_book = OrderBook(clock=LogicalClock(start=1000))
+    order_book.update_time()
+    return order_book
+
+
+def queue(tree, price):
+    return [(order.order_id, order.timestamp, order.quantity) for order in tree.get_price_list(Decimal(price))]
+
+
+def rejected(order_book, records, message, replace=False):
+    '''True if the import fails with message and leaves the book as it was.'''
+    before = (order_book.bids.num_orders, order_book.asks.num_orders, order_book.next_order_id,
+              order_book.commitment.root())
+    try:
+        import_orders(order_book, 'BASE', 'QUOTE', records, replace)
+    except ValueError as e:
+        assert message in str(e), str(e)
+        return before == (order_book.bids.num_orders, order_book.asks.num_orders, order_book.next_order_id,
+                          order_book.commitment.root())
+    return False
+
+
+def test_ndjson_loads_in_book_order():
+    order_book = book()
+    records = [
+        {'side': 'bid', 'price': 99.5, 'quantity': 2, 'account': 'a', 'timestamp': 20},
+        {'side': 'bid', 'price': 99.5, 'quantity': 3, 'account': 'b', 'timestamp': 10, 'order_id': 50},
+        {'side': 'bid', 'price': 98, 'quantity': 1, 'account': 'c'},
+        {'side': 'ask', 'price': 101, 'quantity': 8, 'account': 'd', 'displayQuantity': 2},
+    ]
+    assert import_orders(order_book, 'BASE', 'QUOTE', read_ndjson(ndjson(records))) == 4
+    # Sorted by timestamp within a level; missing ids are given after the
+    # highest in use, in ascending price order
+    assert queue(order_book.bids, '99.5') == [(50, 10, 3), (52, 20, 2)]
+    assert queue(order_book.bids, 98) == [(51, order_book.time, 1)]
+    iceberg = order_book.asks.get_order(53)
+    assert iceberg.quantity == 2 and iceberg.hidden == 6 and order_book.asks.volume == 2
+    assert order_book.next_order_id == 53
+    assert order_book.top_of_book['bid']['order']['order_id'] == 50
+    # Orders placed afterwards are numbered after the imported ones
+    result = order_book.process_order({'type': 'limit', 'side': 'bid', 'price': Decimal(97), 'quantity': Decimal(1),
+                                       'trade_id': 'e', 'account': 'e', 'baseAsset': 'BASE',
+                                       'quoteAsset': 'QUOTE'}, False, False)
+    assert result['data'][1]['order_id'] == 54
+
+
+def test_csv_matches_ndjson():
+    text = 'side,price,quantity,account,order_id,displayQuantity\n' \
+           'bid,10.25,4,a,,\nask,11,5,b,7,1\nbid,10,1,c,,\n'
+    from_csv = book()
+    import_orders(from_csv, 'BASE', 'QUOTE', read_csv(io.StringIO(text)))
+    from_ndjson = book()
+    import_orders(from_ndjson, 'BASE', 'QUOTE', read_ndjson(ndjson([
+        {'side': 'bid', 'price': '10.25', 'quantity': '4', 'account': 'a'},
+        {'side': 'ask', 'price': '11', 'quantity': '5', 'account': 'b', 'order_id': 7, 'displayQuantity': '1'},
+        {'side': 'bid', 'price': '10', 'quantity': '1', 'account': 'c'}])))
+    assert from_csv.commitment.root() == from_ndjson.commitment.root()
+
+
+def test_invalid_records_name_their_position():
+    good = {'side': 'bid', 'price': '1', 'quantity': '1', 'account': 'a'}
+    for bad, message in (({'side': 'buy'}, 'side must be'),
+                         ({'price': '0'}, 'price must be greater than 0'),
+                         ({'price': 'abc'}, 'price is not a number'),
+                         ({'price': 'NaN'}, 'price must be greater than 0'),
+                         ({'quantity': '-1'}, 'quantity must be greater than 0'),
+                         ({'account': ''}, 'account is required'),
+                         ({'order_id': 0}, 'order_id must be greater than 0'),
+                         ({'timestamp': 'soon'}, 'record 2')):
+        assert rejected(book(), [good, dict(good, **bad)], 'record 2'), bad
+        assert rejected(book(), [good, dict(good, **bad)], message), bad
+    assert rejected(book(), [good, 'not an object'], 'record 2 is not an object')
+    assert rejected(book(), [dict(good, order_id=5), dict(good, order_id=5)], 'record 2: duplicate order_id 5')
+    with pytest.raises(ValueError, match='^record 2'):
+        list(read_ndjson(io.StringIO(json.dumps(good) + '\n{"side": \n')))
+
+
+def test_import_that_crosses_is_rejected():
+    assert rejected(book(), [{'side': 'bid', 'price': '10', 'quantity': '1', 'account': 'a'},
+                             {'side': 'ask', 'price': '10', 'quantity': '1', 'account': 'b'}], 'cross the book')
+
+
+def test_import_over_the_caps_is_rejected():
+    records = [{'side': 'bid', 'price': str(price), 'quantity': '1', 'account': 'a'} for price in range(1, 6)]
+    order_book = book()
+    BookLimits(max_orders=4).apply(order_book)
+    assert rejected(order_book, records, 'exceed the cap of 4 orders')
+    order_book = book()
+    BookLimits(max_levels=3).apply(order_book)
+    assert rejected(order_book, records, 'exceed the cap of 3 levels')
+    order_book = book()
+    BookLimits(max_orders=5, max_levels=5).apply(order_book)
+    assert import_orders(order_book, 'BASE', 'QUOTE', records) == 5
+
+
+def test_non_empty_book_needs_replace():
+    order_book = book()
+    import_orders(order_book, 'BASE', 'QUOTE', [{'side': 'bid', 'price': '5', 'quantity': '1', 'account': 'a'}])
+    order_book.process_order({'type': 'stop', 'side': 'ask', 'stopPrice': Decimal(4), 'quantity': Decimal(1),
+                              'trade_id': 's', 'account': 's', 'baseAsset': 'BASE', 'quoteAsset': 'QUOTE'},
+                             False, False)
+    stop_id = next(iter(order_book.stops.stop_map))
+    records = [{'side': 'bid', 'price': '6', 'quantity': '2', 'account': 'b'}]
+    assert rejected(order_book, records, 'not empty')
+    assert rejected(order_book, [dict(records[0], order_id=stop_id)], 'already used by a pending stop', True)
+    assert import_orders(order_book, 'BASE', 'QUOTE', records, replace=True) == 1
+    assert list(order_book.bids.prices) == [6]
+    assert stop_id in order_book.stops and order_book.bids.max_price_list().head_order.order_id > stop_id
+
+
+def test_field_rows_import_the_same():
+    records = [{'side': 'bid' if i % 2 else 'ask', 'price': str(100 - i % 7 if i % 2 else 101 + i % 7),
+                'quantity': str(1 + i % 4), 'account': 'acct%d' % (i % 3)} for i in range(200)]
+    records[3]['displayQuantity'] = '1'
+    records[4]['timestamp'] = 5
+    bulk = BulkImport('BASE', 'QUOTE')
+    bulk.add(records)
+    first = book()
+    bulk.load(first)
+    again = BulkImport('BASE', 'QUOTE')
+    again.add(records_from_rows(json.loads(json.dumps(list(bulk.field_rows()), default=str))))
+    second = book()
+    again.load(second)
+    assert first.commitment.root() == second.commitment.root()
+
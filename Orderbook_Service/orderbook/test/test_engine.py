@@ -0,0 +1,96 @@
+'''
+Checks of the matching engine process (engine.py) through EngineClient:
+orders that process_order cannot take are rejected without taking the
+engine down, and orders and book bodies can be read while the books live in
+the engine.
+
+    python -m pytest orderbook/test/test_engine.py
+'''
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from decimal import Decimal
+import pytest
+from engine import EngineClient, PublishedBooks, publish_directory
+from orderbook.registry import make_symbol
+
+BASE = '0x' + 'a' * 40
+QUOTE = '0x' + 'b' * 40
+SERVICE = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def limit(side, price, quantity):
+    return {'type': 'limit', 'side': side, 'price': Decimal(price), 'quantity': Decimal(quantity),
+            'trade_id': 'maker', 'account': 'maker', 'baseAsset': BASE, 'quoteAsset': QUOTE}
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def engine():
+    name = 'obtest%d' % os.getpid()
+    process = subprocess.Popen([sys.executable, 'engine.py', '--name', name, '--channels', '1', '--slots', '64',
+                                '--publish-interval', '0.01'],
+                               cwd=SERVICE)
+    client = None
+    try:
+        deadline = time.monotonic() + 10
+        while client is None:
+            try:
+                client = EngineClient(name, 1, slots=64, lock_dir=tempfile.gettempdir())
+            except FileNotFoundError:
+                assert process.poll() is None, 'engine exited with %s' % process.returncode
+                assert time.monotonic() < deadline, 'engine did not start'
+                time.sleep(0.05)
+        yield process, client, name
+    finally:
+        if client is not None:
+            client.close()
+        process.terminate()
+        process.wait(10)
+
+
+def test_orders_process_order_cannot_take_are_rejected(engine):
+    process, client, _ = engine
+    for quote in (limit('bid', 10, 0), limit('ask', 10, -1), limit('bid', 'NaN', 1), limit('ask', 'Infinity', 1)):
+        result = client.process_order(quote)
+        assert result['success'] is False, quote
+        assert process.poll() is None, 'engine exited on %r' % quote
+    result = client.process_order(limit('bid', 10, 1))
+    assert result['success'] is True
+    assert result['data'][1]['quantity'] == 1
+    assert client.best_order(BASE, QUOTE, 'bid').price == 10
+
+
+def test_orders_and_books_are_read_from_the_engine(engine):
+    _, client, name = engine
+    resting = client.process_order(limit('ask', 12, 3))['data'][1]
+    client.process_order(limit('bid', 10, 2))
+    order = client.find_order(resting['order_id'])
+    assert (order.side, order.price, order.quantity) == ('ask', 12, 3)
+    assert (order.baseAsset, order.quoteAsset) == (BASE, QUOTE)
+    assert client.find_order(resting['order_id'] + 1000) is None
+
+    books = PublishedBooks(publish_directory(name))
+    symbol = make_symbol(BASE, QUOTE)
+
+    def published():
+        book = books.get(symbol)
+        return json.loads(book.body)['orderbook'] if book is not None else None
+
+    assert wait_for(lambda: published() is not None and len(published()['bids']) == 1)
+    assert [(o['price'], o['amount']) for o in published()['asks']] == [(12.0, 3.0)]
+    client.cancel_order(BASE, QUOTE, 'ask', resting['order_id'])
+    assert wait_for(lambda: published()['asks'] == [])
+    assert client.find_order(resting['order_id']) is None
+    assert books.get(make_symbol(QUOTE, BASE)) is None
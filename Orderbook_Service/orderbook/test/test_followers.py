@@ -0,0 +1,198 @@
+'''
+Checks of primary/follower replication (replication.py), in one process
+over Unix sockets: followers replay the primary's commands to the same
+state root, commands on different markets do not wait for each other, a
+primary that loaded snapshots refuses new followers and promotion fences
+the old primary.
+
+    python -m pytest orderbook/test/test_followers.py
+'''
+import os
+import tempfile
+import threading
+import time
+from decimal import Decimal
+import pytest
+from orderbook import OrderBook
+from orderbook.bulk import BulkImport
+from orderbook.registry import SymbolRegistry, make_symbol
+from replication import Replicator, ReadOnly, ROLE_PRIMARY, ROLE_FENCED
+
+BASE = '0x' + 'a' * 40
+QUOTE = '0x' + 'b' * 40
+OTHER = '0x' + 'c' * 40
+SYMBOL = make_symbol(BASE, QUOTE)
+OTHER_SYMBOL = make_symbol(OTHER, QUOTE)
+
+
+def limit(side, price, quantity, account='maker'):
+    return {'type': 'limit', 'side': side, 'price': Decimal(price), 'quantity': Decimal(quantity),
+            'trade_id': account, 'account': account, 'baseAsset': BASE, 'quoteAsset': QUOTE}
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class Pair(object):
+    '''A primary and one follower, each with its own registry.'''
+
+    def __init__(self, directory, primary_registry=None):
+        self.address = 'unix:' + os.path.join(directory, 'primary.sock')
+        self.primary_books = primary_registry or SymbolRegistry()
+        self.primary = Replicator(self.primary_books, 'primary', listen=self.address)
+        self.primary.start()
+        self.follower_books = SymbolRegistry()
+        self.follower = Replicator(self.follower_books, 'follower',
+                                   listen='unix:' + os.path.join(directory, 'follower.sock'),
+                                   primary=self.address)
+        self.follower.start()
+
+    def run(self, symbol, op, args, method, *method_args):
+        with self.primary.command(symbol, op, args):
+            return method(self.primary_books.get_or_create(symbol), *method_args)
+
+    def order(self, quote, symbol=SYMBOL):
+        return self.run(symbol, 'order', quote, OrderBook.process_order, quote, False, False)
+
+    def caught_up(self):
+        return wait_for(lambda: self.follower.applied == self.primary.log.last)
+
+    def roots_match(self):
+        for symbol, order_book in self.primary_books.items():
+            replica = self.follower_books.get(symbol)
+            if replica is None or replica.commitment.root() != order_book.commitment.root():
+                return False
+        return True
+
+    def stop(self):
+        self.follower.stop()
+        self.primary.stop()
+
+
+def test_follower_replays_to_the_same_root():
+    with tempfile.TemporaryDirectory() as directory:
+        pair = Pair(directory)
+        try:
+            ids = []
+            for i in range(50):
+                result = pair.order(limit('bid' if i % 2 else 'ask', 100 + (i % 5) * (1 if i % 2 else -1) + 5, 1 + i % 3))
+                if result['success'] and result['data'][1] is not None:
+                    ids.append(('bid' if i % 2 else 'ask', result['data'][1]['order_id']))
+            side, order_id = ids[0]
+            pair.run(SYMBOL, 'cancel', {'side': side, 'orderId': order_id}, OrderBook.cancel_order, side, order_id)
+            side, order_id = ids[1]
+            pair.run(SYMBOL, 'amend', {'side': side, 'orderId': order_id, 'quantity': 1},
+                     OrderBook.amend_order, side, order_id, 1)
+            stop = {'type': 'stop', 'side': 'bid', 'stopPrice': Decimal(120), 'quantity': Decimal(1),
+                    'trade_id': 's', 'account': 's', 'baseAsset': BASE, 'quoteAsset': QUOTE}
+            pair.order(stop)
+            bulk = BulkImport(OTHER, QUOTE)
+            bulk.add([{'side': 'bid', 'price': '5', 'quantity': '2', 'account': 'x', 'timestamp': 1},
+                      {'side': 'ask', 'price': '6', 'quantity': '3', 'account': 'y', 'timestamp': 2}])
+            with pair.primary.bulk_import(OTHER_SYMBOL, bulk, False):
+                bulk.load(pair.primary_books.get_or_create(OTHER_SYMBOL))
+            assert pair.caught_up(), 'follower did not catch up'
+            assert pair.follower.errors == 0, pair.follower.last_error
+            assert pair.roots_match()
+            assert pair.follower.log.bytes(SYMBOL) > 0
+        finally:
+            pair.stop()
+
+
+def test_imports_replicate_in_chunks():
+    with tempfile.TemporaryDirectory() as directory:
+        pair = Pair(directory)
+        try:
+            bulk = BulkImport(BASE, QUOTE)
+            bulk.add([{'side': 'bid' if i % 2 else 'ask', 'price': str(100 - i % 50 if i % 2 else 101 + i % 50),
+                       'quantity': str(1 + i % 7), 'account': 'acct%d' % (i % 5)} for i in range(2500)])
+            first = pair.primary.log.last + 1
+            with pair.primary.bulk_import(SYMBOL, bulk, False):
+                bulk.load(pair.primary_books.get_or_create(SYMBOL))
+            ops = [entry[2] for entry in pair.primary.log.since(first, 100)]
+            assert ops == ['import_begin'] + ['import_chunk'] * 3 + ['import_commit'], ops
+            # A failed load is aborted and the follower drops what it staged
+            again = BulkImport(BASE, QUOTE)
+            again.add([{'side': 'bid', 'price': '1', 'quantity': '1', 'account': 'z'}])
+            with pytest.raises(ValueError, match='not empty'):
+                with pair.primary.bulk_import(SYMBOL, again, False):
+                    again.load(pair.primary_books.get(SYMBOL))
+            assert pair.primary.log.since(pair.primary.log.last, 1)[0][2] == 'import_abort'
+            assert pair.caught_up(), 'follower did not catch up'
+            assert pair.follower.errors == 0, pair.follower.last_error
+            assert pair.follower.imports == {}
+            assert pair.roots_match()
+        finally:
+            pair.stop()
+
+
+def test_markets_do_not_wait_for_each_other():
+    with tempfile.TemporaryDirectory() as directory:
+        pair = Pair(directory)
+        try:
+            entered = threading.Event()
+            release = threading.Event()
+
+            def slow_command():
+                with pair.primary.command(SYMBOL, 'order', {}):
+                    entered.set()
+                    release.wait(5)
+                    pair.primary_books.get_or_create(SYMBOL)
+
+            thread = threading.Thread(target=slow_command)
+            thread.start()
+            assert entered.wait(5)
+            started = time.monotonic()
+            pair.order(limit('bid', 10, 1), OTHER_SYMBOL)
+            elapsed = time.monotonic() - started
+            release.set()
+            thread.join()
+            assert elapsed < 1, 'a command on another market waited %.1fs' % elapsed
+        finally:
+            release.set()
+            pair.stop()
+
+
+def test_primary_from_snapshots_refuses_followers():
+    with tempfile.TemporaryDirectory() as directory:
+        registry = SymbolRegistry()
+        loaded = OrderBook()
+        loaded.process_order(limit('bid', 10, 1), False, False)
+        registry.add(SYMBOL, loaded)
+        pair = Pair(directory, registry)
+        try:
+            assert wait_for(lambda: pair.follower.last_error is not None)
+            assert 'snapshots' in pair.follower.last_error
+            assert pair.follower.applied == 0
+        finally:
+            pair.stop()
+
+
+def test_follower_with_books_refuses_to_start():
+    registry = SymbolRegistry()
+    registry.get_or_create(SYMBOL).process_order(limit('bid', 10, 1), False, False)
+    follower = Replicator(registry, 'follower', primary='unix:/nonexistent')
+    with pytest.raises(ValueError, match='empty books'):
+        follower.start()
+
+
+def test_promotion_fences_the_primary():
+    with tempfile.TemporaryDirectory() as directory:
+        pair = Pair(directory)
+        try:
+            pair.order(limit('bid', 10, 1))
+            assert pair.caught_up()
+            last = pair.follower.promote()
+            assert last == pair.primary.log.last
+            assert pair.follower.role == ROLE_PRIMARY and pair.primary.role == ROLE_FENCED
+            with pytest.raises(ReadOnly):
+                pair.order(limit('bid', 10, 1))
+        finally:
+            pair.stop()
+
@@ -0,0 +1,57 @@
+'''
+Checks of the per-book memory estimate and caps (memory.py) for pending
+stops: they are counted in book_usage, close to what they allocate, and
+max_stops rejects stops beyond it.
+
+    python -m pytest orderbook/test/test_memory.py
+'''
+import tracemalloc
+from decimal import Decimal
+import pytest
+from orderbook import OrderBook
+from orderbook.memory import BookLimits, book_usage, parse_book_limits
+
+
+def stop(side, stop_price, quantity=1):
+    return {'type': 'stop_limit', 'side': side, 'stopPrice': Decimal(stop_price), 'price': Decimal(stop_price),
+            'quantity': Decimal(quantity), 'trade_id': '0x' + '1' * 40, 'account': '0x' + '1' * 40,
+            'baseAsset': 'BASE', 'quoteAsset': 'QUOTE'}
+
+
+def test_stops_are_counted():
+    order_book = OrderBook()
+    empty = book_usage(order_book)
+    assert empty['stops'] == 0 and empty['counts']['stops'] == 0
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for i in range(2000):
+            assert order_book.process_order(stop('bid', 100 + i % 50), False, False)['success']
+        allocated = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    usage = book_usage(order_book)
+    assert usage['counts']['stops'] == 2000
+    assert usage['total'] - empty['total'] == usage['stops']
+    # Within a factor of the allocator's count, which also sees the trigger levels
+    assert allocated / 2 < usage['stops'] < allocated * 1.5, (usage['stops'], allocated)
+
+
+def test_stops_beyond_the_cap_are_rejected():
+    order_book = OrderBook()
+    BookLimits(max_stops=3).apply(order_book)
+    ids = [order_book.process_order(stop('ask', 90 - i), False, False)['data'][1]['order_id'] for i in range(3)]
+    result = order_book.process_order(stop('bid', 110), False, False)
+    assert result == {'success': False, 'message': 'Order book is full (3 pending stops)'}
+    assert len(order_book.stops) == 3
+    order_book.cancel_stop(ids[0])
+    assert order_book.process_order(stop('bid', 110), False, False)['success']
+
+
+def test_parse_stops_cap():
+    limits = parse_book_limits('*=10:5:100,WETH_USDC=::::7:2')
+    assert limits['*'].max_stops is None
+    assert limits['WETH_USDC'].as_dict() == {'maxOrders': None, 'maxLevels': None, 'maxTape': None,
+                                             'maxTrades': None, 'maxCandles': 7, 'maxStops': 2}
+    with pytest.raises(ValueError):
+        parse_book_limits('*=1:2:3:4:5:6:7')
@@ -0,0 +1,79 @@
+'''
+Checks of OrderBook.get_orders_page: paging through a side while orders are
+added and cancelled between pages, including the order a cursor names,
+returns every order that rested throughout exactly once, in book order.
+
+    python -m pytest orderbook/test/test_paging.py
+'''
+import random
+from decimal import Decimal
+import pytest
+from orderbook import OrderBook
+from orderbook.clock import LogicalClock
+
+
+def limit(side, price, quantity=1):
+    return {'type': 'limit', 'side': side, 'price': Decimal(price), 'quantity': Decimal(quantity),
+            'trade_id': 'maker', 'account': 'maker', 'baseAsset': 'BASE', 'quoteAsset': 'QUOTE'}
+
+
+def add(order_book, side, price):
+    return order_book.process_order(limit(side, price), False, False)['data'][1]['order_id']
+
+
+def resting_ids(order_book, side):
+    tree = order_book.bids if side == 'bid' else order_book.asks
+    return set(tree.order_map)
+
+
+@pytest.mark.parametrize('side', ['bid', 'ask'])
+@pytest.mark.parametrize('seed', range(5))
+def test_no_order_is_skipped_or_repeated(side, seed):
+    rng = random.Random(seed)
+    order_book = OrderBook(clock=LogicalClock())
+    # Few levels with many orders each, so cursors mostly land inside a level
+    prices = [str(100 + i) for i in range(8)]
+    for _ in range(300):
+        add(order_book, side, rng.choice(prices))
+    initial = resting_ids(order_book, side)
+    cancelled = set()
+    returned = []
+    previous_price = None
+    cursor = None
+    while True:
+        page, cursor = order_book.get_orders_page(side, cursor, None, rng.randint(1, 9))
+        for order in page:
+            price = Decimal(str(order['price']))
+            # Best price first, across pages too
+            if previous_price is not None:
+                assert price <= previous_price if side == 'bid' else price >= previous_price
+            previous_price = price
+            returned.append(order['orderId'])
+        if cursor is None:
+            break
+        # Cancel the order the cursor names about half the time, plus others
+        # anywhere in the book, and add orders at every price
+        if rng.random() < 0.5:
+            order_id = int(cursor.split(':')[1])
+            order_book.cancel_order(side, order_id)
+            cancelled.add(order_id)
+        for order_id in rng.sample(sorted(resting_ids(order_book, side)), 3):
+            order_book.cancel_order(side, order_id)
+            cancelled.add(order_id)
+        for _ in range(3):
+            add(order_book, side, rng.choice(prices))
+    assert len(returned) == len(set(returned)), 'orders returned twice'
+    assert initial - cancelled <= set(returned), 'orders skipped'
+
+
+def test_cursor_order_cancelled_inside_its_level():
+    order_book = OrderBook(clock=LogicalClock())
+    ids = [add(order_book, 'ask', '10') for _ in range(6)]
+    page, cursor = order_book.get_orders_page('ask', None, None, 3)
+    assert [order['orderId'] for order in page] == ids[:3]
+    order_book.cancel_order('ask', ids[2])
+    order_book.cancel_order('ask', ids[0])
+    late = add(order_book, 'ask', '10')
+    page, cursor = order_book.get_orders_page('ask', cursor, None, 10)
+    assert [order['orderId'] for order in page] == ids[3:] + [late]
+    assert cursor is None
@@ -0,0 +1,95 @@
+'''
+Checks of offline replay (replay.py, clock.py): replaying the same recorded
+log twice, from NDJSON or from the binary format, gives the same digest at
+every step and the same books, and a changed log diverges.
+
+    python -m pytest orderbook/test/test_replay.py
+'''
+import random
+from orderbook.replay import Replay, read_log, replay_job, write_binary, write_ndjson
+
+SYMBOLS = ('0x' + 'a' * 40 + '_' + '0x' + 'b' * 40, 'WETH_USDC')
+
+
+def record_log(count=3000, seed=11):
+    '''Mixed flow over two markets: limit, market, stop, stop-limit and
+    iceberg orders, cancels and stop cancels, some records without a
+    timestamp or an order id.'''
+    rng = random.Random(seed)
+    records = []
+    order_id = 0
+    timestamp = 1700000000000
+    for _ in range(count):
+        symbol = rng.choice(SYMBOLS)
+        timestamp += rng.randint(0, 3)
+        roll = rng.random()
+        if roll < 0.2 and order_id:
+            record = {'op': 'cancel', 'symbol': symbol, 'side': rng.choice(('bid', 'ask')),
+                      'order_id': rng.randint(1, order_id)}
+        elif roll < 0.23 and order_id:
+            record = {'op': 'cancel_stop', 'symbol': symbol, 'order_id': rng.randint(1, order_id)}
+        else:
+            order_id += 1
+            side = rng.choice(('bid', 'ask'))
+            record = {'op': 'order', 'symbol': symbol, 'side': side, 'quantity': str(rng.randint(1, 20)),
+                      'account': 'acct%d' % rng.randint(0, 9), 'order_id': order_id}
+            kind = rng.random()
+            price = str(100 + rng.randint(-10, 10)) + rng.choice(('', '.25', '.5'))
+            if kind < 0.1:
+                record['type'] = 'market'
+            elif kind < 0.15:
+                record.update(type='stop', stopPrice=price)
+            elif kind < 0.2:
+                record.update(type='stop_limit', stopPrice=price, price=price)
+            else:
+                record.update(type='limit', price=price)
+                if kind > 0.95:
+                    record['displayQuantity'] = '1'
+            if rng.random() < 0.1:
+                del record['order_id']
+        if rng.random() < 0.9:
+            record['timestamp'] = timestamp
+        records.append(record)
+    return records
+
+
+def run(records):
+    replay = Replay()
+    digests = [digest for _, _, digest in replay.run(records)]
+    roots = {symbol: book.commitment.root() for symbol, book in replay.books.items()}
+    return replay, digests, roots
+
+
+def test_replaying_a_log_twice_gives_the_same_state(tmp_path):
+    path = tmp_path / 'flow.ndjson'
+    with open(path, 'w') as f:
+        write_ndjson(record_log(), f)
+    first, first_digests, first_roots = run(read_log(str(path)))
+    second, second_digests, second_roots = run(read_log(str(path)))
+    assert first.trades > 0 and first.rejected > 0
+    assert first_digests == second_digests
+    assert first_roots == second_roots
+    for symbol, book in first.books.items():
+        assert book.get_orderbook(symbol) == second.books[symbol].get_orderbook(symbol)
+        assert book.time == second.books[symbol].time
+    assert replay_job({'path': str(path)})['digest'] == first.digest.hex()
+
+
+def test_binary_log_replays_like_ndjson(tmp_path):
+    records = record_log()
+    ndjson, binary = tmp_path / 'flow.ndjson', tmp_path / 'flow.bin'
+    with open(ndjson, 'w') as f:
+        write_ndjson(records, f)
+    with open(binary, 'wb') as f:
+        write_binary(records, f)
+    assert run(read_log(str(ndjson)))[1:] == run(read_log(str(binary)))[1:]
+
+
+def test_a_changed_log_diverges_at_the_changed_step():
+    records = record_log()
+    changed = [dict(record) for record in records]
+    step = next(i for i, record in enumerate(changed) if i > 1000 and record.get('type') == 'limit')
+    changed[step]['quantity'] = str(int(changed[step]['quantity']) + 1)
+    digests, changed_digests = run(records)[1], run(changed)[1]
+    assert digests[:step] == changed_digests[:step]
+    assert digests[step] != changed_digests[step]
@@ -0,0 +1,134 @@
+'''
+Checks of the binary book snapshot (snapshot.py): every resting order comes
+back with its exact Decimals, queue position and iceberg reserve, the loaded
+book matches like the one that was saved, a failed write leaves the previous
+snapshot in place and files that are not whole snapshots are refused.
+
+    python -m pytest orderbook/test/test_snapshots.py
+'''
+import os
+import random
+import tempfile
+from decimal import Decimal
+import pytest
+from orderbook import OrderBook
+from orderbook.clock import LogicalClock
+from orderbook.snapshot import write_snapshot, load_snapshot
+
+FIELDS = ('order_id', 'timestamp', 'price', 'quantity', 'trade_id', 'account', 'side',
+          'baseAsset', 'quoteAsset', 'peak', 'hidden')
+
+
+def flow(order_book, rng, steps):
+    '''Random adds, cancels and iceberg orders at prices with many digits,
+    like the Decimals built from JSON floats. Sizes have few enough digits
+    for the running volumes to stay exact.'''
+    for _ in range(steps):
+        side = rng.choice(('bid', 'ask'))
+        tree = order_book.bids if side == 'bid' else order_book.asks
+        roll = rng.random()
+        if roll < 0.15 and len(tree):
+            order_book.cancel_order(side, rng.choice(sorted(tree.order_map)))
+            continue
+        quantity = Decimal('%.8f' % rng.uniform(1, 9))
+        quote = {'type': 'limit', 'side': side, 'price': Decimal(rng.choice((99.1, 99.7, 100.3, 100.9))),
+                 'quantity': quantity, 'trade_id': 't%d' % rng.randint(0, 9),
+                 'account': 'acct%d' % rng.randint(0, 3), 'baseAsset': 'BASE', 'quoteAsset': 'QUOTE'}
+        if roll > 0.9:
+            quote['displayQuantity'] = quantity / 4
+        order_book.process_order(quote, False, False)
+
+
+def orders(tree):
+    '''Every order of tree, level by level in queue order.'''
+    return [[tuple(getattr(order, name, None) for name in FIELDS) for order in tree.get_price_list(price)]
+            for price in tree.prices]
+
+
+def round_trip(order_book, symbol='BASE_QUOTE'):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'book.snap')
+        write_snapshot(order_book, path, symbol)
+        return load_snapshot(path)
+
+
+def test_orders_round_trip():
+    order_book = OrderBook(clock=LogicalClock())
+    flow(order_book, random.Random(1), 3000)
+    assert any(order.peak is not None for tree in (order_book.bids, order_book.asks)
+               for order in tree.order_map.values())
+    symbol, loaded = round_trip(order_book)
+    assert symbol == 'BASE_QUOTE'
+    for tree, restored in ((order_book.bids, loaded.bids), (order_book.asks, loaded.asks)):
+        assert orders(restored) == orders(tree)
+        assert restored.volume == tree.volume
+        assert restored.num_orders == tree.num_orders and restored.depth == tree.depth
+        for price in tree.prices:
+            assert restored.get_price_list(price).volume == tree.get_price_list(price).volume
+            assert len(restored.get_price_list(price)) == len(tree.get_price_list(price))
+    assert (loaded.time, loaded.next_order_id, loaded.last_timestamp) == \
+        (order_book.time, order_book.next_order_id, order_book.last_timestamp)
+    for side in ('bid', 'ask'):
+        top, restored_top = order_book.top_of_book[side], loaded.top_of_book[side]
+        assert (restored_top and restored_top['encoded']) == (top and top['encoded'])
+
+
+def test_loaded_book_matches_the_same():
+    order_book = OrderBook(clock=LogicalClock())
+    flow(order_book, random.Random(2), 2000)
+    _, loaded = round_trip(order_book)
+    loaded.clock = LogicalClock(start=order_book.clock.now + 1)
+    order_book.clock = LogicalClock(start=order_book.clock.now + 1)
+    saved_trades = len(order_book.tape)
+    flow(order_book, random.Random(3), 1000)
+    flow(loaded, random.Random(3), 1000)
+    assert len(loaded.tape) > 0
+    assert [(t['price'], t['quantity'], t['party1'], t['party2']) for t in loaded.tape] == \
+        [(t['price'], t['quantity'], t['party1'], t['party2']) for t in list(order_book.tape)[saved_trades:]]
+    assert orders(loaded.bids) == orders(order_book.bids)
+    assert orders(loaded.asks) == orders(order_book.asks)
+
+
+def test_empty_book_round_trip():
+    _, loaded = round_trip(OrderBook(), '')
+    assert len(loaded.bids) == 0 and len(loaded.asks) == 0
+    assert loaded.top_of_book['bid'] is None and loaded.top_of_book['ask'] is None
+
+
+def test_failed_write_keeps_previous_snapshot(monkeypatch):
+    order_book = OrderBook(clock=LogicalClock())
+    flow(order_book, random.Random(4), 200)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'book.snap')
+        write_snapshot(order_book, path)
+        flow(order_book, random.Random(5), 200)
+
+        def failing_fsync(fd):
+            raise OSError('disk full')
+        with monkeypatch.context() as patch:
+            patch.setattr(os, 'fsync', failing_fsync)
+            with pytest.raises(OSError):
+                write_snapshot(order_book, path)
+        assert os.listdir(directory) == ['book.snap']
+        _, loaded = load_snapshot(path)
+    assert loaded.next_order_id < order_book.next_order_id
+
+
+def test_bad_files_are_refused():
+    order_book = OrderBook(clock=LogicalClock())
+    flow(order_book, random.Random(6), 200)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'book.snap')
+        write_snapshot(order_book, path)
+        with open(path, 'rb') as f:
+            data = f.read()
+        for name, content in (('truncated', data[:-40]), ('other', b'not a snapshot' * 10)):
+            bad = os.path.join(directory, name)
+            with open(bad, 'wb') as f:
+                f.write(content)
+            try:
+                load_snapshot(bad)
+            except ValueError:
+                continue
+            assert False, '%s file was loaded' % name
+
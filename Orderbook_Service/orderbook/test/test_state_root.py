@@ -0,0 +1,77 @@
+'''
+Checks of the Merkle commitment over resting orders (commitment.py):
+inclusion proofs verify against the root, two books fed the same order flow
+have the same root, and a snapshot round trip keeps the root and the slots
+the book hands out next.
+
+    python -m pytest orderbook/test/test_state_root.py
+'''
+import os
+import random
+import tempfile
+from decimal import Decimal
+from orderbook import OrderBook
+from orderbook.clock import LogicalClock
+from orderbook.commitment import verify_proof
+from orderbook.snapshot import write_snapshot, load_snapshot
+
+
+def flow(order_book, rng, steps):
+    '''Random adds, fills, cancels, amends and iceberg orders.'''
+    for _ in range(steps):
+        side = rng.choice(('bid', 'ask'))
+        roll = rng.random()
+        tree = order_book.bids if side == 'bid' else order_book.asks
+        if roll < 0.15 and len(tree):
+            order_book.cancel_order(side, rng.choice(sorted(tree.order_map)))
+        elif roll < 0.25 and len(tree):
+            order_book.amend_order(side, rng.choice(sorted(tree.order_map)), rng.randint(1, 9))
+        else:
+            quantity = rng.randint(1, 9)
+            price = rng.randint(95, 105)
+            quote = {'type': 'limit', 'side': side, 'price': Decimal(price), 'quantity': Decimal(quantity),
+                     'trade_id': 't', 'account': 'acct%d' % rng.randint(0, 3),
+                     'baseAsset': 'BASE', 'quoteAsset': 'QUOTE'}
+            if roll > 0.95 and quantity > 1:
+                quote['displayQuantity'] = Decimal(1)
+            order_book.process_order(quote, False, False)
+
+
+def test_proofs_verify():
+    order_book = OrderBook(clock=LogicalClock())
+    flow(order_book, random.Random(1), 500)
+    root = order_book.commitment.root()
+    for side, tree in (('bid', order_book.bids), ('ask', order_book.asks)):
+        for order_id in tree.order_map:
+            proof = order_book.commitment.proof(side, order_id)
+            assert verify_proof(proof['fields'], proof['index'],
+                                [bytes.fromhex(sibling) for sibling in proof['siblings']], root)
+    assert order_book.commitment.proof('bid', -1) is None
+
+
+def test_same_flow_same_root():
+    first = OrderBook(clock=LogicalClock())
+    second = OrderBook(clock=LogicalClock())
+    flow(first, random.Random(2), 1000)
+    flow(second, random.Random(2), 1000)
+    assert first.commitment.root() == second.commitment.root()
+    flow(first, random.Random(3), 10)
+    assert first.commitment.root() != second.commitment.root()
+
+
+def test_root_survives_snapshot():
+    order_book = OrderBook(clock=LogicalClock())
+    flow(order_book, random.Random(4), 2000)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'book.snap')
+        write_snapshot(order_book, path)
+        _, loaded = load_snapshot(path)
+    assert loaded.commitment.root() == order_book.commitment.root()
+    assert loaded.commitment.slots == order_book.commitment.slots
+    # Both keep handing out the same slots
+    loaded.clock = LogicalClock(start=order_book.clock.now + 1)
+    order_book.clock = LogicalClock(start=order_book.clock.now + 1)
+    flow(order_book, random.Random(5), 500)
+    flow(loaded, random.Random(5), 500)
+    assert loaded.commitment.root() == order_book.commitment.root()
+
@@ -0,0 +1,115 @@
+'''
+Checks of the running market statistics of a book (stats.py) against
+figures recomputed from every recorded trade, with a fake clock: last price
+and direction, session VWAP, and the rolling window's volume, high and low
+as buckets expire, on record and on read.
+
+    python -m pytest orderbook/test/test_stats.py
+'''
+import random
+from decimal import Decimal
+import pytest
+from orderbook import OrderBook
+from orderbook.clock import LogicalClock
+from orderbook.stats import MarketStats, WINDOW_MS
+
+# A short window so a test runs through many expiries
+WINDOW = 60 * 1000
+BUCKET = 5 * 1000
+
+
+class FakeClock(object):
+    '''Milliseconds moved forward by hand.'''
+
+    def __init__(self, now=1700000000000):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, ms):
+        self.now += ms
+
+
+def expected(trades, now):
+    '''The snapshot at now, from the list of (timestamp, price, quantity).'''
+    newest = now - now % BUCKET
+    window = [t for t in trades if newest - (t[0] - t[0] % BUCKET) < WINDOW]
+    volume = sum((t[2] for t in trades), Decimal(0))
+    direction = None
+    for previous, trade in zip(trades, trades[1:]):
+        if trade[1] != previous[1]:
+            direction = 'up' if trade[1] > previous[1] else 'down'
+    return {
+        'lastTradePrice': float(trades[-1][1]) if trades else None,
+        'priceChangeIndicator': direction,
+        'vwap': float(sum(t[1] * t[2] for t in trades) / volume) if volume else None,
+        'sessionVolume': float(volume),
+        'volume24h': float(sum((t[2] for t in window), Decimal(0))),
+        'high24h': float(max(t[1] for t in window)) if window else None,
+        'low24h': float(min(t[1] for t in window)) if window else None
+    }
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_snapshots_match_the_recorded_trades(seed):
+    rng = random.Random(seed)
+    clock = FakeClock()
+    stats = MarketStats(WINDOW, BUCKET)
+    trades = []
+    assert stats.snapshot(clock()) == expected(trades, clock())
+    for _ in range(800):
+        # Mostly trades within a bucket, some gaps of several buckets or
+        # more than the whole window
+        clock.advance(rng.choice((0, 10, 300, 900, 4999, 5000, 17000, 59000, 61000, 200000)))
+        if rng.random() < 0.8:
+            trade = (clock(), Decimal(rng.randint(80, 120)), Decimal(rng.randint(1, 10)))
+            stats.record(*trade)
+            trades.append(trade)
+        # Reads at any time after the last trade, which must not change the stats
+        ahead = clock() + rng.choice((0, 1000, 30000, 70000))
+        assert stats.snapshot(ahead) == expected(trades, ahead)
+        assert stats.snapshot(clock()) == expected(trades, clock())
+
+
+def test_extremes_are_recomputed_only_when_they_expire():
+    stats = MarketStats(WINDOW, BUCKET)
+    stats.record(0, Decimal(150), Decimal(1))  # the high, in the first bucket
+    stats.record(20000, Decimal(90), Decimal(1))  # the low
+    stats.record(40000, Decimal(100), Decimal(1))
+    calls = []
+    window_extremes = stats._window_extremes
+    stats._window_extremes = lambda excluded: calls.append(excluded) or window_extremes(excluded)
+    stats.record(55000, Decimal(110), Decimal(1))  # nothing expires yet
+    assert calls == []
+    stats.record(60000, Decimal(105), Decimal(1))  # the bucket of the high expires
+    assert len(calls) == 1
+    assert (stats.rolling_high, stats.rolling_low, stats.rolling_volume) == (110, 90, 4)
+    stats.record(64000, Decimal(100), Decimal(1))  # same bucket, nothing expires
+    assert len(calls) == 1
+
+
+def test_late_trade_counts_in_the_newest_bucket():
+    stats = MarketStats(WINDOW, BUCKET)
+    stats.record(50000, Decimal(10), Decimal(1))
+    stats.record(12000, Decimal(30), Decimal(2))
+    assert stats.snapshot(50000)['volume24h'] == 3.0
+    # Both expire with the newest bucket, not with the bucket of 12000
+    assert stats.snapshot(105000)['volume24h'] == 3.0
+    assert stats.snapshot(110000)['volume24h'] == 0.0
+
+
+def test_book_stats_follow_its_clock():
+    clock = LogicalClock(start=1000)
+    order_book = OrderBook(clock=clock)
+    maker = {'type': 'limit', 'side': 'ask', 'price': Decimal(5), 'quantity': Decimal(3), 'trade_id': 'm',
+             'account': 'm', 'baseAsset': 'BASE', 'quoteAsset': 'QUOTE'}
+    order_book.process_order(maker, False, False)
+    order_book.process_order(dict(maker, side='bid', quantity=Decimal(2)), False, False)
+    stats = order_book.get_market_stats()
+    assert (stats['lastTradePrice'], stats['volume24h'], stats['vwap']) == (5.0, 2.0, 5.0)
+    # Reads peek at the clock instead of advancing it
+    assert order_book.get_market_stats() == stats and clock.peek() == 1001
+    clock.set(1001 + WINDOW_MS)
+    stats = order_book.get_market_stats()
+    assert (stats['volume24h'], stats['high24h'], stats['sessionVolume']) == (0.0, None, 2.0)
@@ -0,0 +1,97 @@
+'''
+Checks of stop and stop-limit orders: triggering, the one-fill rule for
+triggered stops and pending stops across a snapshot round trip.
+
+    python -m pytest orderbook/test/test_stops.py
+'''
+import os
+import tempfile
+from decimal import Decimal
+from orderbook import OrderBook
+from orderbook.clock import LogicalClock
+from orderbook.snapshot import write_snapshot, load_snapshot
+
+
+def limit(side, price, quantity, trade_id='maker'):
+    return {'type': 'limit', 'side': side, 'price': Decimal(price), 'quantity': Decimal(quantity),
+            'trade_id': trade_id, 'account': trade_id, 'baseAsset': 'BASE', 'quoteAsset': 'QUOTE'}
+
+
+def stop(side, stop_price, quantity, price=None):
+    quote = {'type': 'stop' if price is None else 'stop_limit', 'side': side,
+             'stopPrice': Decimal(stop_price), 'quantity': Decimal(quantity),
+             'trade_id': 'stopper', 'account': 'stopper', 'baseAsset': 'BASE', 'quoteAsset': 'QUOTE'}
+    if price is not None:
+        quote['price'] = Decimal(price)
+    return quote
+
+
+def book_with_asks():
+    order_book = OrderBook(clock=LogicalClock())
+    for price in (101, 102, 103):
+        order_book.process_order(limit('ask', price, 3), False, False)
+    return order_book
+
+
+def test_stop_fills_best_order_only():
+    order_book = book_with_asks()
+    assert order_book.process_order(stop('bid', 101, 2), False, False)['success']
+    result = order_book.process_order(limit('bid', 101, 1, 'taker'), False, False)
+    assert len(result['triggered']) == 1
+    triggered = result['triggered'][0]
+    assert triggered['success'] and triggered['type'] == 'stop'
+    assert len(triggered['trades']) == 1
+    assert triggered['trades'][0]['price'] == 101
+    assert triggered['task_id'] == 4
+    assert order_book.asks.min_price() == 102
+
+
+def test_stop_larger_than_best_order_is_rejected():
+    order_book = book_with_asks()
+    order_book.process_order(stop('bid', 101, 10), False, False)
+    result = order_book.process_order(limit('bid', 101, 1, 'taker'), False, False)
+    triggered = result['triggered'][0]
+    assert not triggered['success']
+    assert triggered['trades'] == []
+    # Nothing beyond the taker's own fill left the book
+    assert order_book.asks.volume == 8
+    assert len(order_book.asks) == 3
+    assert len(order_book.stops) == 0
+
+
+def test_stop_without_liquidity_is_rejected():
+    order_book = OrderBook(clock=LogicalClock())
+    order_book.process_order(limit('ask', 101, 1), False, False)
+    order_book.process_order(stop('bid', 101, 1), False, False)
+    result = order_book.process_order(limit('bid', 101, 1, 'taker'), False, False)
+    assert not result['triggered'][0]['success']
+
+
+def test_stop_limit_rests():
+    order_book = book_with_asks()
+    order_book.process_order(stop('bid', 101, 2, price=100), False, False)
+    result = order_book.process_order(limit('bid', 101, 1, 'taker'), False, False)
+    triggered = result['triggered'][0]
+    assert triggered['success'] and triggered['type'] == 'stop_limit'
+    assert triggered['order'] is not None
+    assert order_book.bids.max_price() == 100
+
+
+def test_pending_stops_survive_snapshot():
+    order_book = book_with_asks()
+    order_book.process_order(stop('bid', 102, 2), False, False)
+    order_book.process_order(stop('bid', 102, 1, price=101), False, False)
+    order_book.process_order(stop('ask', 90, 5), False, False)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'book.snap')
+        write_snapshot(order_book, path, 'BASE_QUOTE')
+        _, loaded = load_snapshot(path)
+    assert list(loaded.stops.stop_map) == list(order_book.stops.stop_map)
+    for order_id, quote in order_book.stops.stop_map.items():
+        restored = loaded.stops.get(order_id)
+        for key in ('type', 'side', 'stopPrice', 'quantity', 'trade_id', 'account', 'timestamp'):
+            assert restored[key] == quote[key], key
+        assert restored.get('price') == quote.get('price')
+    assert [list(level) for level in loaded.stops.buy_stops.values()] == \
+        [list(level) for level in order_book.stops.buy_stops.values()]
+
@@ -0,0 +1,153 @@
+'''
+Checks of the trade history of a book (trades.py) against a plain list of
+the recorded trades, with a fake clock: time ranges, candles of every
+interval, a clock stepping back, and the amortized trimming of the trade
+and candle caps.
+
+    python -m pytest orderbook/test/test_trades.py
+'''
+import random
+from decimal import Decimal
+import pytest
+from orderbook import OrderBook
+from orderbook.clock import LogicalClock
+from orderbook.trades import CANDLE_INTERVALS, Candles, TradeStore
+
+
+class FakeClock(object):
+    '''Milliseconds moved forward by hand.'''
+
+    def __init__(self, now=1700000000000):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, ms):
+        self.now += ms
+
+
+def record_trades(store, count, seed=3):
+    '''Record count trades at fake clock times, a few ms to a few minutes
+    apart; returns them as (timestamp, price, quantity, side, maker) tuples.'''
+    rng = random.Random(seed)
+    clock = FakeClock()
+    trades = []
+    for i in range(count):
+        clock.advance(rng.choice((0, 1, 7, 250, 999, 1000, 45000, 61000, 3600000)))
+        trade = (clock(), Decimal(100 + rng.randint(-50, 50)) / 4, Decimal(rng.randint(1, 9)),
+                 rng.choice(('bid', 'ask')), i + 1)
+        store.record(*trade)
+        trades.append(trade)
+    return trades
+
+
+def expected_candles(trades, interval):
+    candles = []
+    for timestamp, price, quantity, _, _ in trades:
+        start = timestamp - timestamp % interval
+        if candles and candles[-1]['time'] == start:
+            candle = candles[-1]
+            candle['high'] = max(candle['high'], float(price))
+            candle['low'] = min(candle['low'], float(price))
+            candle['close'] = float(price)
+            candle['volume'] += float(quantity)
+            candle['trades'] += 1
+        else:
+            candles.append({'time': start, 'open': float(price), 'high': float(price), 'low': float(price),
+                            'close': float(price), 'volume': float(quantity), 'trades': 1})
+    return candles
+
+
+def test_ranges_match_the_recorded_trades():
+    store = TradeStore()
+    trades = record_trades(store, 2000)
+    rng = random.Random(5)
+    first, last = trades[0][0], trades[-1][0]
+    for _ in range(200):
+        start, end = sorted(rng.randint(first - 10, last + 10) for _ in range(2))
+        limit = rng.choice((None, 1, 10, 1000))
+        expected = [t for t in trades if start <= t[0] < end]
+        if limit is not None:
+            expected = expected[-limit:]
+        assert [(t['timestamp'], t['makerOrderId']) for t in store.range(start, end, limit)] == \
+            [(t[0], t[4]) for t in expected]
+    assert len(store.range()) == len(trades)
+
+
+@pytest.mark.parametrize('name', sorted(CANDLE_INTERVALS))
+def test_candles_match_the_recorded_trades(name):
+    store = TradeStore()
+    trades = record_trades(store, 2000)
+    candles = expected_candles(trades, CANDLE_INTERVALS[name])
+    assert store.get_candles(name) == candles
+    # A range starting inside a bucket includes that bucket
+    middle = candles[len(candles) // 2]['time']
+    assert store.get_candles(name, middle + 1, None, 5) == [c for c in candles if c['time'] >= middle][-5:]
+    with pytest.raises(ValueError):
+        store.get_candles('5m')
+
+
+def test_clock_stepping_back_keeps_the_history_sorted():
+    store = TradeStore()
+    store.record(5000, Decimal(10), Decimal(1), 'bid', 1)
+    store.record(4000, Decimal(12), Decimal(2), 'ask', 2)
+    assert [t['timestamp'] for t in store.range()] == [5000, 5000]
+    assert store.range(4500, 5001)[1]['makerOrderId'] == 2
+    assert store.get_candles('1s') == [{'time': 5000, 'open': 10.0, 'high': 12.0, 'low': 10.0, 'close': 12.0,
+                                        'volume': 3.0, 'trades': 2}]
+
+
+def test_trade_cap_is_enforced_in_batches():
+    cap = 80
+    store = TradeStore(max_trades=cap)
+    lengths = []
+    trades = []
+    clock = FakeClock()
+    for i in range(1000):
+        clock.advance(1)
+        trades.append((clock(), Decimal(1), Decimal(1), 'bid', i))
+        store.record(*trades[-1])
+        lengths.append(len(store))
+    # Never more than an eighth over the cap, dropped back to the cap at once
+    assert max(lengths) == cap + cap // 8 - 1
+    trims = sum(1 for before, after in zip(lengths, lengths[1:]) if after < before)
+    assert trims == (1000 - cap) // (cap // 8)
+    # What is kept is the most recent trades
+    assert [t['makerOrderId'] for t in store.range()] == [t[4] for t in trades[-len(store):]]
+
+
+def test_candle_cap_and_set_limits():
+    store = TradeStore(max_candles=16)
+    for i in range(100):
+        store.record(i * 1000, Decimal(i), Decimal(1), 'bid', i)
+    candles = store.candles['1s']
+    assert 16 <= len(candles) < 16 + 2
+    assert store.get_candles('1s')[-1]['time'] == 99000
+    assert len(store.candles['1m']) == 2
+    store.set_limits(10, 4)
+    assert len(store) == 10 and len(candles) == 4
+    assert [c['time'] for c in store.get_candles('1s')] == [96000, 97000, 98000, 99000]
+    store.set_limits(None, None)
+    store.record(100000, Decimal(1), Decimal(1), 'bid', 100)
+    assert len(store) == 11 and len(candles) == 5
+
+
+def test_late_trade_is_folded_into_the_current_candle():
+    candles = Candles(1000)
+    candles.record(5500, Decimal(3), Decimal(1))
+    candles.record(4200, Decimal(1), Decimal(2))
+    assert candles.range() == [{'time': 5000, 'open': 3.0, 'high': 3.0, 'low': 1.0, 'close': 1.0,
+                                'volume': 3.0, 'trades': 2}]
+
+
+def test_book_records_trades_at_its_clock():
+    order_book = OrderBook(clock=LogicalClock(start=10000, step=400))
+    maker = {'type': 'limit', 'side': 'ask', 'price': Decimal(5), 'quantity': Decimal(3), 'trade_id': 'm',
+             'account': 'm', 'baseAsset': 'BASE', 'quoteAsset': 'QUOTE'}
+    order_book.process_order(maker, False, False)
+    for _ in range(3):
+        order_book.process_order(dict(maker, side='bid', quantity=Decimal(1), trade_id='t', account='t'),
+                                 False, False)
+    assert [t['timestamp'] for t in order_book.trades.range()] == [10400, 10800, 11200]
+    assert [(c['time'], c['trades']) for c in order_book.trades.get_candles('1s')] == [(10000, 2), (11000, 1)]
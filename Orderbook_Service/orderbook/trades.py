@@ -0,0 +1,160 @@
+from bisect import bisect_left
+
+# Candle intervals kept for every book, name : length in milliseconds
+CANDLE_INTERVALS = {
+    '1s': 1000,
+    '1m': 60 * 1000,
+    '1h': 60 * 60 * 1000,
+}
+
+
+def _excess(length, cap):
+    # Entries to drop from the front of columns holding length entries. A cap
+    # is only enforced once the columns are an eighth over it, so trimming a
+    # list from the front costs O(1) amortized per record.
+    if cap is None or length < cap + max(cap // 8, 1):
+        return 0
+    return length - cap
+
+
+def _drop_front(columns, count):
+    for column in columns:
+        del column[:count]
+
+
+class Candles(object):
+    '''
+    OHLCV candles of one interval, stored column-wise in bucket order. A trade
+    either updates the last candle or opens a new one, so recording is O(1)
+    and a range query is a bisect plus a slice. With max_candles set only the
+    most recent candles are kept.
+    '''
+
+    def __init__(self, interval, max_candles=None):
+        self.interval = interval
+        self.max_candles = max_candles
+        self.starts = []
+        self.opens = []
+        self.highs = []
+        self.lows = []
+        self.closes = []
+        self.volumes = []
+        self.counts = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    def record(self, timestamp, price, quantity):
+        start = timestamp - timestamp % self.interval
+        if self.starts and self.starts[-1] >= start:
+            # Same bucket (or a late trade, folded into the current candle)
+            if price > self.highs[-1]:
+                self.highs[-1] = price
+            if price < self.lows[-1]:
+                self.lows[-1] = price
+            self.closes[-1] = price
+            self.volumes[-1] += quantity
+            self.counts[-1] += 1
+        else:
+            self.starts.append(start)
+            self.opens.append(price)
+            self.highs.append(price)
+            self.lows.append(price)
+            self.closes.append(price)
+            self.volumes.append(quantity)
+            self.counts.append(1)
+            self.trim(_excess(len(self.starts), self.max_candles))
+
+    def columns(self):
+        return (self.starts, self.opens, self.highs, self.lows, self.closes, self.volumes, self.counts)
+
+    def trim(self, count):
+        if count > 0:
+            _drop_front(self.columns(), count)
+
+    def range(self, start=None, end=None, limit=None):
+        '''Candles whose bucket starts in [start, end), oldest first.'''
+        lo = 0 if start is None else bisect_left(self.starts, start - start % self.interval)
+        hi = len(self.starts) if end is None else bisect_left(self.starts, end)
+        if limit is not None and hi - lo > limit:
+            lo = hi - limit
+        return [{
+            'time': self.starts[i],
+            'open': float(self.opens[i]),
+            'high': float(self.highs[i]),
+            'low': float(self.lows[i]),
+            'close': float(self.closes[i]),
+            'volume': float(self.volumes[i]),
+            'trades': self.counts[i]
+        } for i in range(lo, hi)]
+
+
+class TradeStore(object):
+    '''
+    Time-indexed trade history of one book. Trades are kept column-wise in
+    arrival order, the timestamp column is non-decreasing so time ranges are
+    found by bisect, and candles for every interval in CANDLE_INTERVALS are
+    updated as each trade is recorded.
+
+    max_trades and max_candles (per interval) bound the history, None keeps
+    everything; see BookLimits, which sets them like the tape cap.
+    '''
+
+    def __init__(self, max_trades=None, max_candles=None):
+        self.max_trades = max_trades
+        self.timestamps = []
+        self.prices = []
+        self.quantities = []
+        self.sides = []  # side of the incoming (taker) order
+        self.maker_order_ids = []
+        self.candles = {name: Candles(interval, max_candles) for name, interval in CANDLE_INTERVALS.items()}
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def record(self, timestamp, price, quantity, side, maker_order_id):
+        if self.timestamps and timestamp < self.timestamps[-1]:
+            # Keep the column sorted; a clock step back must not break bisect
+            timestamp = self.timestamps[-1]
+        self.timestamps.append(timestamp)
+        self.prices.append(price)
+        self.quantities.append(quantity)
+        self.sides.append(side)
+        self.maker_order_ids.append(maker_order_id)
+        self.trim(_excess(len(self.timestamps), self.max_trades))
+        for candles in self.candles.values():
+            candles.record(timestamp, price, quantity)
+
+    def trim(self, count):
+        if count > 0:
+            _drop_front((self.timestamps, self.prices, self.quantities, self.sides, self.maker_order_ids), count)
+
+    def set_limits(self, max_trades, max_candles):
+        '''Change the caps and drop what is over them right away.'''
+        self.max_trades = max_trades
+        if max_trades is not None:
+            self.trim(len(self.timestamps) - max_trades)
+        for candles in self.candles.values():
+            candles.max_candles = max_candles
+            if max_candles is not None:
+                candles.trim(len(candles) - max_candles)
+
+    def range(self, start=None, end=None, limit=None):
+        '''Trades with timestamp in [start, end), oldest first. With a limit,
+        the most recent trades of the range are returned.'''
+        lo = 0 if start is None else bisect_left(self.timestamps, start)
+        hi = len(self.timestamps) if end is None else bisect_left(self.timestamps, end)
+        if limit is not None and hi - lo > limit:
+            lo = hi - limit
+        return [{
+            'timestamp': self.timestamps[i],
+            'price': float(self.prices[i]),
+            'quantity': float(self.quantities[i]),
+            'side': self.sides[i],
+            'makerOrderId': self.maker_order_ids[i]
+        } for i in range(lo, hi)]
+
+    def get_candles(self, interval, start=None, end=None, limit=None):
+        if interval not in self.candles:
+            raise ValueError('Unknown candle interval %s' % interval)
+        return self.candles[interval].range(start, end, limit)
@@ -0,0 +1,186 @@
+import queue
+import sqlite3
+import threading
+import time
+
+import metrics
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS trades (
+    id INTEGER PRIMARY KEY,
+    symbol TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    price TEXT NOT NULL,
+    quantity TEXT NOT NULL,
+    maker_trade_id TEXT,
+    maker_side TEXT,
+    maker_order_id INTEGER,
+    maker_remaining TEXT,
+    taker_trade_id TEXT,
+    taker_side TEXT
+);
+CREATE INDEX IF NOT EXISTS trades_symbol_timestamp ON trades (symbol, timestamp);
+CREATE TABLE IF NOT EXISTS order_events (
+    id INTEGER PRIMARY KEY,
+    symbol TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    event TEXT NOT NULL,
+    order_id INTEGER,
+    account TEXT,
+    side TEXT,
+    price TEXT,
+    quantity TEXT
+);
+CREATE INDEX IF NOT EXISTS order_events_order_id ON order_events (order_id);
+'''
+
+_STOP = object()
+
+
+def _text(value):
+    return None if value is None else str(value)
+
+
+class TradeWriter(threading.Thread):
+    '''
+    Writes trades and order lifecycle events to SQLite from a background
+    thread. The request path only builds a tuple and does a non-blocking put
+    on a bounded queue; if the queue is full the event is counted as dropped
+    rather than stalling matching. The writer drains the queue in batches
+    and writes each batch in one transaction with executemany; a batch that
+    fails to write is counted and dropped, and the writer carries on.
+    '''
+
+    def __init__(self, path, max_queue=100000, batch_size=1000):
+        threading.Thread.__init__(self, name='trade-writer', daemon=True)
+        self.path = path
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.errors = 0
+        self.last_error = None
+        self.failed = False  # the database could not be opened, nothing is written
+        self.batches = 0
+        self.rows = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.lag = metrics.histogram('persistence.lag')
+        self.commit_time = metrics.histogram('persistence.commit')
+
+    def _put(self, item):
+        if self.failed:
+            self.dropped += 1
+            return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def submit_trades(self, symbol, trades):
+        # Trade records are the dicts appended to OrderBook.tape, which are
+        # never mutated afterwards, so they can be handed over as they are
+        if trades:
+            self._put(('trades', time.perf_counter(), symbol, trades))
+
+    def submit_order_event(self, symbol, event, timestamp, order_id, account, side, price, quantity):
+        self._put(('order', time.perf_counter(), symbol,
+                   (symbol, timestamp, event, order_id, account, side, _text(price), _text(quantity))))
+
+    def stop(self, timeout=5.0):
+        '''Flush everything queued so far and stop the thread, waiting at
+        most timeout seconds for room in the queue and again for the flush.
+        Events still queued after that are lost with the (daemon) thread.'''
+        if not self.is_alive():
+            return
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            self.last_error = 'Queue still full after %ss, stopped without flushing' % timeout
+            return
+        self.join(timeout)
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'lastError': self.last_error,
+            'batches': self.batches,
+            'rows': self.rows,
+            'lastBatchSize': self.last_batch_size,
+            'maxBatchSize': self.max_batch_size
+        }
+
+    def run(self):
+        connection = None
+        try:
+            connection = sqlite3.connect(self.path)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(SCHEMA)
+        except Exception as e:
+            if connection is not None:
+                connection.close()
+            self.failed = True
+            self.errors += 1
+            self.last_error = str(e)
+            return
+        try:
+            stopping = False
+            while not stopping:
+                batch = [self.queue.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if any(item is _STOP for item in batch):
+                    # Events racing with stop() are still written
+                    batch = [item for item in batch if item is not _STOP]
+                    stopping = True
+                if batch:
+                    try:
+                        self._write(connection, batch)
+                    except Exception as e:
+                        # Keep the writer alive; the batch is lost and counted
+                        self.errors += 1
+                        self.last_error = str(e)
+        finally:
+            connection.close()
+
+    def _write(self, connection, batch):
+        trade_rows = []
+        order_rows = []
+        now = time.perf_counter()
+        self.lag.observe(now - batch[0][1])
+        for kind, _, symbol, payload in batch:
+            if kind == 'trades':
+                for trade in payload:
+                    maker = trade['party1']
+                    taker = trade['party2']
+                    trade_rows.append((symbol, int(trade['timestamp']), str(trade['price']),
+                                       str(trade['quantity']), _text(maker[0]), maker[1], maker[2],
+                                       _text(maker[3]), _text(taker[0]), taker[1]))
+                    # Lifecycle of the resting order that was hit
+                    order_rows.append((symbol, int(trade['timestamp']),
+                                       'filled' if maker[3] is None else 'partially_filled',
+                                       maker[2], _text(maker[0]), maker[1], str(trade['price']),
+                                       _text(maker[3]) if maker[3] is not None else '0'))
+            else:
+                order_rows.append(payload)
+        with connection:
+            if trade_rows:
+                connection.executemany(
+                    'INSERT INTO trades (symbol, timestamp, price, quantity, maker_trade_id, maker_side, '
+                    'maker_order_id, maker_remaining, taker_trade_id, taker_side) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', trade_rows)
+            if order_rows:
+                connection.executemany(
+                    'INSERT INTO order_events (symbol, timestamp, event, order_id, account, side, price, quantity) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', order_rows)
+        self.commit_time.observe(time.perf_counter() - now)
+        self.batches += 1
+        self.rows += len(trade_rows) + len(order_rows)
+        self.last_batch_size = len(batch)
+        if len(batch) > self.max_batch_size:
+            self.max_batch_size = len(batch)
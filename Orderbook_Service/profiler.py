@@ -0,0 +1,55 @@
+import sys
+import threading
+import time
+from collections import Counter
+
+MAX_PROFILE_SECONDS = 60
+MIN_INTERVAL_SECONDS = 0.001
+
+_profile_lock = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def _collapse(frame):
+    # Outermost frame first, as expected by flamegraph.pl / speedscope
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s (%s:%d)' % (code.co_name, code.co_filename, code.co_firstlineno))
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+
+def sample(seconds, interval=0.005):
+    '''
+    Sample the stacks of every other thread in the process for the given
+    number of seconds and return them in the collapsed stack format
+    ("frame;frame;frame count" per line) read by flame graph tools.
+
+    Sampling runs on the calling thread, the threads serving requests are not
+    touched, so this can run against a live service. Only one profile runs at
+    a time; a concurrent call raises ProfilerBusy.
+    '''
+    seconds = min(max(float(seconds), 0), MAX_PROFILE_SECONDS)
+    interval = max(float(interval), MIN_INTERVAL_SECONDS)
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusy('A profile is already running')
+    try:
+        me = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != me:
+                    stacks[_collapse(frame)] += 1
+            samples += 1
+            time.sleep(interval)
+    finally:
+        _profile_lock.release()
+    lines = ['%s %d' % (stack, count) for stack, count in stacks.most_common()]
+    return samples, '\n'.join(lines) + '\n'
@@ -0,0 +1,137 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+def parse_limits(text):
+    '''Parse "endpoint=rate:burst,..." into {endpoint: (rate, burst)}.'''
+    limits = {}
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        endpoint, spec = part.split('=')
+        rate, burst = spec.split(':')
+        limits[endpoint.strip()] = (float(rate), float(burst))
+    return limits
+
+
+class RateLimiter(object):
+    '''
+    Token buckets keyed by (endpoint, key), where key is the account for
+    order endpoints and the client address otherwise. A bucket is a two
+    item list [tokens, last refill], refilled lazily on access, so state is
+    O(1) per key and no timer runs. Buckets are kept in LRU order; each call
+    drops a couple of buckets that have been idle longer than idle_seconds
+    (an idle bucket is full, so forgetting it changes nothing), and max_keys
+    bounds the table when many keys are active at once.
+    '''
+
+    def __init__(self, limits, idle_seconds=300, max_keys=100000, clock=time.monotonic):
+        self.limits = limits  # endpoint : (tokens per second, burst)
+        self.idle_seconds = idle_seconds
+        self.max_keys = max_keys
+        self.clock = clock
+        self.buckets = OrderedDict()
+        self.rejected = {}  # endpoint : count
+        self.lock = threading.Lock()
+
+    def acquire(self, endpoint, key, cost=1.0):
+        '''Take cost tokens. Returns 0 when allowed, otherwise the number of
+        seconds until the request would be allowed.'''
+        limit = self.limits.get(endpoint)
+        if limit is None:
+            return 0
+        rate, burst = limit
+        with self.lock:
+            now = self.clock()
+            bucket_key = (endpoint, key)
+            bucket = self.buckets.get(bucket_key)
+            if bucket is None:
+                bucket = [burst, now]
+                self.buckets[bucket_key] = bucket
+            else:
+                self.buckets.move_to_end(bucket_key)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            self._evict(now)
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return 0
+            self.rejected[endpoint] = self.rejected.get(endpoint, 0) + 1
+            return (cost - bucket[0]) / rate if rate > 0 else self.idle_seconds
+
+    def _evict(self, now):
+        for _ in range(2):
+            if not self.buckets:
+                return
+            oldest_key, oldest = next(iter(self.buckets.items()))
+            if now - oldest[1] < self.idle_seconds and len(self.buckets) <= self.max_keys:
+                return
+            del self.buckets[oldest_key]
+
+    def stats(self):
+        return {'keys': len(self.buckets), 'rejected': dict(self.rejected)}
+
+
+class AdmissionControl(object):
+    '''
+    Caps the number of requests in flight. Ordinary endpoints may only use
+    max_in_flight - reserved slots; the reserved slots are kept for latency
+    critical endpoints, so an order or orderbook flood cannot starve the
+    hook's get_best_order calls. Requests over the cap are shed with a 429
+    before any work is done.
+    '''
+
+    def __init__(self, max_in_flight, reserved=0, critical_paths=()):
+        self.max_in_flight = max_in_flight
+        self.reserved = reserved
+        self.critical_paths = set(critical_paths)
+        self.in_flight = 0
+        self.shed = {}  # path : count
+        self.lock = threading.Lock()
+
+    def try_enter(self, path):
+        limit = self.max_in_flight if path in self.critical_paths else self.max_in_flight - self.reserved
+        with self.lock:
+            if self.in_flight >= limit:
+                self.shed[path] = self.shed.get(path, 0) + 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        return {'inFlight': self.in_flight, 'maxInFlight': self.max_in_flight,
+                'reserved': self.reserved, 'shed': dict(self.shed)}
+
+
+class AdmissionMiddleware:
+    '''ASGI middleware applying AdmissionControl to every HTTP request.'''
+
+    def __init__(self, app, admission):
+        self.app = app
+        self.admission = admission
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if not self.admission.try_enter(scope["path"]):
+            await send({
+                "type": "http.response.start",
+                "status": 429,
+                "headers": [(b"content-type", b"application/json"), (b"retry-after", b"1")],
+            })
+            await send({
+                "type": "http.response.body",
+                "body": b'{"message":"Service overloaded, retry later","status_code":0}',
+            })
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.admission.leave()
@@ -0,0 +1,576 @@
+'''
+Warm-standby replication of the order books to follower processes.
+
+The primary logs every book command it runs (register, cancel, amend,
+cancel-replace, stop orders, and book evictions) with a sequence number and
+the time its book used, after the command ran and in the order the commands
+ran. Followers connect over TCP ("host:port") or a Unix socket
+("unix:/path") and receive the log as NDJSON; each entry is replayed through
+the same OrderBook methods the API uses, with the book clock pinned to the
+primary's time, so a follower's books, order ids and timestamps match the
+primary's. Followers serve the read endpoints and refuse writes.
+
+Handshake: a follower sends {"type": "hello", "epoch", "next"}, the first
+sequence number it is missing, and the primary answers with "welcome" and
+streams from there, or with "error" if it no longer holds that entry or the
+follower applied a different log. Followers keep the entries they applied,
+so any of them can in turn serve the rest after a promotion.
+
+A bulk import is logged as import_begin, one import_chunk per IMPORT_CHUNK
+orders and import_commit, the command that loads the book; followers stage
+the chunks and load them on the commit, and drop them on import_abort.
+
+The log only carries commands, so a follower replays the primary's state
+from empty books: a primary that did not start empty (books loaded from
+snapshots) refuses new followers, and a follower refuses to start with
+books of its own.
+
+Promotion of a follower (promote()) first asks the primary to stop taking
+writes ("promote" -> "fenced" with its last sequence number), waits until
+it applied everything up to that number, then starts accepting writes and,
+if configured, followers of its own. force=True skips the primary, for when
+it is gone.
+
+On the primary a command runs under the lock of its symbol's stripe, so
+commands on different markets run side by side, and costs an append to an
+in-memory list under a short lock; encoding and sending happen in one thread
+per follower.
+'''
+import contextlib
+import json
+import os
+import secrets
+import socket
+import threading
+import time
+import zlib
+from decimal import Decimal
+from orderbook.clock import PinnedClock, wall_clock
+from orderbook.registry import split_symbol
+from orderbook.bulk import BulkImport, chunks, records_from_rows
+from orderbook.memory import command_bytes
+
+ROLE_PRIMARY = 'primary'
+ROLE_FOLLOWER = 'follower'
+ROLE_FENCED = 'fenced'  # former primary after a promotion, read only
+
+DECIMAL_FIELDS = ('price', 'quantity', 'stopPrice', 'displayQuantity')
+HEARTBEAT_SECONDS = 0.5
+BATCH_SIZE = 1000
+# A batch is sent as soon as it holds this many bytes
+SEND_BYTES = 1 << 20
+# Orders per import_chunk entry
+IMPORT_CHUNK = 1000
+RECONNECT_SECONDS = 1.0
+# Book commands take one of these locks, picked by symbol
+LOCK_STRIPES = 64
+
+
+class ReadOnly(Exception):
+    pass
+
+
+def parse_address(text):
+    '''"unix:/path" or "host:port" as (socket family, address).'''
+    if text.startswith('unix:'):
+        return socket.AF_UNIX, text[len('unix:'):]
+    host, _, port = text.rpartition(':')
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+
+def _connect(address, timeout):
+    family, target = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(target)
+    if family == socket.AF_INET:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def _encode(message):
+    return json.dumps(message, default=str, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+def _decode_quote(quote):
+    for name in DECIMAL_FIELDS:
+        if quote.get(name) is not None:
+            quote[name] = Decimal(quote[name])
+    return quote
+
+
+def _staged(imports, symbol, import_id):
+    staged = imports.get(symbol)
+    if staged is None or staged[0] != import_id:
+        raise KeyError('Import %s was not begun' % import_id)
+    return staged
+
+
+def apply_command(registry, symbol, op, args, imports):
+    '''Run a logged command on registry's books, as the API did on the
+    primary. imports holds the bulk imports being staged, by symbol.'''
+    if op == 'import_begin':
+        base_asset, quote_asset = split_symbol(symbol)
+        imports[symbol] = (args['importId'], BulkImport(base_asset, quote_asset), args['replace'])
+        return
+    if op == 'import_chunk':
+        _staged(imports, symbol, args['importId'])[1].add(records_from_rows(args['orders']))
+        return
+    if op == 'import_commit':
+        _, bulk, replace = _staged(imports, symbol, args['importId'])
+        del imports[symbol]
+        bulk.load(registry.get_or_create(symbol), replace)
+        return
+    if op == 'import_abort':
+        if symbol in imports and imports[symbol][0] == args['importId']:
+            del imports[symbol]
+        return
+    if op == 'evict':
+        registry.remove(symbol)
+        return
+    if op == 'order':
+        registry.get_or_create(symbol).process_order(_decode_quote(dict(args)), False, False)
+        return
+    order_book = registry.get(symbol)
+    if order_book is None:
+        raise KeyError('Order book not found: %s' % symbol)
+    if op == 'cancel':
+        order_book.cancel_order(args['side'], args['orderId'])
+    elif op == 'amend':
+        order_book.amend_order(args['side'], args['orderId'], args.get('quantity'), args.get('price'))
+    elif op == 'cancel_replace':
+        order_book.cancel_replace(args['side'], args['orderId'], _decode_quote(dict(args['quote'])))
+    elif op == 'cancel_stop':
+        order_book.cancel_stop(args['orderId'])
+    else:
+        raise ValueError('Unknown command %r' % op)
+
+
+class CommandLog(object):
+    '''
+    The last backlog commands, as (seq, symbol, op, args, book time, wall
+    time) tuples. changed is held to append and is notified on every append;
+    symbol_bytes approximates the memory the entries of each symbol hold.
+    '''
+
+    def __init__(self, backlog):
+        self.backlog = backlog
+        self.entries = []
+        self.first = 1  # sequence number of entries[0]
+        self.last = 0
+        self.changed = threading.Condition(threading.RLock())
+        self.symbol_bytes = {}
+
+    def append(self, symbol, op, args, book_time, wall=None):
+        self.last += 1
+        self.entries.append((self.last, symbol, op, args, book_time, wall or wall_clock()))
+        self.symbol_bytes[symbol] = self.symbol_bytes.get(symbol, 0) + command_bytes(op, args)
+        if len(self.entries) >= self.backlog + max(self.backlog // 8, 1):
+            # Trim in bulk so appends stay O(1) amortized
+            dropped = len(self.entries) - self.backlog
+            for entry in self.entries[:dropped]:
+                remaining = self.symbol_bytes[entry[1]] - command_bytes(entry[2], entry[3])
+                if remaining > 0:
+                    self.symbol_bytes[entry[1]] = remaining
+                else:
+                    del self.symbol_bytes[entry[1]]
+            del self.entries[:dropped]
+            self.first += dropped
+        self.changed.notify_all()
+
+    def bytes(self, symbol=None):
+        if symbol is None:
+            return sum(self.symbol_bytes.values())
+        return self.symbol_bytes.get(symbol, 0)
+
+    def since(self, seq, limit):
+        start = max(seq - self.first, 0)
+        return self.entries[start:start + limit]
+
+
+class BookLocks(object):
+    '''Striped locks; called with a symbol, returns the lock commands on
+    that symbol run under.'''
+
+    def __init__(self, stripes=LOCK_STRIPES):
+        self.locks = [threading.Lock() for _ in range(stripes)]
+
+    def __call__(self, symbol):
+        return self.locks[zlib.crc32(symbol.encode('utf-8')) % len(self.locks)]
+
+
+class Replicator(object):
+    '''
+    Replication state of this process. Also a registry listener: it gives
+    every book the pinned clock and logs evictions while primary.
+    '''
+
+    def __init__(self, registry, role, listen=None, primary=None, backlog=100000):
+        if role not in (ROLE_PRIMARY, ROLE_FOLLOWER):
+            raise ValueError('Replication role must be primary or follower')
+        if role == ROLE_FOLLOWER and not primary:
+            raise ValueError('A follower needs the address of its primary')
+        self.registry = registry
+        self.role = role
+        self.listen = listen
+        self.primary_address = primary
+        self.log = CommandLog(backlog)
+        self.epoch = secrets.token_hex(8) if role == ROLE_PRIMARY else None
+        self.clock = PinnedClock()
+        self.book_lock = BookLocks()
+        # Commands and follower applies between their role check and their
+        # append; a fence or promotion waits for them under log.changed
+        self.in_flight = 0
+        self.started_empty = None
+        self.imports = {}  # symbol : (import id, BulkImport, replace) staged by a follower
+        self.running = False
+        self.server = None
+        self.followers = {}  # connection id : {'address', 'next'}
+        self.next_follower_id = 0
+        # Follower side
+        self.sock = None
+        self.connected = False
+        self.applied = 0
+        self.applied_wall = None  # primary wall time of the last applied entry
+        self.primary_last = 0
+        self.errors = 0
+        self.reconnects = 0
+        self.last_error = None
+        registry.add_listener(self)
+
+    @property
+    def writable(self):
+        return self.role == ROLE_PRIMARY
+
+    def add_book(self, symbol, order_book):
+        order_book.clock = self.clock
+
+    def remove_book(self, symbol):
+        if self.role == ROLE_PRIMARY:
+            with self.log.changed:
+                self.log.append(symbol, 'evict', {}, None)
+
+    def _enter(self, role):
+        with self.log.changed:
+            if self.role != role:
+                return False
+            self.in_flight += 1
+            return True
+
+    def _wait_in_flight(self):
+        # Called with log.changed held, after the role changed
+        while self.in_flight:
+            self.log.changed.wait()
+
+    @contextlib.contextmanager
+    def command(self, symbol, op, args):
+        '''Run the with block as book command op on symbol and log it once
+        the block completes. args are copied first, as the block may mutate
+        them (process_order fills in ids and timestamps). Commands on the
+        same symbol run one at a time, in the order they are logged.'''
+        args = {key: dict(value) if isinstance(value, dict) else value for key, value in args.items()}
+        with self.book_lock(symbol):
+            if not self._enter(ROLE_PRIMARY):
+                raise ReadOnly('Read-only replica, send writes to the primary')
+            completed = False
+            try:
+                yield
+                completed = True
+            finally:
+                with self.log.changed:
+                    self.in_flight -= 1
+                    if completed:
+                        order_book = self.registry.books.get(symbol)
+                        self.log.append(symbol, op, args, order_book.time if order_book is not None else None)
+                    else:
+                        self.log.changed.notify_all()
+
+    @contextlib.contextmanager
+    def bulk_import(self, symbol, bulk, replace):
+        '''Log the orders validated in bulk IMPORT_CHUNK at a time, then run
+        the with block, which loads them into the book, as the import's
+        commit. Each chunk holds the symbol's lock for one append only. If
+        the block fails, followers are told to drop the staged orders.'''
+        import_id = secrets.token_hex(8)
+        with self.command(symbol, 'import_begin', {'importId': import_id, 'replace': replace}):
+            pass
+        try:
+            for rows in chunks(bulk.field_rows(), IMPORT_CHUNK):
+                with self.command(symbol, 'import_chunk', {'importId': import_id, 'orders': rows}):
+                    pass
+            with self.command(symbol, 'import_commit', {'importId': import_id}):
+                yield
+        except Exception:
+            try:
+                with self.command(symbol, 'import_abort', {'importId': import_id}):
+                    pass
+            except ReadOnly:
+                pass
+            raise
+
+    def _books_empty(self):
+        return all(len(order_book.bids) == 0 and len(order_book.asks) == 0 and len(order_book.stops) == 0
+                   and order_book.next_order_id == 0
+                   for _, order_book in self.registry.items())
+
+    def start(self):
+        self.started_empty = self._books_empty()
+        if self.role == ROLE_FOLLOWER and not self.started_empty:
+            raise ValueError('A follower must start with empty books, do not load snapshots on followers')
+        self.running = True
+        if self.role == ROLE_PRIMARY:
+            self._start_server()
+        else:
+            threading.Thread(target=self._follow, name='replication-follower', daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        if self.server is not None:
+            self.server.close()
+        if self.sock is not None:
+            self._close_follower_socket()
+        with self.log.changed:
+            self.log.changed.notify_all()
+
+    # Primary side
+
+    def _start_server(self):
+        if not self.listen or self.server is not None:
+            return
+        family, target = parse_address(self.listen)
+        server = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        else:
+            try:
+                os.unlink(target)
+            except FileNotFoundError:
+                pass
+        server.bind(target)
+        server.listen()
+        self.server = server
+        threading.Thread(target=self._accept, name='replication-server', daemon=True).start()
+
+    def _accept(self):
+        while self.running:
+            try:
+                conn, address = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn, address), name='replication-sender',
+                             daemon=True).start()
+
+    def _serve(self, conn, address):
+        follower_id = None
+        try:
+            if conn.family == socket.AF_INET:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            hello = json.loads(conn.makefile('rb').readline() or b'{}')
+            if hello.get('type') == 'promote':
+                with self.log.changed:
+                    if self.role == ROLE_PRIMARY:
+                        self.role = ROLE_FENCED
+                    # Commands already past their role check still get logged
+                    self._wait_in_flight()
+                    last = self.log.last
+                conn.sendall(_encode({'type': 'fenced', 'epoch': self.epoch, 'last': last}))
+                return
+            if hello.get('type') != 'hello':
+                return
+            next_seq = int(hello['next'])
+            with self.log.changed:
+                error = None
+                if hello.get('epoch') not in (None, self.epoch) or (hello.get('epoch') is None and next_seq != 1):
+                    error = 'Follower applied a different log, start it again with empty books'
+                elif hello.get('epoch') is None and not self.started_empty:
+                    error = ('Primary loaded its books from snapshots, which are not in the log; '
+                             'followers can only replicate a primary that started with empty books')
+                elif next_seq < self.log.first:
+                    error = 'Entry %d is no longer held, start the follower again with empty books' % next_seq
+                elif next_seq > self.log.last + 1:
+                    error = 'Follower is ahead of the primary'
+                follower_id = self.next_follower_id
+                self.next_follower_id += 1
+                self.followers[follower_id] = {'address': str(address or 'unix'), 'next': next_seq}
+                last = self.log.last
+            if error is not None:
+                conn.sendall(_encode({'type': 'error', 'message': error}))
+                return
+            conn.sendall(_encode({'type': 'welcome', 'epoch': self.epoch, 'first': self.log.first, 'last': last}))
+            while self.running:
+                with self.log.changed:
+                    if self.log.last < next_seq:
+                        self.log.changed.wait(HEARTBEAT_SECONDS)
+                    entries = self.log.since(next_seq, BATCH_SIZE)
+                    last = self.log.last
+                if not entries:
+                    conn.sendall(_encode({'type': 'heartbeat', 'last': last, 'wall': wall_clock()}))
+                    continue
+                batch = []
+                size = 0
+                for seq, symbol, op, args, book_time, wall in entries:
+                    data = _encode({'type': 'entry', 'seq': seq, 'symbol': symbol, 'op': op,
+                                    'args': args, 'time': book_time, 'wall': wall})
+                    batch.append(data)
+                    size += len(data)
+                    if size >= SEND_BYTES:
+                        # Import chunks are large, do not build the whole batch
+                        conn.sendall(b''.join(batch))
+                        batch = []
+                        size = 0
+                if batch:
+                    conn.sendall(b''.join(batch))
+                next_seq = entries[-1][0] + 1
+                self.followers[follower_id]['next'] = next_seq
+        except (OSError, ValueError, KeyError):
+            pass
+        finally:
+            if follower_id is not None:
+                self.followers.pop(follower_id, None)
+            conn.close()
+
+    # Follower side
+
+    def _close_follower_socket(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def _follow(self):
+        while self.running and self.role == ROLE_FOLLOWER:
+            try:
+                self.sock = _connect(self.primary_address, 4 * HEARTBEAT_SECONDS)
+                self.sock.sendall(_encode({'type': 'hello', 'epoch': self.epoch, 'next': self.applied + 1}))
+                reader = self.sock.makefile('rb')
+                welcome = json.loads(reader.readline() or b'{}')
+                if welcome.get('type') != 'welcome':
+                    raise ConnectionError(welcome.get('message', 'Primary closed the connection'))
+                self.epoch = welcome['epoch']
+                self.primary_last = max(self.primary_last, welcome['last'])
+                self.connected = True
+                for line in reader:
+                    message = json.loads(line)
+                    if message['type'] == 'entry':
+                        self._apply(message)
+                    elif message['type'] == 'heartbeat':
+                        self.primary_last = max(self.primary_last, message['last'])
+                raise ConnectionError('Primary closed the connection')
+            except (OSError, ValueError) as e:
+                if self.role != ROLE_FOLLOWER or not self.running:
+                    break
+                self.last_error = str(e)
+                self.reconnects += 1
+            finally:
+                self.connected = False
+                if self.sock is not None:
+                    self._close_follower_socket()
+            time.sleep(RECONNECT_SECONDS)
+
+    def _apply(self, message):
+        seq = message['seq']
+        if seq != self.applied + 1:
+            raise ValueError('Expected entry %d, got %d' % (self.applied + 1, seq))
+        with self.book_lock(message['symbol']):
+            if not self._enter(ROLE_FOLLOWER):
+                raise ConnectionError('Promoted')
+            self.clock.pin(message['time'])
+            try:
+                apply_command(self.registry, message['symbol'], message['op'], message['args'], self.imports)
+            except Exception as e:
+                # The primary ran this command; the books have diverged
+                self.errors += 1
+                self.last_error = 'Entry %d: %s' % (seq, e)
+            finally:
+                self.clock.unpin()
+            with self.log.changed:
+                self.in_flight -= 1
+                self.log.append(message['symbol'], message['op'], message['args'], message['time'],
+                                message['wall'])
+                self.applied = seq
+                self.applied_wall = message['wall']
+                self.primary_last = max(self.primary_last, seq)
+
+    def promote(self, force=False, timeout=10.0):
+        '''Make this follower the primary. Returns the last sequence number
+        applied before taking writes.'''
+        if self.role != ROLE_FOLLOWER:
+            raise ValueError('Only a follower can be promoted')
+        if not force:
+            sock = _connect(self.primary_address, timeout)
+            try:
+                sock.sendall(_encode({'type': 'promote'}))
+                fenced = json.loads(sock.makefile('rb').readline() or b'{}')
+            finally:
+                sock.close()
+            if fenced.get('type') != 'fenced' or fenced.get('epoch') != self.epoch:
+                raise ConnectionError('Primary did not confirm the fence')
+            deadline = time.monotonic() + timeout
+            while self.applied < fenced['last']:
+                if time.monotonic() > deadline:
+                    raise TimeoutError('Caught up to %d of %d, the primary is fenced; retry or force'
+                                       % (self.applied, fenced['last']))
+                time.sleep(0.01)
+        with self.log.changed:
+            self._wait_in_flight()
+            self.role = ROLE_PRIMARY
+            # Imports the old primary did not commit never will be
+            self.imports.clear()
+            if self.epoch is None:
+                self.epoch = secrets.token_hex(8)
+        if self.sock is not None:
+            self._close_follower_socket()
+        self._start_server()
+        return self.applied
+
+    def stats(self):
+        stats = {
+            'role': self.role,
+            'epoch': self.epoch,
+            'firstSeq': self.log.first,
+            'lastSeq': self.log.last,
+            'logBytes': self.log.bytes(),
+            'followers': [{'address': follower['address'], 'next': follower['next'],
+                           'lagEntries': self.log.last + 1 - follower['next']}
+                          for follower in list(self.followers.values())]
+        }
+        if self.primary_address is not None:
+            lag_entries = max(self.primary_last - self.applied, 0)
+            stats.update({
+                'primary': self.primary_address,
+                'connected': self.connected,
+                'applied': self.applied,
+                'primaryLastSeq': self.primary_last,
+                'lagEntries': lag_entries,
+                'lagSeconds': ((wall_clock() - self.applied_wall) / 1000.0
+                               if lag_entries and self.applied_wall is not None else 0.0),
+                'errors': self.errors,
+                'reconnects': self.reconnects,
+                'lastError': self.last_error
+            })
+        return stats
+
+
+class ReplicaModeMiddleware:
+    '''Answers 503 on write endpoints unless this process is the primary.'''
+
+    def __init__(self, app, replicator, write_paths):
+        self.app = app
+        self.replicator = replicator
+        self.write_paths = set(write_paths)
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] == "http" and scope["path"] in self.write_paths
+                and not self.replicator.writable):
+            await send({
+                "type": "http.response.start",
+                "status": 503,
+                "headers": [(b"content-type", b"application/json")],
+            })
+            await send({
+                "type": "http.response.body",
+                "body": b'{"message":"Read-only replica, send writes to the primary","status_code":0}',
+            })
+            return
+        await self.app(scope, receive, send)
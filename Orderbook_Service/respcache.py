@@ -0,0 +1,183 @@
+'''
+Cache of encoded response bodies for large read endpoints (/api/orderbook),
+with the compressed encodings of each body computed once, off the request
+path.
+
+An entry is keyed by (symbol, view) and belongs to one book at one
+OrderBook.sequence: a request for the same book at the same sequence reuses
+the stored body, anything else rebuilds it. A new body is handed to the
+compressor thread, which adds its gzip (and brotli/zstd, when those modules
+are installed) encodings, so N pollers of an unchanged book cost one JSON
+encoding and one compression per encoding instead of N.
+'''
+import gzip
+import queue
+import threading
+import time
+from collections import OrderedDict
+import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_STOP = object()
+
+
+def available_encoders():
+    '''Content-Encoding : compress function, most preferred first.'''
+    encoders = OrderedDict()
+    if brotli is not None:
+        encoders['br'] = lambda body: brotli.compress(body, quality=5)
+    if zstandard is not None:
+        # Only ever used from the compressor thread
+        compressor = zstandard.ZstdCompressor(level=3)
+        encoders['zstd'] = compressor.compress
+    encoders['gzip'] = lambda body: gzip.compress(body, compresslevel=6, mtime=0)
+    return encoders
+
+
+def accepted_encodings(header):
+    '''Encodings a client accepts, from its Accept-Encoding header; None
+    stands for "*".'''
+    accepted = set()
+    for part in header.split(','):
+        fields = part.strip().split(';')
+        name = fields[0].strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in fields[1:]:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            accepted.add(None if name == '*' else name)
+    return accepted
+
+
+class CacheEntry(object):
+
+    def __init__(self, key, order_book, sequence, body, created):
+        self.key = key
+        self.order_book = order_book
+        self.sequence = sequence
+        self.created = created
+        self.bodies = {'identity': body}
+        self.ready = threading.Event()  # set once the compressed bodies are in
+
+
+class ResponseCache(threading.Thread):
+    '''
+    Bodies are rebuilt when their book's sequence moves, or after max_age
+    seconds in any case since responses also carry time dependent fields
+    (the rolling 24h stats). Bodies under min_size are not compressed. A
+    request that finds a body still being compressed waits up to wait
+    seconds for it before falling back to the uncompressed body.
+    '''
+
+    def __init__(self, max_entries=1024, max_age=1.0, min_size=1024, wait=0.05, clock=time.monotonic):
+        threading.Thread.__init__(self, name='response-compressor', daemon=True)
+        self.entries = OrderedDict()  # (symbol, view) : CacheEntry, least recently used first
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.min_size = min_size
+        self.wait = wait
+        self.clock = clock
+        self.encoders = available_encoders()
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.compressions = 0
+        self.superseded = 0
+        self.responses = {}  # encoding : [responses, bytes sent, uncompressed bytes]
+        self.compress_time = metrics.histogram('response_cache.compress')
+
+    def get(self, key, order_book):
+        '''Entry for key if it is current for order_book, otherwise None.'''
+        entry = self.entries.get(key)
+        if (entry is None or entry.order_book is not order_book
+                or entry.sequence != order_book.sequence
+                or self.clock() - entry.created > self.max_age):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, key, order_book, sequence, body):
+        '''Store body as the response for key at sequence, read before body
+        was built, and queue it for compression.'''
+        entry = CacheEntry(key, order_book, sequence, body, self.clock())
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        if len(body) >= self.min_size and self.is_alive():
+            self.queue.put(entry)
+        else:
+            entry.ready.set()
+        return entry
+
+    def select(self, entry, accept_encoding):
+        '''(Content-Encoding, body) of entry to send to a client sending
+        accept_encoding; the encoding is "identity" if nothing else fits.'''
+        accepted = accepted_encodings(accept_encoding or '')
+        wanted = [name for name in self.encoders if name in accepted or None in accepted]
+        if wanted and not entry.ready.is_set():
+            entry.ready.wait(self.wait)
+        encoding = 'identity'
+        for name in wanted:
+            if name in entry.bodies:
+                encoding = name
+                break
+        body = entry.bodies[encoding]
+        counts = self.responses.setdefault(encoding, [0, 0, 0])
+        counts[0] += 1
+        counts[1] += len(body)
+        counts[2] += len(entry.bodies['identity'])
+        return encoding, body
+
+    def stop(self, timeout=None):
+        self.queue.put(_STOP)
+        self.join(timeout)
+
+    def run(self):
+        while True:
+            entry = self.queue.get()
+            if entry is _STOP:
+                return
+            if self.entries.get(entry.key) is not entry:
+                # A newer body replaced it before it was compressed
+                self.superseded += 1
+                entry.ready.set()
+                continue
+            started = time.perf_counter()
+            body = entry.bodies['identity']
+            for name, compress in self.encoders.items():
+                entry.bodies[name] = compress(body)
+            self.compress_time.observe(time.perf_counter() - started)
+            self.compressions += 1
+            entry.ready.set()
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'compressions': self.compressions,
+            'superseded': self.superseded,
+            'queued': self.queue.qsize(),
+            'encodings': list(self.encoders),
+            'responses': {encoding: {'responses': counts[0], 'bytes': counts[1], 'uncompressedBytes': counts[2]}
+                          for encoding, counts in self.responses.items()}
+        }
@@ -0,0 +1,276 @@
+'''
+Request tracing with W3C trace context, so one order can be followed across
+Execution_Service, this service, the AVS and Validation_Service.
+
+TraceMiddleware reads the traceparent header of each request and, when the
+request is sampled, records a server span for it plus the child spans an
+endpoint marks with Trace.stage() (parse, match, serialize in
+register_order). Every response carries a traceparent naming this
+service's span, so the caller can parent its next hop on it; an incoming
+tracestate is passed back unchanged.
+
+Sampling follows the caller: a request whose traceparent has the sampled
+flag is always recorded, one without the flag never is, and requests that
+start a new trace are sampled at ORDERBOOK_TRACE_SAMPLE_RATE. Requests that
+are not sampled cost a header lookup and, for new traces, one random number.
+
+Finished spans go on a bounded queue, dropped when it is full, and a
+background thread writes them in batches as OTLP JSON (ExportTraceServiceRequest),
+either appended as one line per batch to a file ("file:/path") or POSTed to
+an OTLP/HTTP collector ("http://127.0.0.1:4318/v1/traces").
+'''
+import json
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+
+TRACEPARENT_RE = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+FLAG_SAMPLED = 0x01
+INVALID_TRACE_ID = '0' * 32
+INVALID_SPAN_ID = '0' * 16
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_STOP = object()
+
+
+def new_trace_id():
+    return '%032x' % random.getrandbits(128)
+
+
+def new_span_id():
+    return '%016x' % random.getrandbits(64)
+
+
+def parse_traceparent(value):
+    '''(trace id, parent span id, sampled) from a traceparent header, or
+    None if it is missing or malformed.'''
+    if not value:
+        return None
+    match = TRACEPARENT_RE.match(value.strip().lower())
+    if match is None:
+        return None
+    trace_id, span_id, flags = match.groups()
+    if trace_id == INVALID_TRACE_ID or span_id == INVALID_SPAN_ID:
+        return None
+    return trace_id, span_id, bool(int(flags, 16) & FLAG_SAMPLED)
+
+
+def format_traceparent(trace_id, span_id, sampled):
+    return '00-%s-%s-%02x' % (trace_id, span_id, FLAG_SAMPLED if sampled else 0)
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+class Trace(object):
+    '''
+    The server span of one sampled request. Times are kept as perf_counter
+    readings and converted to unix nanoseconds against the request's start,
+    so spans within a request are ordered exactly.
+    '''
+
+    def __init__(self, tracer, name, trace_id, parent_span_id):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_span_id()
+        self.parent_span_id = parent_span_id
+        self.start_ns = time.time_ns()
+        self.start = time.perf_counter()
+        self.mark = self.start
+        self.attributes = {}
+        self.children = []  # (name, start, end, attributes)
+
+    def _unix_ns(self, reading):
+        return self.start_ns + int((reading - self.start) * 1e9)
+
+    def stage(self, name, **attributes):
+        '''Record a child span from the end of the previous stage (or the
+        start of the request) to now.'''
+        now = time.perf_counter()
+        self.children.append((name, self.mark, now, attributes))
+        self.mark = now
+
+    def finish(self, status_code):
+        end = time.perf_counter()
+        self.attributes['http.status_code'] = status_code
+        spans = [{
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_span_id or '',
+            'name': self.name,
+            'kind': SPAN_KIND_SERVER,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self._unix_ns(end)),
+            'attributes': [_attribute(key, value) for key, value in self.attributes.items()],
+            'status': {'code': STATUS_ERROR if status_code >= 500 else STATUS_OK}
+        }]
+        for name, started, ended, attributes in self.children:
+            spans.append({
+                'traceId': self.trace_id,
+                'spanId': new_span_id(),
+                'parentSpanId': self.span_id,
+                'name': name,
+                'kind': SPAN_KIND_INTERNAL,
+                'startTimeUnixNano': str(self._unix_ns(started)),
+                'endTimeUnixNano': str(self._unix_ns(ended)),
+                'attributes': [_attribute(key, value) for key, value in attributes.items()]
+            })
+        self.tracer.submit(spans)
+
+
+class Tracer(threading.Thread):
+    '''Batches finished spans and exports them from a background thread.'''
+
+    def __init__(self, export, sample_rate=0.0, service_name='orderbook-service', max_queue=10000,
+                 batch_size=512, flush_seconds=1.0, timeout=2.0):
+        threading.Thread.__init__(self, name='trace-exporter', daemon=True)
+        if not (export.startswith('file:') or export.startswith('http://') or export.startswith('https://')):
+            raise ValueError('Trace export must be file:/path or an http(s) OTLP endpoint')
+        self.export = export
+        self.sample_rate = sample_rate
+        self.resource = {'attributes': [_attribute('service.name', service_name)]}
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.timeout = timeout
+        self.spans = 0
+        self.batches = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_error = None
+
+    def start_trace(self, name, traceparent):
+        '''Trace for a request, or None if it is not sampled. Also returns
+        the traceparent to send back.'''
+        parent = parse_traceparent(traceparent)
+        if parent is not None:
+            trace_id, parent_span_id, sampled = parent
+        else:
+            trace_id, parent_span_id = new_trace_id(), None
+            sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        if not sampled:
+            # Pass the caller's context through untouched
+            return None, format_traceparent(trace_id, parent_span_id or new_span_id(), False)
+        trace = Trace(self, name, trace_id, parent_span_id)
+        return trace, format_traceparent(trace_id, trace.span_id, True)
+
+    def submit(self, spans):
+        try:
+            self.queue.put_nowait(spans)
+        except queue.Full:
+            self.dropped += len(spans)
+
+    def stop(self, timeout=5.0):
+        '''Export what is queued and stop the thread, waiting at most timeout
+        seconds for room in the queue and again for the export.'''
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self.join(timeout)
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.extend(item)
+            if batch:
+                self._export(batch)
+
+    def _export(self, spans):
+        try:
+            body = json.dumps({'resourceSpans': [{
+                'resource': self.resource,
+                'scopeSpans': [{'scope': {'name': 'orderbook'}, 'spans': spans}]
+            }]}, separators=(',', ':')).encode('utf-8')
+            if self.export.startswith('file:'):
+                with open(self.export[len('file:'):], 'ab') as f:
+                    f.write(body + b'\n')
+            else:
+                request = urllib.request.Request(self.export, data=body, method='POST',
+                                                 headers={'Content-Type': 'application/json'})
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    response.read()
+        except Exception as e:
+            # Spans are lost, tracing must never take the service down (nor
+            # the exporter: http.client errors such as IncompleteRead are
+            # neither OSError nor ValueError)
+            self.errors += 1
+            self.last_error = str(e)
+            return
+        self.spans += len(spans)
+        self.batches += 1
+
+    def stats(self):
+        return {
+            'sampleRate': self.sample_rate,
+            'queued': self.queue.qsize(),
+            'spans': self.spans,
+            'batches': self.batches,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'lastError': self.last_error
+        }
+
+
+class TraceMiddleware:
+    '''Starts a Trace for every sampled request (request.state.trace, None
+    otherwise), finishes it with the response status and returns the
+    traceparent header.'''
+
+    def __init__(self, app, tracer):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        traceparent = tracestate = None
+        for key, value in scope["headers"]:
+            if key == b"traceparent":
+                traceparent = value.decode("latin-1")
+            elif key == b"tracestate":
+                tracestate = value
+        trace, response_traceparent = self.tracer.start_trace(
+            "%s %s" % (scope["method"], scope["path"]), traceparent)
+        scope.setdefault("state", {})["trace"] = trace
+        status = [500]
+
+        async def send_with_context(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"traceparent", response_traceparent.encode("latin-1")))
+                if tracestate is not None:
+                    headers.append((b"tracestate", tracestate))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_context)
+        finally:
+            if trace is not None:
+                trace.finish(status[0])